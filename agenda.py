@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+"""agenda.py
+
+Udacity conference server-side Python App Engine conference agendas
+
+The agenda of a conference is the conference, its sessions ordered by date
+and start time, and their speakers, as one ConferenceAgendaForm. It is
+built by a task whenever the conference or its sessions change, and kept
+zlib compressed in a ConferenceAgenda entity and in memcache, so reading
+it costs one memcache call. Changes within REBUILD_INTERVAL seconds share
+one rebuild; until it has run, readers get the previous version. The seat
+count is the only live part: it is read from the seat cache, see seats.py,
+in the same memcache call.
+"""
+
+import time
+import zlib
+
+from protorpc import protojson
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import ConferenceAgenda, ConferenceAgendaForm
+from models import ConferenceForm, Session, SpeakerForm
+import seats
+import serializers
+
+AGENDA_ID = 'agenda'
+MEMCACHE_AGENDA_PREFIX = "CONFERENCE_AGENDA:"
+AGENDA_CACHE_TIME = 60 * 60     # seconds
+REBUILD_INTERVAL = 5            # seconds between rebuilds per conference
+REBUILD_URL = '/tasks/rebuild_agenda'
+
+
+def agendaKey(conf_key):
+    """Return the key of the ConferenceAgenda of conf_key."""
+    return ndb.Key(ConferenceAgenda, AGENDA_ID, parent=conf_key)
+
+
+def _sessionOrder(session):
+    """Sort key of sessions in an agenda: by date and start time, sessions
+    without them last."""
+    return (session.date is None, session.date,
+            session.startTime is None, session.startTime, session.name)
+
+
+def _buildAgenda(conf, sessions):
+    """Return the ConferenceAgendaForm of conf and its sessions."""
+    speaker_keys = list(set(sess.speakerKey for sess in sessions
+                            if sess.speakerKey))
+    entities = ndb.get_multi([conf.key.parent()] + speaker_keys)
+    prof = entities[0]
+    speakers = dict((speaker.key, speaker)
+                    for speaker in entities[1:] if speaker)
+
+    cf = serializers.copy(conf, ConferenceForm)
+    cf.organizerDisplayName = getattr(prof, 'displayName', None)
+    return ConferenceAgendaForm(
+        conference=cf,
+        sessions=[serializers.copySession(sess, speakers.get(sess.speakerKey))
+                  for sess in sorted(sessions, key=_sessionOrder)],
+        speakers=[serializers.copy(speaker, SpeakerForm) for speaker in
+                  sorted(speakers.values(), key=lambda sp: sp.fullname)],
+        version=int(time.time() * 1000000))
+
+
+@ndb.transactional()
+def _storeAgenda(conf_key, payload, version):
+    """Store the agenda unless a newer version was stored meanwhile.
+    Returns True if it was stored."""
+    agenda = agendaKey(conf_key).get()
+    if agenda and agenda.version > version:
+        return False
+    ConferenceAgenda(key=agendaKey(conf_key), payload=payload,
+                     version=version).put()
+    return True
+
+
+def rebuild(conf_key):
+    """Build and store the agenda of conf_key. Returns the compressed
+    payload, or None if the conference doesn't exist."""
+    if conf_key.kind() != 'Conference':
+        return None
+    conf_future = conf_key.get_async()
+    sessions_future = Session.query(ancestor=conf_key).fetch_async()
+    conf = conf_future.get_result()
+    if not conf:
+        agendaKey(conf_key).delete()
+        memcache.delete(MEMCACHE_AGENDA_PREFIX + conf_key.urlsafe())
+        return None
+
+    form = _buildAgenda(conf, sessions_future.get_result())
+    payload = zlib.compress(protojson.encode_message(form))
+    if _storeAgenda(conf_key, payload, form.version):
+        memcache.set(MEMCACHE_AGENDA_PREFIX + conf_key.urlsafe(), payload,
+                     time=AGENDA_CACHE_TIME)
+    return payload
+
+
+def scheduleRebuild(conf_key):
+    """Schedule the rebuild of the agenda of conf_key; call it once the
+    change has committed."""
+    wsck = conf_key.urlsafe()
+    # one named task per conference and interval coalesces the rebuilds;
+    # it runs after the interval closes so it sees every change made in it
+    now = time.time()
+    bucket = int(now // REBUILD_INTERVAL)
+    try:
+        taskqueue.add(url=REBUILD_URL,
+                      name='rebuild-agenda-%s-%d' % (wsck, bucket),
+                      params={'websafeConferenceKey': wsck},
+                      countdown=int((bucket + 1) * REBUILD_INTERVAL - now) + 1)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def getAgenda(conf_key):
+    """Return the ConferenceAgendaForm of conf_key, or None if the
+    conference doesn't exist. Agendas that were never built are built
+    on the spot."""
+    if conf_key.kind() != 'Conference':
+        return None
+    wsck = conf_key.urlsafe()
+    cached = memcache.get_multi([MEMCACHE_AGENDA_PREFIX + wsck,
+                                 seats.MEMCACHE_SEATS_PREFIX + wsck])
+    payload = cached.get(MEMCACHE_AGENDA_PREFIX + wsck)
+    if payload is None:
+        agenda = agendaKey(conf_key).get()
+        if agenda:
+            payload = agenda.payload
+            memcache.add(MEMCACHE_AGENDA_PREFIX + wsck, payload,
+                         time=AGENDA_CACHE_TIME)
+        else:
+            payload = rebuild(conf_key)
+            if payload is None:
+                return None
+
+    form = protojson.decode_message(ConferenceAgendaForm,
+                                    zlib.decompress(payload))
+    seats_available = cached.get(seats.MEMCACHE_SEATS_PREFIX + wsck)
+    if seats_available is not None:
+        form.conference.seatsAvailable = seats_available
+    return form
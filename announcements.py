@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+"""announcements.py
+
+Udacity conference server-side Python App Engine "nearly sold out"
+announcement
+
+The set of nearly sold out conferences is kept in a single NearlySoldOut
+entity and updated only when a seat change moves a conference across the
+threshold. The announcement string built from it is cached in memcache.
+The hourly cron no longer builds the announcement; it only repairs the set
+in case an update was missed.
+"""
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Conference, NearlySoldOut
+import seats
+
+MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
+ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
+                    'are nearly sold out: %s')
+NEARLY_SOLD_OUT_SEATS = 5
+NEARLY_SOLD_OUT_KEY = ndb.Key(NearlySoldOut, 'announcement')
+
+
+def isNearlySoldOut(seats):
+    """Return True if seats is in the nearly sold out range."""
+    return 0 < (seats or 0) <= NEARLY_SOLD_OUT_SEATS
+
+
+def _formatAnnouncement(nearly):
+    """Return the announcement string for a NearlySoldOut entity."""
+    if not nearly or not nearly.conferenceNames:
+        return ""
+    return ANNOUNCEMENT_TPL % ', '.join(nearly.conferenceNames)
+
+
+def _setAnnouncement(nearly):
+    """Put the announcement for nearly into memcache and return it."""
+    # an empty announcement is cached too, so getAnnouncement() doesn't
+    # go to the datastore while nothing is nearly sold out
+    announcement = _formatAnnouncement(nearly)
+    memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+    return announcement
+
+
+@ndb.transactional()
+def _updateNearlySoldOut(conf_key, name, add):
+    """Add or remove one conference; returns the entity if it changed."""
+    nearly = NEARLY_SOLD_OUT_KEY.get() or NearlySoldOut(key=NEARLY_SOLD_OUT_KEY)
+    if add == (conf_key in nearly.conferenceKeys):
+        return None
+    if add:
+        nearly.conferenceKeys.append(conf_key)
+        nearly.conferenceNames.append(name)
+    else:
+        i = nearly.conferenceKeys.index(conf_key)
+        del nearly.conferenceKeys[i]
+        del nearly.conferenceNames[i]
+    nearly.put()
+    return nearly
+
+
+def seatsChanged(conf, before, after):
+    """Update the announcement if a committed seat change from before to
+    after seats moved conf into or out of the nearly sold out range."""
+    if isNearlySoldOut(before) == isNearlySoldOut(after):
+        return
+    nearly = _updateNearlySoldOut(conf.key, conf.name, isNearlySoldOut(after))
+    if nearly:
+        _setAnnouncement(nearly)
+
+
+def getAnnouncement():
+    """Return the current announcement, from memcache if possible."""
+    announcement = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
+    if announcement is None:
+        announcement = _setAnnouncement(NEARLY_SOLD_OUT_KEY.get())
+    return announcement
+
+
+def repairAnnouncement():
+    """Rebuild the nearly sold out set; run by the hourly cron.
+    Candidates are the conferences the reconciled Conference.seatsAvailable
+    puts in range plus the current members, checked against the live seat
+    count so a write-back that hasn't happened yet can't undo an update."""
+    candidates = set(Conference.query(ndb.AND(
+        Conference.seatsAvailable <= NEARLY_SOLD_OUT_SEATS,
+        Conference.seatsAvailable > 0)
+    ).fetch(keys_only=True))
+    current = NEARLY_SOLD_OUT_KEY.get()
+    if current:
+        candidates.update(current.conferenceKeys)
+
+    confs = [conf for conf in ndb.get_multi(list(candidates)) if conf]
+    live = seats.getSeatsAvailableMulti(confs)
+    confs = sorted((conf for conf in confs if isNearlySoldOut(
+                        live.get(conf.key.urlsafe(), conf.seatsAvailable))),
+                   key=lambda conf: conf.name)
+
+    nearly = NearlySoldOut(key=NEARLY_SOLD_OUT_KEY,
+                           conferenceKeys=[conf.key for conf in confs],
+                           conferenceNames=[conf.name for conf in confs])
+    if not current or (current.conferenceKeys != nearly.conferenceKeys or
+                       current.conferenceNames != nearly.conferenceNames):
+        nearly.put()
+    return _setAnnouncement(nearly)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+"""bench_readpaths.py
+
+Latency benchmark of the ConferenceApi read paths against the local
+datastore stub. Each path is timed as it was before its reads were
+overlapped, with one blocking get or fetch after the other, and as it is
+now; the median wall-clock time and the datastore calls per request are
+printed for both. Run with the App Engine SDK on the Python path:
+
+    python bench_readpaths.py [--rpc-latency 20] [--repeat 50]
+
+The stub answers a call as soon as it is waited on, so every datastore
+call is delayed by --rpc-latency milliseconds on a thread of its own,
+standing in for the round trip to the production datastore. Calls that
+are in flight together overlap, as they do in production.
+"""
+
+import argparse
+import datetime
+import os
+import threading
+import time
+
+from google.appengine.api import apiproxy_rpc
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from conference import ConferenceApi
+from models import Conference, Profile, Session, SessionForms, Speaker
+import seats
+import speakers
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class LatencyRPC(apiproxy_rpc.RPC):
+    """RPC that runs its call on a thread after the stub's latency."""
+
+    def _MakeCallImpl(self):
+        self._state = apiproxy_rpc.RPC.RUNNING
+        self._thread = threading.Thread(target=self._run)
+        self._thread.start()
+
+    def _run(self):
+        time.sleep(self.stub.latency)
+        try:
+            self.stub.MakeSyncCall(self.package, self.call, self.request,
+                                   self.response)
+        except Exception as e:
+            self._exception = e
+
+    def _WaitImpl(self):
+        self._thread.join()
+        self._state = apiproxy_rpc.RPC.FINISHING
+        if self.callback:
+            self.callback()
+        return True
+
+
+class LatencyStub(object):
+    """Wraps the datastore stub, delaying and counting its calls."""
+
+    def __init__(self, stub, latency):
+        self._stub = stub
+        self._lock = threading.Lock()
+        self.latency = latency
+        self.calls = 0
+
+    def CreateRPC(self):
+        return LatencyRPC(stub=self)
+
+    def MakeSyncCall(self, service, call, request, response):
+        with self._lock:
+            self.calls += 1
+        self._stub.MakeSyncCall(service, call, request, response)
+
+    def __getattr__(self, name):
+        return getattr(self._stub, name)
+
+
+def _seed(conferences, sessions_per_conference):
+    """Create conferences, each with its own organizer, sessions and
+    speakers. Returns the websafe conference keys."""
+    entities = []
+    wscks = []
+    start = datetime.date(2026, 1, 1)
+    for i in range(conferences):
+        p_key = ndb.Key(Profile, 'organizer%d@example.com' % i)
+        entities.append(Profile(key=p_key, displayName='Organizer %d' % i,
+                                mainEmail=p_key.id()))
+        conf_key = ndb.Key(Conference, i + 1, parent=p_key)
+        entities.append(Conference(key=conf_key, name='Conference %d' % i,
+                                   organizerUserId=p_key.id(),
+                                   city='London', topics=['Web'],
+                                   startDate=start, month=1,
+                                   maxAttendees=100, seatsAvailable=100))
+        wscks.append(conf_key.urlsafe())
+        for j in range(sessions_per_conference):
+            name = 'Speaker %d' % (j % 5)
+            entities.append(Speaker(key=speakers.speakerKey(name),
+                                    fullname=name))
+            entities.append(Session(
+                parent=conf_key, name='Session %d' % j,
+                speakerKey=speakers.speakerKey(name), speakerName=name,
+                duration=60, typeOfSession='LECTURE', date=start,
+                startTime=datetime.time(9 + j % 8)))
+    ndb.put_multi(entities)
+    return wscks
+
+
+# - - - read paths as they were before their reads overlapped - - - -
+
+def _loadConferenceFormsSequential(api, wscks):
+    conferences = ndb.get_multi([ndb.Key(urlsafe=wsck) for wsck in wscks])
+    conferences = [conf for conf in conferences if conf]
+    organisers = set(conf.key.parent() for conf in conferences)
+    profiles = ndb.get_multi(list(organisers))
+    names = dict((profile.key, profile.displayName)
+                 for profile in profiles if profile)
+    forms = dict((conf.key.urlsafe(),
+                  api._copyConferenceToForm(conf, names.get(conf.key.parent())))
+                 for conf in conferences)
+    for wsck, total in seats.getSeatsAvailableMulti(conferences).items():
+        forms[wsck].seatsAvailable = total
+    return forms
+
+
+def _conferenceSessionsSequential(api, wsck):
+    conf = ndb.Key(urlsafe=wsck).get()
+    sessions = Session.query(ancestor=conf.key).fetch()
+    speaker_keys = list(set(sess.speakerKey for sess in sessions
+                            if sess.speakerKey))
+    found = dict(zip(speaker_keys, ndb.get_multi(speaker_keys)))
+    return SessionForms(
+        items=[api._copySessionToForm(sess, found.get(sess.speakerKey))
+               for sess in sessions])
+
+
+def _conferencesCreatedSequential(p_key):
+    confs = Conference.query(ancestor=p_key).fetch()
+    prof = p_key.get()
+    return confs, prof
+
+
+# - - - read paths as they are now - - - - - - - - - - - - - - - - -
+
+def _conferencesCreated(p_key):
+    confs_future = Conference.query(ancestor=p_key).fetch_async()
+    prof = p_key.get()
+    return confs_future.get_result(), prof
+
+
+def _paths(api, wscks):
+    """Return (name, before, after) for each benchmarked read path."""
+    p_key = ndb.Key(urlsafe=wscks[0]).parent()
+    return [
+        ('getConferencesToAttend',
+         lambda: _loadConferenceFormsSequential(api, wscks),
+         lambda: api._loadConferenceForms(wscks)),
+        ('getConferenceSessions',
+         lambda: _conferenceSessionsSequential(api, wscks[0]),
+         lambda: api._getConferenceSessionsAsync(wscks[0]).get_result()),
+        ('getConferencesCreated',
+         lambda: _conferencesCreatedSequential(p_key),
+         lambda: _conferencesCreated(p_key)),
+    ]
+
+
+def _time(stub, read, repeat):
+    """Return the median milliseconds and the datastore calls of read."""
+    ctx = ndb.get_context()
+    elapsed = []
+    calls = 0
+    for i in range(repeat):
+        ctx.clear_cache()
+        before = stub.calls
+        start = time.time()
+        read()
+        elapsed.append((time.time() - start) * 1000)
+        calls = stub.calls - before
+    elapsed.sort()
+    return elapsed[len(elapsed) // 2], calls
+
+
+def benchmark(stub, conferences, sessions, repeat):
+    wscks = _seed(conferences, sessions)
+    ctx = ndb.get_context()
+    # every read has to go to the datastore
+    ctx.set_cache_policy(False)
+    ctx.set_memcache_policy(False)
+    api = ConferenceApi()
+
+    print('%-24s %10s %10s %8s %14s' % (
+        'path', 'before ms', 'after ms', 'speedup', 'calls (b/a)'))
+    for name, before, after in _paths(api, wscks):
+        before_ms, before_calls = _time(stub, before, repeat)
+        after_ms, after_calls = _time(stub, after, repeat)
+        print('%-24s %10.1f %10.1f %7.2fx %8d/%-5d' % (
+            name, before_ms, after_ms, before_ms / max(after_ms, 0.001),
+            before_calls, after_calls))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Latency benchmark of the ConferenceApi read paths.')
+    parser.add_argument('--rpc-latency', type=float, default=20,
+                        help='milliseconds per datastore call')
+    parser.add_argument('--conferences', type=int, default=20)
+    parser.add_argument('--sessions', type=int, default=20,
+                        help='sessions per conference')
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    tb = testbed.Testbed()
+    tb.activate()
+    tb.init_datastore_v3_stub()
+    tb.init_memcache_stub()
+    tb.init_taskqueue_stub(root_path=HERE)
+    stub = LatencyStub(apiproxy_stub_map.apiproxy.GetStub('datastore_v3'),
+                       args.rpc_latency / 1000.0)
+    apiproxy_stub_map.apiproxy.ReplaceStub('datastore_v3', stub)
+    try:
+        benchmark(stub, args.conferences, args.sessions, args.repeat)
+    finally:
+        tb.deactivate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+"""bench_serializers.py
+
+Micro-benchmark of the entity to message copiers. Every registered kind
+is copied by the compiled copy plans of serializers.py and by the
+reflection-based loops the _copy*ToForm helpers used before; both must
+give the same messages. The best time per entity of each is printed.
+Run with the App Engine SDK on the Python path:
+
+    python bench_serializers.py [--entities 1000] [--repeat 5]
+
+Entities are only built in memory, no datastore is involved.
+"""
+
+import argparse
+import datetime
+import time
+
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from models import Conference, ConferenceForm
+from models import Profile, ProfileForm, TeeShirtSize
+from models import Session, SessionForm
+from models import Speaker, SpeakerForm
+from models import WishList, WishListForm
+import serializers
+
+
+# - - - copies as the _copy*ToForm helpers did them before - - - - - -
+
+def _copyConferenceReflection(conf, displayName):
+    cf = ConferenceForm()
+    for field in cf.all_fields():
+        if hasattr(conf, field.name):
+            # convert Date to date string; just copy others
+            if field.name.endswith('Date'):
+                setattr(cf, field.name, str(getattr(conf, field.name)))
+            else:
+                setattr(cf, field.name, getattr(conf, field.name))
+        elif field.name == "websafeKey":
+            setattr(cf, field.name, conf.key.urlsafe())
+    if displayName:
+        setattr(cf, 'organizerDisplayName', displayName)
+    cf.check_initialized()
+    return cf
+
+
+def _copyProfileReflection(prof):
+    pf = ProfileForm()
+    for field in pf.all_fields():
+        if hasattr(prof, field.name):
+            # convert t-shirt string to Enum; just copy others
+            if field.name == 'teeShirtSize':
+                setattr(pf, field.name, getattr(TeeShirtSize,
+                                                getattr(prof, field.name)))
+            else:
+                setattr(pf, field.name, getattr(prof, field.name))
+    pf.check_initialized()
+    return pf
+
+
+def _copySessionReflection(session, speaker):
+    sform = SessionForm()
+    setattr(sform, 'sessionWebsafeKey', session.key.urlsafe())
+    for field in sform.all_fields():
+        if hasattr(session, field.name):
+            if field.name.endswith('date') or field.name.endswith('startTime'):
+                setattr(sform, field.name, str(getattr(session, field.name)))
+            else:
+                setattr(sform, field.name, getattr(session, field.name))
+    setattr(sform, 'speakerName', str(speaker.fullname))
+    setattr(sform, 'speakerProfession', str(speaker.profession))
+    sform.check_initialized()
+    return sform
+
+
+def _copySpeakerReflection(speaker):
+    spform = SpeakerForm()
+    for field in spform.all_fields():
+        if hasattr(speaker, field.name):
+            setattr(spform, field.name, getattr(speaker, field.name))
+    spform.check_initialized()
+    return spform
+
+
+def _copyWishListReflection(wishlist):
+    wlform = WishListForm()
+    for field in wlform.all_fields():
+        if hasattr(wishlist, field.name):
+            # convert Key to key string and just copy others
+            if field.name.endswith('sessionKey'):
+                setattr(wlform, field.name, str(getattr(wishlist, field.name)))
+            else:
+                setattr(wlform, field.name, getattr(wishlist, field.name))
+    wlform.check_initialized()
+    return wlform
+
+
+def _entities(count):
+    """Return {kind name: [entity, ...]} with count entities of each."""
+    start = datetime.date(2026, 1, 1)
+    speaker = Speaker(key=ndb.Key(Speaker, 'jane doe'), fullname='Jane Doe',
+                      profession='Engineer')
+    entities = {'Conference': [], 'Profile': [], 'Session': [],
+                'Speaker': [], 'WishList': []}
+    for i in range(count):
+        p_key = ndb.Key(Profile, 'user%d@example.com' % i)
+        conf_key = ndb.Key(Conference, i + 1, parent=p_key)
+        sess_key = ndb.Key(Session, i + 1, parent=conf_key)
+        entities['Conference'].append(Conference(
+            key=conf_key, name='Conference %d' % i,
+            description='A conference', organizerUserId=p_key.id(),
+            topics=['Web', 'Mobile'], city='London', startDate=start,
+            month=1, endDate=start + datetime.timedelta(days=2),
+            maxAttendees=100, seatsAvailable=42))
+        entities['Profile'].append(Profile(
+            key=p_key, displayName='User %d' % i, mainEmail=p_key.id(),
+            teeShirtSize='M_M',
+            conferenceKeysToAttend=[conf_key.urlsafe()]))
+        entities['Session'].append(Session(
+            key=sess_key, name='Session %d' % i, highlights='Highlights',
+            speakerKey=speaker.key, speakerName=speaker.fullname,
+            duration=60, typeOfSession='LECTURE', date=start,
+            startTime=datetime.time(9, 30)))
+        entities['Speaker'].append(Speaker(
+            key=ndb.Key(Speaker, 'speaker %d' % i),
+            fullname='Speaker %d' % i, profession='Engineer'))
+        entities['WishList'].append(WishList(
+            key=ndb.Key(WishList, sess_key.urlsafe(), parent=p_key),
+            sessionKey=sess_key, userID=p_key.id()))
+    return entities, speaker
+
+
+def _copiers(speaker):
+    """Return (kind name, before, after) for each registered kind."""
+    return [
+        ('Conference',
+         lambda conf: _copyConferenceReflection(conf, 'Organizer'),
+         lambda conf: _withDisplayName(
+             serializers.copy(conf, ConferenceForm), 'Organizer')),
+        ('Profile', _copyProfileReflection,
+         lambda prof: serializers.copy(prof, ProfileForm)),
+        ('Session',
+         lambda sess: _copySessionReflection(sess, speaker),
+         lambda sess: serializers.copySession(sess, speaker)),
+        ('Speaker', _copySpeakerReflection,
+         lambda sp: serializers.copy(sp, SpeakerForm)),
+        ('WishList', _copyWishListReflection,
+         lambda wl: serializers.copy(wl, WishListForm)),
+    ]
+
+
+def _withDisplayName(cf, displayName):
+    cf.organizerDisplayName = displayName
+    return cf
+
+
+def _best(copier, entities, repeat):
+    """Return the best microseconds per entity over repeat runs."""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        for entity in entities:
+            copier(entity)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000000 / len(entities)
+
+
+def benchmark(count, repeat):
+    entities, speaker = _entities(count)
+    print('%-12s %12s %12s %8s' % ('kind', 'before us', 'after us',
+                                   'speedup'))
+    for name, before, after in _copiers(speaker):
+        for entity in entities[name][:10]:
+            assert before(entity) == after(entity), name
+        before_us = _best(before, entities[name], repeat)
+        after_us = _best(after, entities[name], repeat)
+        print('%-12s %12.1f %12.1f %7.2fx' % (
+            name, before_us, after_us, before_us / max(after_us, 0.001)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Micro-benchmark of the entity to message copiers.')
+    parser.add_argument('--entities', type=int, default=1000,
+                        help='entities copied per run and kind')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    # keys need an application id
+    tb = testbed.Testbed()
+    tb.activate()
+    try:
+        benchmark(args.entities, args.repeat)
+    finally:
+        tb.deactivate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+"""bulkimport.py
+
+Udacity conference server-side Python App Engine bulk conference import
+
+An upload is parsed once, in the API call, into ConferenceImportChunk
+entities of CHUNK_SIZE rows. The chunks of one import are processed one
+after the other, since they all write to the organizer's entity group:
+each chunk's task queues the task of the next chunk when it finishes,
+while the chunks of different imports run in parallel. Each task
+allocates a block of Conference ids for its rows, remembers it on the
+chunk so a retried task writes the same keys again, creates the
+conferences with a single put_multi and queues one confirmation for the
+whole chunk. Progress and rejected rows are collected on the
+ConferenceImport entity.
+"""
+
+import csv
+import json
+from StringIO import StringIO
+
+from protorpc import messages
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import caching
+import facets
+import mailer
+from models import Conference, ConferenceForm
+from models import ConferenceImport, ConferenceImportChunk, ImportRowError
+from models import ImportFormat
+import serializers
+import textsearch
+
+CHUNK_SIZE = 100
+MAX_REPORTED_ERRORS = 100
+IMPORT_QUEUE = 'conference-import'
+PROCESS_CHUNK_URL = '/tasks/import_conferences_chunk'
+# ConferenceForm fields a row may set; the rest are derived on creation
+IMPORT_FIELDS = frozenset(('name', 'description', 'topics', 'city',
+                           'startDate', 'endDate', 'maxAttendees'))
+TOPIC_SEPARATOR = ';'
+
+
+def _parseJsonLines(data):
+    """Yield (row, values, error) for every non blank line of data."""
+    for row, line in enumerate(data.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            values = json.loads(line)
+        except ValueError as e:
+            yield row, None, 'invalid JSON: %s' % e
+            continue
+        if not isinstance(values, dict):
+            yield row, None, 'expected a JSON object'
+        else:
+            yield row, values, None
+
+
+def _parseCsv(data):
+    """Yield (row, values, error) for every data row of data; the first
+    row holds the field names."""
+    reader = csv.reader(StringIO(data.encode('utf-8')))
+    header = None
+    for cells in reader:
+        cells = [cell.decode('utf-8').strip() for cell in cells]
+        if not any(cells):
+            continue
+        if header is None:
+            header = cells
+            continue
+        if len(cells) != len(header):
+            yield reader.line_num, None, 'expected %d columns, got %d' % (
+                len(header), len(cells))
+        else:
+            yield reader.line_num, dict(zip(header, cells)), None
+
+
+def parseRows(data, fmt):
+    """Split data, in ImportFormat fmt, into rows. Returns ([[row, values],
+    ...], [ImportRowError, ...]); row is the line number in data."""
+    parse = _parseCsv if fmt == ImportFormat.CSV else _parseJsonLines
+    rows = []
+    errors = []
+    for row, values, error in parse(data):
+        if error:
+            errors.append(ImportRowError(row=row, message=error))
+        else:
+            rows.append([row, values])
+    return rows, errors
+
+
+def _formFromRow(values):
+    """Return the ConferenceForm for the values of one row. Raises
+    ValueError or messages.ValidationError if the row is invalid."""
+    form = ConferenceForm()
+    for name, value in values.items():
+        if name not in IMPORT_FIELDS:
+            raise ValueError('unknown field %r' % name)
+        if value in (None, '', []):
+            continue
+        field = form.field_by_name(name)
+        if isinstance(value, basestring):
+            if field.repeated:
+                value = [item.strip() for item in value.split(TOPIC_SEPARATOR)
+                         if item.strip()]
+            elif isinstance(field, messages.IntegerField):
+                value = int(value)
+        setattr(form, name, value)
+    if not form.name:
+        raise ValueError("'name' field required")
+    return form
+
+
+def _enqueueChunk(chunk_key, transactional=False):
+    """Enqueue the task that processes chunk_key."""
+    taskqueue.add(url=PROCESS_CHUNK_URL, queue_name=IMPORT_QUEUE,
+                  params={'websafeChunkKey': chunk_key.urlsafe()},
+                  transactional=transactional)
+
+
+def startImport(p_key, email, rows, errors):
+    """Store the parsed rows of an import by the organizer p_key in chunks
+    and enqueue the task of the first chunk. Returns the ConferenceImport."""
+    imp_id = ConferenceImport.allocate_ids(size=1, parent=p_key)[0]
+    imp_key = ndb.Key(ConferenceImport, imp_id, parent=p_key)
+    chunks = [ConferenceImportChunk(
+                  key=ndb.Key(ConferenceImportChunk, n + 1, parent=imp_key),
+                  rows=rows[start:start + CHUNK_SIZE])
+              for n, start in enumerate(range(0, len(rows), CHUNK_SIZE))]
+    imp = ConferenceImport(key=imp_key, email=email,
+                           status='RUNNING' if chunks else 'DONE',
+                           totalRows=len(rows) + len(errors),
+                           chunks=len(chunks), errorRows=len(errors),
+                           errors=errors[:MAX_REPORTED_ERRORS])
+    ndb.put_multi([imp] + chunks)
+    if chunks:
+        _enqueueChunk(chunks[0].key)
+    return imp
+
+
+@ndb.transactional()
+def _finishChunk(chunk_key, conf_keys, errors):
+    """Mark the chunk done, count its rows on the import and queue the
+    confirmation email and the next chunk's task. Returns False if a
+    previous run already did."""
+    imp, chunk = ndb.get_multi([chunk_key.parent(), chunk_key])
+    if chunk.done:
+        return False
+    chunk.done = True
+    imp.chunksDone += 1
+    imp.createdRows += len(conf_keys)
+    imp.errorRows += len(errors)
+    imp.errors = (imp.errors + errors)[:MAX_REPORTED_ERRORS]
+    if imp.chunksDone == imp.chunks:
+        imp.status = 'DONE'
+    ndb.put_multi([imp, chunk])
+
+    # chunks are numbered from 1 in the order of their rows
+    if chunk_key.id() < imp.chunks:
+        _enqueueChunk(ndb.Key(ConferenceImportChunk, chunk_key.id() + 1,
+                              parent=chunk_key.parent()),
+                      transactional=True)
+
+    if conf_keys:
+        mailer.enqueueConfirmation(imp.email, conf_keys, transactional=True)
+    return True
+
+
+def processChunk(chunk_key):
+    """Create the conferences of one ConferenceImportChunk."""
+    chunk = chunk_key.get()
+    if not chunk or chunk.done:
+        return
+    p_key = chunk_key.parent().parent()
+
+    # allocate the ids once, so a retried task overwrites its own writes
+    if chunk.firstId is None:
+        chunk.firstId = Conference.allocate_ids(size=len(chunk.rows),
+                                                parent=p_key)[0]
+        chunk.put()
+
+    confs = []
+    errors = []
+    for offset, (row, values) in enumerate(chunk.rows):
+        try:
+            form = _formFromRow(values)
+            data = serializers.conferenceDataFromForm(form)
+        except (ValueError, TypeError, messages.ValidationError) as e:
+            errors.append(ImportRowError(row=row, message=str(e)))
+            continue
+        data['key'] = ndb.Key(Conference, chunk.firstId + offset, parent=p_key)
+        data['organizerUserId'] = p_key.id()
+        confs.append(Conference(**data))
+
+    ndb.put_multi(confs)
+    textsearch.indexConferences(confs)
+    facets.countConferences(confs)
+    if _finishChunk(chunk_key, [conf.key for conf in confs], errors) and confs:
+        caching.bumpListingGeneration()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+"""caching.py
+
+Udacity conference server-side Python App Engine read-through caches
+
+Serialized ConferenceForm payloads are kept in memcache, keyed by the
+websafe key of the conference, and in a per-request dict so that repeated
+lookups within one API call never leave the instance.
+
+queryConferences responses are shared by all users and cached whole,
+keyed by a hash of the normalized query plus a listing generation number.
+Every write that can change a listing bumps the generation, which orphans
+all cached listings at once; the same two values form the ETag. Listing
+queries are eventually consistent, so a listing built right after a write
+may miss it; a task bumps the generation again LISTING_SETTLE_TIME later,
+which drops any such listing. Seat registrations don't bump it: listings
+are cached without seatsAvailable, which is filled in from the
+per-conference cache when they are served.
+
+Profiles are read on nearly every authenticated call. profileCache keeps
+them in a bounded LRU per instance, in front of memcache. Each local entry
+carries the version stamp its Profile had in memcache when it was loaded;
+invalidate() bumps the stamp, so every instance drops its copy on the next
+read, which costs one small memcache get instead of the whole Profile.
+"""
+
+import collections
+import hashlib
+import json
+import threading
+import time
+
+from protorpc import protojson
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+
+from models import ConferenceForm, ConferenceForms
+
+MEMCACHE_CONFERENCE_PREFIX = "CONFERENCE_FORM:"
+CONFERENCE_CACHE_TIME = 10 * 60     # seconds
+# after an invalidation, refuse memcache.add() for this long so a reader
+# that loaded the entity before the write committed can't put it back
+INVALIDATION_LOCK_TIME = 2          # seconds
+MEMCACHE_LISTING_GENERATION_KEY = "CONFERENCE_LISTING_GENERATION"
+MEMCACHE_LISTING_PREFIX = "CONFERENCE_LISTING:"
+LISTING_CACHE_TIME = 10 * 60        # seconds
+# memcache values are limited to 1 MB, key included
+MAX_LISTING_CACHE_SIZE = 1000 * 1000    # bytes
+LISTING_SETTLE_TIME = 5             # seconds until the second bump
+BUMP_LISTING_GENERATION_URL = '/tasks/bump_listing_generation'
+MEMCACHE_PROFILE_PREFIX = "PROFILE:"
+MEMCACHE_PROFILE_VERSION_PREFIX = "PROFILE_VERSION:"
+PROFILE_CACHE_TIME = 10 * 60        # seconds
+PROFILE_LOCAL_CACHE_TIME = 30       # seconds
+PROFILE_LOCAL_CACHE_SIZE = 1000     # entries per instance
+
+
+class ConferenceFormCache(object):
+    """Read-through cache of serialized ConferenceForm payloads.
+
+    One instance lives for one request; the memcache layer is shared by
+    all instances. Writers must call invalidate() once their transaction
+    has committed.
+    """
+
+    def __init__(self):
+        self._local = {}
+
+    def get_multi(self, wscks, loader):
+        """Return a {websafeKey: ConferenceForm} dict for wscks.
+
+        loader(wscks) is called with the keys missing from both cache
+        layers and must return a {websafeKey: ConferenceForm} dict;
+        conferences that don't exist are simply left out of the result.
+        """
+        payloads = {}
+        missing = []
+        for wsck in wscks:
+            if wsck in self._local:
+                payloads[wsck] = self._local[wsck]
+            elif wsck not in missing:
+                missing.append(wsck)
+
+        if missing:
+            cached = memcache.get_multi(missing,
+                                        key_prefix=MEMCACHE_CONFERENCE_PREFIX)
+            payloads.update(cached)
+            self._local.update(cached)
+            missing = [wsck for wsck in missing if wsck not in cached]
+
+        if missing:
+            loaded = {}
+            for wsck, form in loader(missing).items():
+                if form is not None:
+                    loaded[wsck] = protojson.encode_message(form)
+            if loaded:
+                memcache.add_multi(loaded, time=CONFERENCE_CACHE_TIME,
+                                   key_prefix=MEMCACHE_CONFERENCE_PREFIX)
+            payloads.update(loaded)
+            self._local.update(loaded)
+
+        # decode on every call so callers can't mutate the cached copy
+        return dict((wsck, protojson.decode_message(ConferenceForm, payload))
+                    for wsck, payload in payloads.items())
+
+    def get(self, wsck, loader):
+        """Return the ConferenceForm for wsck, or None if it doesn't exist."""
+        return self.get_multi([wsck], loader).get(wsck)
+
+    def invalidate(self, wsck):
+        """Drop wsck from both cache layers."""
+        self._local.pop(wsck, None)
+        memcache.delete(MEMCACHE_CONFERENCE_PREFIX + wsck,
+                        seconds=INVALIDATION_LOCK_TIME)
+
+
+class ProfileCache(object):
+    """Read-through cache of Profile entities, keyed by user id.
+
+    One instance lives for the whole instance (see profileCache) and is
+    shared by concurrent requests. Entries are kept as serialized protocol
+    buffers, so every get() returns a fresh entity that the caller may
+    change. Only read-only callers should use it: read-modify-write code
+    must get the Profile from the datastore, and call invalidate() once its
+    write has committed; local entries whose version stamp is no longer
+    current are ignored on every instance.
+    """
+
+    def __init__(self, size=PROFILE_LOCAL_CACHE_SIZE,
+                 local_time=PROFILE_LOCAL_CACHE_TIME):
+        self._size = size
+        self._local_time = local_time
+        # user id: (expires, version, pb)
+        self._local = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.localHits = 0
+        self.memcacheHits = 0
+        self.misses = 0
+
+    def _version(self, user_id):
+        """Return the current version stamp of the Profile of user_id, or
+        None if memcache can't tell."""
+        key = MEMCACHE_PROFILE_VERSION_PREFIX + user_id
+        version = memcache.get(key)
+        if version is None:
+            memcache.add(key, _newGeneration())
+            version = memcache.get(key)
+        return version
+
+    def _getLocal(self, user_id, version):
+        with self._lock:
+            entry = self._local.pop(user_id, None)
+            if entry is None:
+                return None
+            if entry[0] < time.time() or version is None or \
+                    entry[1] != version:
+                return None
+            # re-insert to mark it as most recently used
+            self._local[user_id] = entry
+            self.localHits += 1
+            return entry[2]
+
+    def _setLocal(self, user_id, version, pb):
+        with self._lock:
+            self._local.pop(user_id, None)
+            self._local[user_id] = (time.time() + self._local_time,
+                                    version, pb)
+            while len(self._local) > self._size:
+                self._local.popitem(last=False)
+
+    def get(self, p_key):
+        """Return the Profile for p_key, or None if it doesn't exist."""
+        user_id = p_key.id()
+        # read before the Profile, so a copy loaded while invalidate() runs
+        # is stamped with the old version
+        version = self._version(user_id)
+        pb = self._getLocal(user_id, version)
+        if pb is None:
+            pb = memcache.get(MEMCACHE_PROFILE_PREFIX + user_id)
+            with self._lock:
+                if pb is not None:
+                    self.memcacheHits += 1
+                else:
+                    self.misses += 1
+            if pb is None:
+                profile = p_key.get()
+                if profile is None:
+                    return None
+                pb = ndb.model_to_protobuf(profile).SerializeToString()
+                memcache.add(MEMCACHE_PROFILE_PREFIX + user_id, pb,
+                             time=PROFILE_CACHE_TIME)
+            self._setLocal(user_id, version, pb)
+        return ndb.model_from_protobuf(entity_pb.EntityProto(pb))
+
+    def invalidate(self, p_key):
+        """Drop p_key from memcache and from every instance."""
+        with self._lock:
+            self._local.pop(p_key.id(), None)
+        memcache.delete(MEMCACHE_PROFILE_PREFIX + p_key.id(),
+                        seconds=INVALIDATION_LOCK_TIME)
+        memcache.incr(MEMCACHE_PROFILE_VERSION_PREFIX + p_key.id(),
+                      initial_value=_newGeneration())
+
+    def stats(self):
+        """Return the hit and miss counters of this instance."""
+        return {'localHits': self.localHits,
+                'memcacheHits': self.memcacheHits,
+                'misses': self.misses,
+                'size': len(self._local)}
+
+
+profileCache = ProfileCache()
+
+
+def _newGeneration():
+    """Return a generation number that no earlier generation can reach,
+    even if the counter was evicted from memcache."""
+    return int(time.time() * 1000000)
+
+
+def listingGeneration():
+    """Return the current conference listing generation."""
+    generation = memcache.get(MEMCACHE_LISTING_GENERATION_KEY)
+    if generation is None:
+        memcache.add(MEMCACHE_LISTING_GENERATION_KEY, _newGeneration())
+        generation = memcache.get(MEMCACHE_LISTING_GENERATION_KEY)
+    return generation
+
+
+def bumpListingGeneration(delayed=False):
+    """Invalidate every cached conference listing, now and once more
+    after LISTING_SETTLE_TIME; delayed is set by that second bump."""
+    memcache.incr(MEMCACHE_LISTING_GENERATION_KEY,
+                  initial_value=_newGeneration())
+    if delayed:
+        return
+    # one named task per interval coalesces the second bumps; it runs at
+    # least LISTING_SETTLE_TIME after every bump made in the interval
+    now = time.time()
+    bucket = int(now // LISTING_SETTLE_TIME)
+    try:
+        taskqueue.add(url=BUMP_LISTING_GENERATION_URL,
+                      name='bump-listing-generation-%d' % bucket,
+                      countdown=int((bucket + 2) * LISTING_SETTLE_TIME - now) + 1)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def listingETag(request):
+    """Return the ETag of the queryConferences response for request, a
+    ConferenceQueryForms, in the current listing generation."""
+    query = {
+        'filters': sorted((f.field or '', f.operator or '', f.value or '')
+                          for f in request.filters),
+        'fields': sorted(request.fields),
+        'pageSize': request.pageSize,
+        'pageToken': request.pageToken,
+        'debug': bool(request.debug),
+    }
+    canonical = json.dumps(query, sort_keys=True)
+    return hashlib.sha1('%s:%s' % (listingGeneration(), canonical)).hexdigest()
+
+
+def getListing(etag):
+    """Return the cached ConferenceForms for etag, or None."""
+    payload = memcache.get(MEMCACHE_LISTING_PREFIX + etag)
+    if payload is None:
+        return None
+    return protojson.decode_message(ConferenceForms, payload)
+
+
+def setListing(etag, forms):
+    """Cache the ConferenceForms response for etag, unless it is too big
+    for memcache; the response is served either way."""
+    payload = protojson.encode_message(forms)
+    if len(payload) > MAX_LISTING_CACHE_SIZE:
+        return
+    try:
+        memcache.set(MEMCACHE_LISTING_PREFIX + etag, payload,
+                     time=LISTING_CACHE_TIME)
+    except ValueError:
+        pass
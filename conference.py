@@ -18,16 +18,38 @@ from protorpc import remote
 
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
+from google.appengine.api.datastore_errors import BadValueError
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
 from models import ConflictException, Profile, ProfileMiniForm, ProfileForm
 from models import StringMessage, BooleanMessage
 from models import Conference, ConferenceForm, ConferenceForms
 from models import ConferenceQueryForm, ConferenceQueryForms, TeeShirtSize
-from models import Session, SessionForm, SessionForms
+from models import ConferenceImportForm, ConferenceImportStatusForm
+from models import ConferenceAgendaForm, ConferenceSearchForm
+from models import ConferenceFacetsForm, FacetCountForm
+from models import Session, SessionForm, SessionForms, SessionSearchForm
+from models import normalizeSessionType
+from models import SpeakerSessions, FeaturedSpeaker
 from models import Speaker, SpeakerForm, SpeakerForms
 from models import WishList, WishListForm, WishListForms
 
+import agenda
+import announcements
+import bulkimport
+import caching
+from caching import ConferenceFormCache
+import facets
+import instrumentation
+import mailer
+import planner
+import seats
+import serializers
+import speakers
+import textsearch
+import unitofwork
+
 from settings import WEB_CLIENT_ID, ANDROID_CLIENT_ID, IOS_CLIENT_ID
 from settings import ANDROID_AUDIENCE
 from utils import getUserId
@@ -36,25 +58,23 @@ __author__ = 'Yongkie Wiyogo'
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
-MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
-ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
-                    'are nearly sold out: %s')
-MEMCACHE_FEATURED_SPEAKER = "FEATURED_SPEAKER"
+MEMCACHE_FEATURED_SPEAKER = "FEATURED_SPEAKER:"
+FEATURED_SPEAKER_CACHE_TIME = 10 * 60  # seconds
+FEATURED_SPEAKER_ID = 'featured'
 FEATURED_SPEAKER_TPL = ('Featured speaker of this conference is %s. His/her session names are %s')
+MAX_PAGE_SIZE = 100
+# ConferenceForm fields shown by the conference list views; a projection on
+# exactly these properties is served by the "conference listings" indexes
+LISTING_PROJECTION = ('name', 'city', 'maxAttendees', 'organizerUserId',
+                      'seatsAvailable', 'startDate')
+LISTING_FIELDS = frozenset(LISTING_PROJECTION +
+                           ('websafeKey', 'organizerDisplayName'))
+SEAT_SHARD_ATTEMPTS = 3
+MAX_BATCH_SESSIONS = 500
+# most sessions one searchSessions call reads from the datastore
+MAX_SEARCH_SCAN = 1000
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
-DEFAULTS = {
-    "city": "Default City",
-    "maxAttendees": 0,
-    "seatsAvailable": 0,
-    "topics": [ "Default", "Topic" ],
-}
-
-SESSION_DEFAULTS = {
-    "duration": 0,
-    "typeOfSession": "NOT_SPECIFIED"
-}
-
 OPERATORS = {
             'EQ':   '=',
             'GT':   '>',
@@ -76,6 +96,16 @@ CONF_GET_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
 )
 
+CONF_CREATED_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    fields=messages.StringField(1, repeated=True),
+)
+
+IMPORT_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeImportKey=messages.StringField(1),
+)
+
 CONF_POST_REQUEST = endpoints.ResourceContainer(
     ConferenceForm,
     websafeConferenceKey=messages.StringField(1)
@@ -100,10 +130,19 @@ SESSION_GET_REQUEST_BY_SPEAKER_TYPE = endpoints.ResourceContainer(
     speakerFullname=messages.StringField(1),
     typeOfSession=messages.StringField(2)
 )
+SESSION_PAGE_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    pageSize=messages.IntegerField(1),
+    pageToken=messages.StringField(2),
+)
 WISHLIST_POST_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     sessionKey=messages.StringField(1),
 )
+WISHLIST_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+)
 
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -116,25 +155,67 @@ WISHLIST_POST_REQUEST = endpoints.ResourceContainer(
 class ConferenceApi(remote.Service):
     """Conference API v0.1"""
 
+    def __init__(self):
+        super(ConferenceApi, self).__init__()
+        # a new service instance is created for every request, so this
+        # also serves as the per-request conference cache
+        self._conferenceCache = ConferenceFormCache()
+        # entities written by this request, see unitofwork.py
+        self._unitOfWork = unitofwork.UnitOfWork()
+
 # - - - Conference objects - - - - - - - - - - - - - - - - -
 
     def _copyConferenceToForm(self, conf, displayName):
         """Copy relevant fields from Conference to ConferenceForm."""
-        cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
+        cf = serializers.copy(conf, ConferenceForm)
         if displayName:
-            setattr(cf, 'organizerDisplayName', displayName)
-        cf.check_initialized()
+            cf.organizerDisplayName = displayName
         return cf
 
+    def _loadConferenceForms(self, wscks):
+        """Load Conferences by websafe key and return them as a
+        {websafeKey: ConferenceForm} dict; cache loader for
+        ConferenceFormCache."""
+        # the organiser is the parent of the conference key, so conferences
+        # and organizers can be fetched together in one batch; keys of
+        # other kinds are left out like missing conferences
+        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in wscks]
+        conf_keys = [key for key in conf_keys if key.kind() == 'Conference']
+        organisers = list(set(key.parent() for key in conf_keys))
+        entities = ndb.get_multi(conf_keys + organisers)
+        conferences = [conf for conf in entities[:len(conf_keys)] if conf]
+        profiles = entities[len(conf_keys):]
+        names = {}
+        for profile in profiles:
+            if profile:
+                names[profile.key] = profile.displayName
+
+        forms = dict((conf.key.urlsafe(),
+                      self._copyConferenceToForm(conf, names.get(conf.key.parent())))
+                     for conf in conferences)
+
+        # sharded conferences report the live seat count, not the
+        # periodically reconciled Conference.seatsAvailable
+        for wsck, total in seats.getSeatsAvailableMulti(conferences).items():
+            forms[wsck].seatsAvailable = total
+        return forms
+
+    def _invalidateConference(self, wsck, listings=True):
+        """Invalidate the cached ConferenceForm and, unless listings is
+        False, conference listings once the current transaction (if any)
+        has committed."""
+        def invalidate():
+            self._conferenceCache.invalidate(wsck)
+            if listings:
+                caching.bumpListingGeneration()
+        ndb.get_context().call_on_commit(invalidate)
+
+
+    def _invalidateProfile(self, p_key):
+        """Invalidate the cached Profile once the current transaction
+        (if any) has committed."""
+        ndb.get_context().call_on_commit(
+            lambda: caching.profileCache.invalidate(p_key))
 
     def _createConferenceObject(self, request):
         """Create or update Conference object, returning ConferenceForm."""
@@ -148,28 +229,11 @@ class ConferenceApi(remote.Service):
             raise endpoints.BadRequestException("Conference 'name' field required")
 
         # copy ConferenceForm/ProtoRPC Message into dict
-        data = {field.name: getattr(request, field.name) for field in request.all_fields()}
-        del data['websafeKey']
-        del data['organizerDisplayName']
-
-        # add default values for those missing (data model&outbound Message)
-        for df in DEFAULTS:
-            if data[df] in (None, []):
-                data[df] = DEFAULTS[df]
-                setattr(request, df, DEFAULTS[df])
-
-        # convert dates from strings->Date objects;set month basedon start_date
-        if data['startDate']:
-            data['startDate'] = datetime.strptime(data['startDate'][:10], "%Y-%m-%d").date()
-            data['month'] = data['startDate'].month
-        else:
-            data['month'] = 0
-        if data['endDate']:
-            data['endDate'] = datetime.strptime(data['endDate'][:10], "%Y-%m-%d").date()
-
-        # set seatsAvailable to be same as maxAttendees on creation
-        if data["maxAttendees"] > 0:
-            data["seatsAvailable"] = data["maxAttendees"]
+        try:
+            data = serializers.conferenceDataFromForm(request)
+        except ValueError:
+            raise endpoints.BadRequestException(
+                "Conference dates must be formatted as YYYY-MM-DD")
 
         # generate Profile Key based on user ID and Conference
         # ID based on Profile key get Conference key from ID. See Lesson 4
@@ -181,14 +245,15 @@ class ConferenceApi(remote.Service):
 
         # create Conference, send email to organizer confirming
         # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
-        taskqueue.add(params={'email': user.email(),
-                              'conferenceInfo': repr(request)},
-                               url='/tasks/send_confirmation_email'
-        )
+        self._unitOfWork.add(Conference(**data))
+        self._unitOfWork.flush()
+        caching.bumpListingGeneration()
+        textsearch.scheduleIndex(c_key)
+        facets.scheduleUpdate(c_key)
+        mailer.enqueueConfirmation(user.email(), [c_key])
         return request
 
-    @ndb.transactional()
+    @ndb.transactional(xg=True)
     def _updateConferenceObject(self, request):
         user = endpoints.get_current_user()
         if not user:
@@ -199,8 +264,10 @@ class ConferenceApi(remote.Service):
         data = {field.name: getattr(request, field.name)
                 for field in request.all_fields()}
 
-        # update existing conference
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        # update existing conference; the transaction may be retried, so
+        # every attempt gets a unit of work of its own
+        uow = unitofwork.UnitOfWork()
+        conf = uow.track(ndb.Key(urlsafe=request.websafeConferenceKey).get())
         # check that conference exists
         if not conf:
             raise endpoints.NotFoundException('No conference found with key: %s'
@@ -211,6 +278,9 @@ class ConferenceApi(remote.Service):
             raise endpoints.ForbiddenException(
                 'Only the owner can update the conference.')
 
+        old_max = conf.maxAttendees or 0
+        old_seats = conf.seatsAvailable
+
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
         for field in request.all_fields():
@@ -224,39 +294,152 @@ class ConferenceApi(remote.Service):
                         conf.month = data.month
                 # write to Conference object
                 setattr(conf, field.name, data)
-        conf.put()
+
+        # once sharded, seatsAvailable is owned by the seat counter; only
+        # a change of maxAttendees moves seats
+        if conf.seatShards:
+            delta = (conf.maxAttendees or 0) - old_max
+            if delta and not seats.adjustSeats(conf, delta):
+                raise ConflictException(
+                    "maxAttendees can't be cut below the seats already taken.")
+            conf.seatsAvailable = (old_seats or 0) + delta
+        # an update that changes nothing writes nothing
+        if uow.flush():
+            new_seats = conf.seatsAvailable
+            ndb.get_context().call_on_commit(
+                lambda: announcements.seatsChanged(conf, old_seats, new_seats))
+            ndb.get_context().call_on_commit(
+                lambda: agenda.scheduleRebuild(conf.key))
+            textsearch.scheduleIndex(conf.key)
+            facets.scheduleUpdate(conf.key)
+            self._invalidateConference(request.websafeConferenceKey)
         prof = ndb.Key(Profile, user_id).get()
         return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
 
-    @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
+    @instrumentation.method(ConferenceForm, ConferenceForm, path='conference',
             http_method='POST', name='createConference')
     def createConference(self, request):
         """Create new conference."""
         return self._createConferenceObject(request)
 
-    @endpoints.method(CONF_POST_REQUEST, ConferenceForm,
+    @instrumentation.method(CONF_POST_REQUEST, ConferenceForm,
                       path='conference/{websafeConferenceKey}',
                       http_method='PUT', name='updateConference')
     def updateConference(self, request):
         """Update conference w/provided fields & return w/updated info."""
         return self._updateConferenceObject(request)
 
-    @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
+    @instrumentation.method(CONF_GET_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='GET', name='getConference')
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
-        # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        if not conf:
+        # get ConferenceForm from cache or datastore; bail if not found
+        cf = self._conferenceCache.get(request.websafeConferenceKey,
+                                       self._loadConferenceForms)
+        if not cf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
-        # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        return cf
 
+    @instrumentation.method(CONF_GET_REQUEST, ConferenceAgendaForm,
+            path='conference/{websafeConferenceKey}/agenda',
+            http_method='GET', name='getConferenceAgenda')
+    def getConferenceAgenda(self, request):
+        """Return a conference with its sessions, ordered by date and start
+        time, and their speakers, precomputed; see agenda.py."""
+        form = agenda.getAgenda(ndb.Key(urlsafe=request.websafeConferenceKey))
+        if not form:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
+        return form
+
+    @instrumentation.method(ConferenceImportForm, ConferenceImportStatusForm,
+            path='conference/import',
+            http_method='POST', name='importConferences')
+    def importConferences(self, request):
+        """Create conferences in bulk from JSONL or CSV data. The rows are
+        written by background tasks; poll getConferenceImport for progress."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+
+        rows, errors = bulkimport.parseRows(request.data or '', request.format)
+        if not rows and not errors:
+            raise endpoints.BadRequestException("Import 'data' field required")
+        imp = bulkimport.startImport(ndb.Key(Profile, user_id), user.email(),
+                                     rows, errors)
+        return serializers.copy(imp, ConferenceImportStatusForm)
+
+    @instrumentation.method(IMPORT_GET_REQUEST, ConferenceImportStatusForm,
+            path='conference/import/{websafeImportKey}',
+            http_method='GET', name='getConferenceImport')
+    def getConferenceImport(self, request):
+        """Return the progress and rejected rows of a bulk import."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+        imp_key = ndb.Key(urlsafe=request.websafeImportKey)
+        imp = imp_key.get() if imp_key.kind() == 'ConferenceImport' else None
+        if not imp:
+            raise endpoints.NotFoundException(
+                'No import found with key: %s' % request.websafeImportKey)
+        if imp_key.parent() != ndb.Key(Profile, user_id):
+            raise endpoints.ForbiddenException(
+                'Only the owner can view the import.')
+        return serializers.copy(imp, ConferenceImportStatusForm)
+
+
+    def _checkFields(self, fields):
+        """Raise BadRequestException for unknown ConferenceForm fields."""
+        unknown = set(fields) - set(f.name for f in ConferenceForm.all_fields())
+        if unknown:
+            raise endpoints.BadRequestException(
+                "Unknown fields: %s" % ', '.join(sorted(unknown)))
+
+    def _trimConferenceForm(self, cf, fields):
+        """Return a ConferenceForm with only fields (and websafeKey) set."""
+        trimmed = ConferenceForm(websafeKey=cf.websafeKey)
+        for name in fields:
+            setattr(trimmed, name, getattr(cf, name))
+        return trimmed
+
+    def _queryOptions(self, fields, projectable):
+        """Return the fetch options for a conference query selecting fields:
+        a projection when the listing indexes cover it, keys only when
+        fields are selected otherwise, and full entities when they aren't.
+        """
+        if not fields:
+            return {}
+        if projectable and set(fields) <= LISTING_FIELDS:
+            return {'projection': LISTING_PROJECTION}
+        return {'keys_only': True}
+
+    def _conferenceFormsFromResults(self, results, fields, names, plan=None):
+        """Turn the results of a conference query run with _queryOptions
+        into ConferenceForms; names maps organizerUserId to displayName.
+        The residual predicates of plan, if given, are applied as well."""
+        if results and isinstance(results[0], ndb.Key):
+            # keys only: complete the entities from the conference cache
+            wscks = [key.urlsafe() for key in results]
+            forms = self._conferenceCache.get_multi(wscks,
+                                                    self._loadConferenceForms)
+            forms = [forms[wsck] for wsck in wscks if wsck in forms]
+            if plan:
+                forms = plan.apply(forms)
+        else:
+            if plan:
+                results = plan.apply(results)
+            forms = [self._copyConferenceToForm(conf, names.get(conf.organizerUserId))
+                     for conf in results]
+        if fields:
+            forms = [self._trimConferenceForm(cf, fields) for cf in forms]
+        return forms
+
+    @instrumentation.method(CONF_CREATED_REQUEST, ConferenceForms,
                       path='getConferencesCreated',
                       http_method='POST', name='getConferencesCreated')
     def getConferencesCreated(self, request):
@@ -266,38 +449,31 @@ class ConferenceApi(remote.Service):
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
         user_id = getUserId(user)
+        self._checkFields(request.fields)
 
-        # create ancestor query for all key matches for this user
-        confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
+        # create ancestor query for all key matches for this user and
+        # look up the profile while it runs
+        p_key = ndb.Key(Profile, user_id)
+        q = Conference.query(ancestor=p_key)
+        options = self._queryOptions(request.fields, projectable=True)
+        if 'projection' in options:
+            q = q.order(Conference.name)
+        confs_future = q.fetch_async(**options)
+        prof = caching.profileCache.get(p_key)
+        confs = confs_future.get_result()
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in confs]
+            items=self._conferenceFormsFromResults(
+                confs, request.fields, {user_id: getattr(prof, 'displayName')})
         )
 
     def _getQuery(self, request):
-        """Return formatted query from the submitted filters."""
-        q = Conference.query()
-        inequality_filter, filters = self._formatFilters(request.filters)
-
-        # If exists, sort on inequality filter first
-        if not inequality_filter:
-            q = q.order(Conference.name)
-        else:
-            q = q.order(ndb.GenericProperty(inequality_filter))
-            q = q.order(Conference.name)
-
-        for filtr in filters:
-            if filtr["field"] in ["month", "maxAttendees"]:
-                filtr["value"] = int(filtr["value"])
-            formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"])
-            q = q.filter(formatted_query)
-        return q
+        """Return the QueryPlan for the submitted filters, see planner.py."""
+        return planner.plan(Conference, self._formatFilters(request.filters))
 
     def _formatFilters(self, filters):
         """Parse, check validity and format user supplied filters."""
         formatted_filters = []
-        inequality_field = None
 
         for f in filters:
             filtr = {field.name: getattr(f, field.name) for field in f.all_fields()}
@@ -308,67 +484,173 @@ class ConferenceApi(remote.Service):
             except KeyError:
                 raise endpoints.BadRequestException("Filter contains invalid field or operator.")
 
-            # Every operation except "=" is an inequality
-            if filtr["operator"] != "=":
-                # check if inequality operation has been used in previous
-                # filters disallow the filter if inequality was performed on a
-                # different field before track the field on which the inequality
-                # operation is performed
-                if inequality_field and inequality_field != filtr["field"]:
+            if filtr["field"] in ["month", "maxAttendees"]:
+                try:
+                    filtr["value"] = int(filtr["value"])
+                except (TypeError, ValueError):
                     raise endpoints.BadRequestException(
-                        "Inequality filter is allowed on only one field.")
-                else:
-                    inequality_field = filtr["field"]
+                        "Filter on %s needs an integer value." % filtr["field"])
 
+            # inequalities on more than one field and NE filters no longer
+            # need rejecting; the planner applies them in memory
             formatted_filters.append(filtr)
-        return (inequality_field, formatted_filters)
+        return formatted_filters
 
 
-    @endpoints.method(ConferenceQueryForms, ConferenceForms,
+    @instrumentation.method(ConferenceQueryForms, ConferenceForms,
                       path='queryConferences', http_method='POST',
                       name='queryConferences')
     def queryConferences(self, request):
-        """Query for conferences."""
-        conferences = self._getQuery(request)
+        """Query for conferences, one page at a time if pageSize is given.
+        If fields are given, only those ConferenceForm fields are returned.
+        Responses are cached for all users; a client that sends the etag
+        of its copy as ifNoneMatch gets notModified back if it's current.
+        seatsAvailable isn't covered by the etag: it is filled in live."""
+        etag = caching.listingETag(request)
+        if request.ifNoneMatch == etag:
+            return ConferenceForms(etag=etag, notModified=True)
+        forms = caching.getListing(etag)
+        if forms is None:
+            forms = self._queryConferences(request)
+            forms.etag = etag
+            # registrations don't invalidate listings, so their seat
+            # counts are never cached
+            for cf in forms.items:
+                cf.seatsAvailable = None
+            caching.setListing(etag, forms)
+        self._fillSeatsAvailable(forms, request.fields)
+        return forms
+
+    def _fillSeatsAvailable(self, forms, fields):
+        """Set the current seatsAvailable of the conferences in forms, a
+        ConferenceForms listing, from the conference cache."""
+        if fields and 'seatsAvailable' not in fields:
+            return
+        current = self._conferenceCache.get_multi(
+            [cf.websafeKey for cf in forms.items], self._loadConferenceForms)
+        for cf in forms.items:
+            if cf.websafeKey in current:
+                cf.seatsAvailable = current[cf.websafeKey].seatsAvailable
+
+    def _queryConferences(self, request):
+        """Run queryConferences against the datastore."""
+        self._checkFields(request.fields)
+        plan = self._getQuery(request)
+        query_plan = plan.describe() if request.debug else None
+        if plan.empty:
+            return ConferenceForms(queryPlan=query_plan)
+        q = plan.query()
+        options = self._queryOptions(request.fields,
+                                     projectable=not request.filters)
+
+        # run the query only once; page through it with a datastore cursor
+        # when the client asks for a page size
+        next_token = None
+        if request.pageSize:
+            if request.pageSize < 0 or request.pageSize > MAX_PAGE_SIZE:
+                raise endpoints.BadRequestException(
+                    "pageSize must be between 1 and %d" % MAX_PAGE_SIZE)
+            cursor = None
+            if request.pageToken:
+                try:
+                    cursor = Cursor(urlsafe=request.pageToken)
+                except BadValueError:
+                    raise endpoints.BadRequestException("Invalid pageToken.")
+            conferences, next_cursor, more = q.fetch_page(
+                request.pageSize, start_cursor=cursor, **options)
+            if more and next_cursor:
+                next_token = next_cursor.urlsafe()
+        else:
+            conferences = q.fetch(**options)
 
         # need to fetch organiser displayName from profiles
         # get all keys and use get_multi for speed
-        organisers = [(ndb.Key(Profile, conf.organizerUserId))
-                      for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
         names = {}
-        for profile in profiles:
-            if profile:
-                names[profile.key.id()] = profile.displayName
-
-        # return individual ConferenceForm object per Conference
+        if not options.get('keys_only'):
+            organisers = set(ndb.Key(Profile, conf.organizerUserId)
+                             for conf in conferences)
+            profiles = ndb.get_multi(list(organisers))
+
+            # put display names in a dict for easier fetching
+            for profile in profiles:
+                if profile:
+                    names[profile.key.id()] = profile.displayName
+
+        # return individual ConferenceForm object per Conference; with
+        # residual filters a page may hold fewer than pageSize items
         return ConferenceForms(
-                items=[self._copyConferenceToForm(conf, names[conf.organizerUserId])
-                       for conf in conferences]
+                items=self._conferenceFormsFromResults(conferences,
+                                                       request.fields, names,
+                                                       plan),
+                nextPageToken=next_token,
+                queryPlan=query_plan
         )
 
+    @instrumentation.method(ConferenceSearchForm, ConferenceForms,
+                      path='searchConferences', http_method='POST',
+                      name='searchConferences')
+    def searchConferences(self, request):
+        """Search conferences by the words of their name, topics and
+        description, best matches first, one page at a time; see
+        textsearch.py. New and updated conferences are found once their
+        indexing task has run."""
+        if not request.query:
+            raise endpoints.BadRequestException("Search 'query' field required")
+        page_size = request.pageSize or MAX_PAGE_SIZE
+        if page_size < 0 or page_size > MAX_PAGE_SIZE:
+            raise endpoints.BadRequestException(
+                "pageSize must be between 1 and %d" % MAX_PAGE_SIZE)
+        offset = 0
+        if request.pageToken:
+            try:
+                offset = int(request.pageToken)
+            except ValueError:
+                raise endpoints.BadRequestException("Invalid pageToken.")
+            if offset < 0:
+                raise endpoints.BadRequestException("Invalid pageToken.")
+
+        wscks = textsearch.search(request.query, request.mode)
+        page = wscks[offset:offset + page_size]
+        forms = self._conferenceCache.get_multi(page, self._loadConferenceForms)
+        next_token = None
+        if offset + page_size < len(wscks):
+            next_token = str(offset + page_size)
+        # conferences deleted since they were indexed are left out
+        return ConferenceForms(
+            items=[forms[wsck] for wsck in page if wsck in forms],
+            nextPageToken=next_token)
+
+    @instrumentation.method(message_types.VoidMessage, ConferenceFacetsForm,
+                      path='conferenceFacets', http_method='GET',
+                      name='getConferenceFacets')
+    def getConferenceFacets(self, request):
+        """Return the number of conferences per city, topic and month, most
+        common first; see facets.py. New and updated conferences are
+        counted once their task has run."""
+        counts = facets.getFacets()
+
+        def facetForms(facet):
+            values = sorted(counts.get(facet, {}).items(),
+                            key=lambda item: (-item[1], item[0]))
+            return [FacetCountForm(value=value, count=count)
+                    for value, count in values]
+        return ConferenceFacetsForm(cities=facetForms('city'),
+                                    topics=facetForms('topic'),
+                                    months=facetForms('month'))
+
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
     def _copyProfileToForm(self, prof):
         """Copy relevant fields from Profile to ProfileForm."""
-        # copy relevant fields from Profile to ProfileForm
-        pf = ProfileForm()
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(pf, field.name, getattr(TeeShirtSize,
-                                                    getattr(prof, field.name)))
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
-        pf.check_initialized()
-        return pf
-
-
-    def _getProfileFromUser(self):
+        # t-shirt string is converted to the Enum by the copy plan
+        return serializers.copy(prof, ProfileForm)
+
+
+    def _getProfileFromUser(self, cached=False, uow=None):
         """Return user Profile from datastore, creating new one if
-        non-existent."""
+        non-existent. With cached=True the Profile may come from the
+        profile cache; only for callers that don't write it back.
+        A new Profile, and changes to one loaded from the datastore, are
+        written by the next flush of uow (by default the request's)."""
         # make sure user is authed
         user = endpoints.get_current_user()
         if not user:
@@ -377,23 +659,28 @@ class ConferenceApi(remote.Service):
         # get Profile from datastore
         user_id = getUserId(user)
         p_key = ndb.Key(Profile, user_id)
-        profile = p_key.get()
+        if uow is None:
+            uow = self._unitOfWork
+        invalidate = lambda: self._invalidateProfile(p_key)
+        if cached:
+            profile = caching.profileCache.get(p_key)
+        else:
+            profile = uow.track(p_key.get(), on_write=invalidate)
         # create new Profile if not there
         if not profile:
-            profile = Profile(
+            profile = uow.add(Profile(
                 key = p_key,
                 displayName = user.nickname(),
                 mainEmail= user.email(),
                 teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
-            )
-            profile.put()
+            ), on_write=invalidate)
 
         return profile      # return Profile
 
     def _doProfile(self, save_request=None):
         """Get user Profile and return to user, possibly updating it first."""
-        # get user Profile
-        prof = self._getProfileFromUser()
+        # get user Profile; a save must start from the stored one
+        prof = self._getProfileFromUser(cached=not save_request)
 
         # if saveProfile(), process user-modifyable fields
         if save_request:
@@ -406,20 +693,23 @@ class ConferenceApi(remote.Service):
                         #    setattr(prof, field, str(val).upper())
                         #else:
                         #    setattr(prof, field, val)
-                        prof.put()
+
+        # a single write, and none if nothing changed; also writes a
+        # Profile created by this call
+        self._unitOfWork.flush()
 
         # return ProfileForm
         return self._copyProfileToForm(prof)
 
 
-    @endpoints.method(message_types.VoidMessage, ProfileForm,
+    @instrumentation.method(message_types.VoidMessage, ProfileForm,
                       path='profile', http_method='GET', name='getProfile')
     def getProfile(self, request):
         """Return user profile."""
         return self._doProfile()
 
 
-    @endpoints.method(ProfileMiniForm, ProfileForm,
+    @instrumentation.method(ProfileMiniForm, ProfileForm,
                       path='profile', http_method='POST', name='saveProfile')
     def saveProfile(self, request):
         """Update & return user profile."""
@@ -430,44 +720,24 @@ class ConferenceApi(remote.Service):
 
     @staticmethod
     def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
+        """Repair the nearly sold out set & assign the Announcement to
+        memcache; used by memcache cron job. The set itself is kept up to
+        date by _conferenceRegistration, see announcements.py.
         """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5, Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
-
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = ANNOUNCEMENT_TPL % (
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
-        else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+        return announcements.repairAnnouncement()
 
-        return announcement
-
-    @endpoints.method(message_types.VoidMessage, StringMessage,
+    @instrumentation.method(message_types.VoidMessage, StringMessage,
                       path='conference/announcement/get',
                       http_method='GET', name='getAnnouncement')
     def getAnnouncement(self, request):
         """Return Announcement from memcache."""
-        return StringMessage(data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or
-                                  "")
+        return StringMessage(data=announcements.getAnnouncement())
 
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
-    @ndb.transactional(xg=True)
     def _conferenceRegistration(self, request, reg=True):
         """Register or unregister user for selected conference."""
-        retval = None
-        prof = self._getProfileFromUser() # get user Profile
-
         # check if conf exists given websafeConfKey
         # get conference; check that it exists
         wsck = request.websafeConferenceKey
@@ -476,6 +746,42 @@ class ConferenceApi(remote.Service):
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
 
+        # seats are taken from the conference's seat shards, see seats.py
+        if not conf.seatShards:
+            conf = seats.initShards(conf.key)
+
+        # a shard may run dry between picking and registering; pick again
+        for attempt in range(SEAT_SHARD_ATTEMPTS):
+            shard_key = seats.pickShard(conf, reg)
+            if not shard_key:
+                raise ConflictException(
+                    "There are no seats available.")
+            retval = self._shardRegistration(wsck, shard_key, reg)
+            if retval is not None:
+                break
+        else:
+            raise ConflictException(
+                "There are no seats available.")
+
+        if retval:
+            delta = -1 if reg else 1
+            total = seats.seatsChanged(conf, delta)
+            announcements.seatsChanged(conf, total - delta, total)
+            # listings show live seat counts; the write-back to
+            # Conference.seatsAvailable, which listings filter on, bumps
+            # the listing generation, see seats.reconcile
+            self._invalidateConference(wsck, listings=False)
+        return BooleanMessage(data=retval)
+
+    @ndb.transactional(xg=True)
+    def _shardRegistration(self, wsck, shard_key, reg=True):
+        """Move one seat between the user's Profile and a SeatShard.
+        Returns None if the shard has no seat left."""
+        # the transaction may be retried; each attempt has its own uow
+        uow = unitofwork.UnitOfWork()
+        prof = self._getProfileFromUser(uow=uow) # get user Profile
+        shard = uow.track(shard_key.get())
+
         # register
         if reg:
             # check if user already registered otherwise add
@@ -484,70 +790,56 @@ class ConferenceApi(remote.Service):
                     "You have already registered for this conference")
 
             # check if seats avail
-            if conf.seatsAvailable <= 0:
-                raise ConflictException(
-                    "There are no seats available.")
+            if shard.seatsAvailable <= 0:
+                return None
 
             # register user, take away one seat
             prof.conferenceKeysToAttend.append(wsck)
-            conf.seatsAvailable -= 1
-            retval = True
+            shard.seatsAvailable -= 1
 
         # unregister
         else:
             # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
+            if wsck not in prof.conferenceKeysToAttend:
+                return False
 
-                # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
-                conf.seatsAvailable += 1
-                retval = True
-            else:
-                retval = False
+            # unregister user, add back one seat
+            prof.conferenceKeysToAttend.remove(wsck)
+            shard.seatsAvailable += 1
 
         # write things back to the datastore & return
-        prof.put()
-        conf.put()
-        return BooleanMessage(data=retval)
+        uow.flush()
+        return True
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @instrumentation.method(message_types.VoidMessage, ConferenceForms,
                       path='conferences/attending',
                       http_method='GET', name='getConferencesToAttend')
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
-        prof = self._getProfileFromUser() # get user Profile
-        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
-
-        # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        prof = self._getProfileFromUser(cached=True) # get user Profile
+        self._unitOfWork.flush()    # in case the Profile is new
+        wscks = prof.conferenceKeysToAttend
+        forms = self._conferenceCache.get_multi(wscks, self._loadConferenceForms)
 
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, names[conf.organizerUserId])\
-         for conf in conferences]
-        )
+        return ConferenceForms(items=[forms[wsck] for wsck in wscks
+                                      if wsck in forms])
 
-    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+    @instrumentation.method(CONF_GET_REQUEST, BooleanMessage,
                       path='conference/{websafeConferenceKey}',
                       http_method='POST', name='registerForConference')
     def registerForConference(self, request):
         """Register user for selected conference."""
         return self._conferenceRegistration(request)
 
-    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+    @instrumentation.method(CONF_GET_REQUEST, BooleanMessage,
                       path='conference/{websafeConferenceKey}',
                       http_method='DELETE', name='unregisterFromConference')
     def unregisterFromConference(self, request):
         """Unregister user for selected conference."""
         return self._conferenceRegistration(request, reg=False)
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @instrumentation.method(message_types.VoidMessage, ConferenceForms,
                       path='filterPlayground',
                       http_method='GET', name='filterPlayground')
     def filterPlayground(self, request):
@@ -587,8 +879,9 @@ class ConferenceApi(remote.Service):
         # Get the conference from websafeConferenceKey
         conf = ndb.Key(urlsafe=request.confwebsafekey).get()
 
-        # generate Profile Key based on user ID and Conference
-        # ID based on Profile key get Conference key from ID. See Lesson 4
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.confwebsafekey)
         conf_key = conf.key
 
         #Check for exissting session to avoid double entry
@@ -601,110 +894,181 @@ class ConferenceApi(remote.Service):
             sess_key = ndb.Key(Session, sess_id, parent=conf_key)
 
             # copy SessionForm/ProtoRPC Message into dict data
-            dict_data = {field.name: getattr(request, field.name) for field in request.all_fields()}
-            del dict_data['confwebsafekey']
+            try:
+                dict_data = serializers.sessionDataFromForm(request)
+            except ValueError:
+                raise endpoints.BadRequestException(
+                    "Session date must be YYYY-MM-DD and startTime HH:MM")
             dict_data['key'] = sess_key
 
-            # add default values for those missing
-            # (both data model & outbound Message)
-            for df in SESSION_DEFAULTS:
-                if dict_data[df] in (None, []):
-                    dict_data[df] = SESSION_DEFAULTS[df]
-                    setattr(request, df, SESSION_DEFAULTS[df])
-            print "Request date: "
-            # Fill date using current date UTC time zone
-            # if date is not exist, user can add it later
-            if request.date:
-                # convert d tes from strings to Date objects and combine with start time
-                # remove date and starttime from request SessionForm because Session
-                # has only a startDataTime property
-                dict_data['date'] = datetime.strptime(request.date, "%Y-%m-%d").date()
-
-            if request.startTime:
-                dict_data['startTime'] = datetime.strptime(request.startTime, "%H:%M").time()
-            # check for existing speaker before create a new one
+            # get the speaker, creating it if it doesn't exist yet
             if request.speakerName:
-                qspeaker = Speaker.query()
-                qspeaker = qspeaker.filter(Speaker.fullname == request.speakerName)
-                if not qspeaker.get():
-                    # Create speaker. Speaker entity does not have parent
-                    # because speakers can give talks in different conferences
-                    speaker_id = Speaker.allocate_ids(size=1)[0]
-                    speaker_key = ndb.Key(Speaker, speaker_id)
-                    speaker_data = {'fullname': request.speakerName, 
-                                    'profession': request.speakerProfession}    
-                    Speaker(**speaker_data).put()
-                    dict_data['speakerKey'] = speaker_key
-                else:
-                    dict_data['speakerKey'] = qspeaker.get().key
-            sp_name = dict_data['speakerName']
-            sp_profession = dict_data['speakerProfession']
-            del dict_data['speakerName']
-            del dict_data['speakerProfession']
-            del dict_data['sessionWebsafeKey']
+                speaker_keys = speakers.getSpeakerKeys(
+                    {request.speakerName: request.speakerProfession})
+                dict_data['speakerKey'] = speaker_keys[request.speakerName]
             # Save session data to datastore
-            Session(**dict_data).put()
+            self._unitOfWork.add(Session(**dict_data))
+            self._unitOfWork.flush()
+            agenda.scheduleRebuild(conf_key)
 
             # Task 4 check for featured speaker call task queue
-            # get the existing session and compare to dict_data['speaker']
-            taskqueue.add(url='/tasks/get_featured_speaker',
-                          params={'conf_urlsafekey': request.confwebsafekey,
-                                  'speaker_name': sp_name,
-                                  'speaker_prof': sp_profession})
+            # the task counts the new session towards its speaker
+            if dict_data.get('speakerKey'):
+                self._featuredSpeakerTask(conf_key, [sess_key]).add()
         return request
 
+    def _createSessionObjects(self, forms):
+        """Create the sessions described by a list of SessionForms, possibly
+        of several conferences, with a few batched datastore calls. Sessions
+        whose name is already taken in their conference are skipped.
+        Returns SessionForms of the created sessions."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        if len(forms) > MAX_BATCH_SESSIONS:
+            raise endpoints.BadRequestException(
+                'At most %d sessions can be created at once' % MAX_BATCH_SESSIONS)
+        for form in forms:
+            if not form.confwebsafekey or not form.name:
+                raise endpoints.BadRequestException(
+                    "Session 'confwebsafekey' and 'name' fields required")
+
+        # the conferences and the names of their sessions, all in parallel
+        conf_keys = []
+        for form in forms:
+            conf_key = ndb.Key(urlsafe=form.confwebsafekey)
+            if conf_key not in conf_keys:
+                conf_keys.append(conf_key)
+        futures = [Session.query(ancestor=conf_key).fetch_async()
+                   for conf_key in conf_keys]
+        for conf_key, conf in zip(conf_keys, ndb.get_multi(conf_keys)):
+            if not conf:
+                raise endpoints.NotFoundException(
+                    'No conference found with key: %s' % conf_key.urlsafe())
+        taken = dict((conf_key, set(sess.name for sess in future.get_result()))
+                     for conf_key, future in zip(conf_keys, futures))
+
+        # dedupe against existing sessions and within the batch
+        new = []
+        professions = {}
+        for form in forms:
+            conf_key = ndb.Key(urlsafe=form.confwebsafekey)
+            if form.name in taken[conf_key]:
+                continue
+            taken[conf_key].add(form.name)
+            try:
+                data = serializers.sessionDataFromForm(form)
+            except ValueError:
+                raise endpoints.BadRequestException(
+                    "Session %r: date must be YYYY-MM-DD and startTime HH:MM"
+                    % form.name)
+            new.append((conf_key, data))
+            if form.speakerName:
+                professions.setdefault(form.speakerName, form.speakerProfession)
+        speaker_keys = speakers.getSpeakerKeys(professions)
+
+        # one block of ids per conference, then a single put_multi
+        next_ids = {}
+        for conf_key in conf_keys:
+            count = sum(1 for key, data in new if key == conf_key)
+            if count:
+                next_ids[conf_key] = Session.allocate_ids(
+                    size=count, parent=conf_key)[0]
+        sessions = []
+        for conf_key, data in new:
+            data['key'] = ndb.Key(Session, next_ids[conf_key], parent=conf_key)
+            next_ids[conf_key] += 1
+            if data['speakerName']:
+                data['speakerKey'] = speaker_keys[data['speakerName']]
+            sessions.append(self._unitOfWork.add(Session(**data)))
+        self._unitOfWork.flush()
+
+        # one featured speaker recompute and agenda rebuild per conference
+        tasks = []
+        for conf_key in next_ids:
+            agenda.scheduleRebuild(conf_key)
+        for conf_key in conf_keys:
+            sess_keys = [sess.key for sess in sessions
+                         if sess.key.parent() == conf_key and sess.speakerKey]
+            if sess_keys:
+                tasks.append(self._featuredSpeakerTask(conf_key, sess_keys))
+        queue = taskqueue.Queue()
+        for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+            queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+
+        return self._copySessionsToForms(sessions)
+
+    def _featuredSpeakerTask(self, conf_key, sess_keys):
+        """Return the task that counts the new sessions sess_keys of a
+        conference towards their speakers, see _checkFeaturedSpeaker."""
+        return taskqueue.Task(url='/tasks/get_featured_speaker',
+                              params={'conf_urlsafekey': conf_key.urlsafe(),
+                                      'sess_urlsafekey': [sess_key.urlsafe()
+                                                          for sess_key in sess_keys]})
+
+
+    def _copySessionToForm(self, session, speaker=None):
+        """Copy relevant fields from Session to SessionForm.
+        The speaker entity is resolved by the caller, see _copySessionsToForms."""
+        return serializers.copySession(session, speaker)
+
+    @ndb.tasklet
+    def _copySessionsToFormsAsync(self, sessions):
+        """Copy a list of Sessions to SessionForms, fetching all their
+        speakers with a single get_multi."""
+        sessions = [sess for sess in sessions if sess]
+        speaker_keys = list(set(sess.speakerKey for sess in sessions
+                                if sess.speakerKey))
+        speakers = yield ndb.get_multi_async(speaker_keys)
+        speakers = dict(zip(speaker_keys, speakers))
+
+        raise ndb.Return(SessionForms(
+            items=[self._copySessionToForm(sess, speakers.get(sess.speakerKey))
+                   for sess in sessions]
+        ))
+
+    def _copySessionsToForms(self, sessions):
+        """Synchronous version of _copySessionsToFormsAsync."""
+        return self._copySessionsToFormsAsync(sessions).get_result()
+
+    @ndb.tasklet
+    def _getConferenceSessionsAsync(self, wsck, typeOfSession=None):
+        """Return SessionForms for the sessions of a conference, optionally
+        of one type. The conference lookup and the session query run
+        concurrently."""
+        conf_key = ndb.Key(urlsafe=wsck)
+        squery = Session.query(ancestor=conf_key)
+        if typeOfSession:
+            squery = squery.filter(Session.typeOfSession == typeOfSession)
+
+        conf, sessions = yield conf_key.get_async(), squery.fetch_async()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
 
-    def _copySessionToForm(self, session):
-        """Copy relevant fields from Session to SessionForm."""
-        sform = SessionForm()
-        print session
-        setattr(sform, 'sessionWebsafeKey', session.key.urlsafe() )
-        # get speaker properties
-        speaker = getattr(session, 'speakerKey').get()
-
-        if speaker:
-            setattr(sform, 'speakerName', str(speaker.fullname) )
-            setattr(sform, 'speakerProfession', str(speaker.profession) )
-        else:
-            setattr(sform, 'speakerName', "None" )
-            setattr(sform, 'speakerProfession', "None" )
-
-        for field in sform.all_fields():
-            if hasattr(session, field.name):
-                if field.name.endswith('date') or field.name.endswith('startTime'):
-                    setattr(sform, field.name, str(getattr(session, field.name)))
-                elif field.name.endswith('speakerKey'):
-                    # extract the name entity to string
-                    print "Speaker KEy found"
-                    fullname = session.speakerKey.get().fullname
-                    profession = session.speakerKey.get().profession
-                    setattr(sform, 'speakerName', "Test1234")
-                    setattr(sform, 'speakerProfession', str(getattr(session, profession)))
-                else:
-                    setattr(sform, field.name, getattr(session, field.name))
-
-        sform.check_initialized()
-        return sform
+        forms = yield self._copySessionsToFormsAsync(sessions)
+        raise ndb.Return(forms)
 
     def _copySpeakerToForm(self, speaker):
         """Copy relevant fields from Speaker to SpeakerForm."""
-        spform = SpeakerForm()
-        for field in spform.all_fields():
-            if hasattr(speaker, field.name):
-                setattr(spform, field.name, getattr(speaker, field.name))
-
-        spform.check_initialized()
-        return spform
+        return serializers.copy(speaker, SpeakerForm)
 
     # 1 endpoint
-    @endpoints.method(SessionForm, SessionForm, path="session", 
+    @instrumentation.method(SessionForm, SessionForm, path="session", 
                       http_method='POST', name='createSession'  )
     def createSession(self, request):
         """Create a new session."""
         return self._createSessionObject(request)
 
+    @instrumentation.method(SessionForms, SessionForms, path="sessions",
+                      http_method='POST', name='createSessions')
+    def createSessions(self, request):
+        """Create many sessions at once; returns the created sessions.
+        Sessions whose name already exists in their conference are skipped."""
+        return self._createSessionObjects(request.items)
+
     # 2. endpoint
-    @endpoints.method(SESSION_GET_REQUEST, SessionForms,
+    @instrumentation.method(SESSION_GET_REQUEST, SessionForms,
             path='session/getConferenceSessions',
             http_method='GET', name='getConferenceSessions')
     def getConferenceSessions(self, request):
@@ -714,16 +1078,11 @@ class ConferenceApi(remote.Service):
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
 
-        # create query and its filter
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        squery = Session.query(ancestor=conf.key)
-
-        return SessionForms(
-            items=[self._copySessionToForm(session) for session in squery]
-        )
+        return self._getConferenceSessionsAsync(
+            request.websafeConferenceKey).get_result()
 
     # 3. endpoint
-    @endpoints.method(SESSION_GET_REQUEST_BY_TYPE, SessionForms,
+    @instrumentation.method(SESSION_GET_REQUEST_BY_TYPE, SessionForms,
             path='session/{websafeConferenceKey}/types',
             http_method='GET', name='getConferenceSessionsByType')
     def getConferenceSessionsByType(self, request):
@@ -732,15 +1091,10 @@ class ConferenceApi(remote.Service):
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
 
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        squery = Session.query(ancestor=conf.key)
-
-        sessions = squery.filter(Session.typeOfSession == request.typeOfSession).fetch()
-        return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions]
-        )
+        return self._getConferenceSessionsAsync(
+            request.websafeConferenceKey, request.typeOfSession).get_result()
     # Exceed req add speaker as an entity
-    @endpoints.method(SESSION_GET_REQUEST_BY_SPEAKER, SessionForms,
+    @instrumentation.method(SESSION_GET_REQUEST_BY_SPEAKER, SessionForms,
             path='session/{speakerFullname}',
             http_method='GET', name='getSessionsBySpeaker')
     def getSessionsBySpeaker(self, request):
@@ -750,76 +1104,54 @@ class ConferenceApi(remote.Service):
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
 
-        squery = Session.query(ancestor=conf.key)
-        sessions = [sess for sess in squery if getattr(ses, 'speakerKey').get().fullname == request.speakerFullname ]
+        # speakers are keyed by their normalized name, so any spelling
+        # of the name finds the speaker's sessions
+        speaker_key = speakers.speakerKey(request.speakerFullname)
+        if not speaker_key:
+            return SessionForms(items=[])
+        squery = Session.query(Session.speakerKey == speaker_key)
 
-        return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions]
-        )
+        return self._copySessionsToForms(squery.fetch())
 
 # ------- Wish List ------------
 
     def _createWishListObject(self, request):
-        """Create or update WishList object, returning WishListForm/request.
-           A session can only be created by a user who has created a conference"""
+        """Create WishList object, returning WishListForm/request.
+           The entry is keyed by the session under the user's Profile, so
+           adding a session twice just writes the same entity again."""
         # preload necessary data items
         user = endpoints.get_current_user()
 
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
         user_id = getUserId(user)
-        # Get the conference from websafeConferenceKey
+        if not request.sessionKey:
+            raise endpoints.BadRequestException(
+                "WishList 'sessionKey' field required")
         p_key = ndb.Key(Profile, user_id)
         session = ndb.Key(urlsafe=request.sessionKey).get()
+        if not session or session.key.kind() != 'Session':
+            raise endpoints.NotFoundException(
+                'No session found with key: %s' % request.sessionKey)
 
-        wlquery = WishList.query(ancestor=p_key)
-        wlist = wlquery.filter(WishList.sessionKey == session.key).fetch()
-
-        is_wishlist_not_exist = True
-        if wlist is not None:
-            for wl in wlist:
-                if wl.sessionKey == session.key:
-                    is_wishlist_not_exist = False
-
-        if is_wishlist_not_exist:
-            # generate Profile Key based on user ID and Conference
-
-            wishlist_id = WishList.allocate_ids(size=1, parent=p_key)[0]
-            wishlist_key = ndb.Key(WishList, wishlist_id, parent=p_key)
-
-            # copy WishlistForm/ProtoRPC Message into dict data
-            dict_data = {field.name: getattr(request, field.name)
-                         for field in request.all_fields()}
-            # convert session key to key property
-            if dict_data['sessionKey']:
-                dict_data['sessionKey'] = ndb.Key(urlsafe=request.sessionKey)
-            else:
-                print ("Something is wrong with the session key")
-
-            dict_data['userID'] = user_id
-            # Save session data to datastore
-            WishList(**dict_data).put()
-
+        # Save wishlist entry to datastore
+        request.userID = user_id
+        self._unitOfWork.add(WishList(key=self._wishListKey(p_key, session.key),
+                                      sessionKey=session.key, userID=user_id))
+        self._unitOfWork.flush()
         return request
 
+    def _wishListKey(self, p_key, sess_key):
+        """Return the key of the WishList entry of sess_key for p_key."""
+        return ndb.Key(WishList, sess_key.urlsafe(), parent=p_key)
+
     def _copyWishListToForm(self, wishlist):
         """Copy relevant fields from Wishlist to WishlistForm."""
-        wlform = WishListForm()
-
-        for field in wlform.all_fields():
-            if hasattr(wishlist, field.name):
-                # convert Key to key string and just copy others
-                if field.name.endswith('sessionKey'):
-                    setattr(wlform, field.name, str(getattr(wishlist, field.name)))
-                else:
-                    print "[_copyWishListToForm] No sessionKey but: ",field.name
-                    setattr(wlform, field.name, getattr(wishlist, field.name))
-
-        wlform.check_initialized()
-        return wlform
+        # the sessionKey Key is converted to a string by the copy plan
+        return serializers.copy(wishlist, WishListForm)
 
     # addSessionToWishlist(SessionKey)
-    @endpoints.method(WishListForm, WishListForm,
+    @instrumentation.method(WishListForm, WishListForm,
             path='session/addwishlist',
             http_method='POST', name='addSessionToWishlist')
     def addSessionToWishlist(self, request):
@@ -827,30 +1159,68 @@ class ConferenceApi(remote.Service):
          in attending"""
         return self._createWishListObject(request)
 
-    @endpoints.method(message_types.VoidMessage, SessionForms,
+    @instrumentation.method(WISHLIST_POST_REQUEST, BooleanMessage,
+            path='session/removewishlist',
+            http_method='DELETE', name='removeSessionFromWishlist')
+    def removeSessionFromWishlist(self, request):
+        """Remove the session from the user's wishlist. Returns False if it
+        wasn't in the wishlist."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        if not request.sessionKey:
+            raise endpoints.BadRequestException(
+                "'sessionKey' field required")
+        sess_key = ndb.Key(urlsafe=request.sessionKey)
+        if sess_key.kind() != 'Session':
+            raise endpoints.NotFoundException(
+                'No session found with key: %s' % request.sessionKey)
+        p_key = ndb.Key(Profile, getUserId(user))
+        wl_keys = [self._wishListKey(p_key, sess_key)]
+        if not wl_keys[0].get():
+            # entries the rekey_wishlists migration hasn't moved yet
+            wl_keys = WishList.query(WishList.sessionKey == sess_key,
+                                     ancestor=p_key).fetch(keys_only=True)
+            if not wl_keys:
+                return BooleanMessage(data=False)
+        for wl_key in wl_keys:
+            self._unitOfWork.delete(wl_key)
+        self._unitOfWork.flush()
+        return BooleanMessage(data=True)
+
+    @instrumentation.method(WISHLIST_GET_REQUEST, SessionForms,
             path='session/wishlists',
             http_method='GET', name='getSessionsInWishlist')
     def getSessionsInWishlist(self, request):
-        """query for all the sessions in a conference that the user is
-         interested in"""
+        """query for all the sessions in the user's wishlist, optionally
+         only those of one conference"""
         user = endpoints.get_current_user()
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
         user_id = getUserId(user)
-        # Get the conference from websafeConferenceKey
         p_key = ndb.Key(Profile, user_id)
-        wlquery = WishList.query()
-        wishlists = wlquery.filter(WishList.userID == user_id).fetch()
-        sessions =[]
-        for wl in wishlists:
-            sessions.append(wl.sessionKey.get())
-
-        return SessionForms(
-            items=[self._copySessionToForm(sess) for sess in sessions]
-        )
+
+        # the session keys are the ids of the wishlist keys; the ancestor
+        # query is strongly consistent and reads no entities
+        wl_keys = WishList.query(ancestor=p_key).fetch(keys_only=True)
+        sess_keys = [ndb.Key(urlsafe=wl_key.id()) for wl_key in wl_keys
+                     if isinstance(wl_key.id(), basestring)]
+        # entries the rekey_wishlists migration hasn't moved yet
+        legacy = [wl_key for wl_key in wl_keys
+                  if not isinstance(wl_key.id(), basestring)]
+        for wl in ndb.get_multi(legacy):
+            if wl and wl.sessionKey not in sess_keys:
+                sess_keys.append(wl.sessionKey)
+        if request.websafeConferenceKey:
+            conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+            sess_keys = [sess_key for sess_key in sess_keys
+                         if sess_key.parent() == conf_key]
+        sessions = ndb.get_multi(sess_keys)
+
+        return self._copySessionsToForms(sessions)
 
     # ----- Task 3: Create 2 Queries -----
-    @endpoints.method(SESSION_GET_REQUEST_BY_SPEAKER_TYPE, SessionForms,
+    @instrumentation.method(SESSION_GET_REQUEST_BY_SPEAKER_TYPE, SessionForms,
             path='session/speakertype',
             http_method='GET', name='getSessionsBySpeakerAndType')
     def getSessionsBySpeakerAndType(self, request):
@@ -859,18 +1229,16 @@ class ConferenceApi(remote.Service):
         user = endpoints.get_current_user()
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
-        # get the key of the input speaker
-        spquery = Speaker.query(Speaker.fullname == request.speakerFullname)
-        speakerkey =  spquery.get().key
-
-        squery = Session.query()
-        squery2 = squery.filter(ndb.AND(Session.speakerKey == speakerkey,
-                                        Session.typeOfSession == request.typeOfSession))
-        return SessionForms(
-            items=[self._copySessionToForm(session) for session in squery2]
-        )
-
-    @endpoints.method(message_types.VoidMessage, SpeakerForms,
+        speaker_key = speakers.speakerKey(request.speakerFullname)
+        if not speaker_key:
+            return SessionForms(items=[])
+        # one query on the speakerKey/typeOfSession composite index
+        squery = Session.query(ndb.AND(
+            Session.speakerKey == speaker_key,
+            Session.typeOfSession == request.typeOfSession))
+        return self._copySessionsToForms(squery.fetch())
+
+    @instrumentation.method(message_types.VoidMessage, SpeakerForms,
             path='session/allspeakers',
             http_method='GET', name='getAllSpeakers')
     def getAllSpeakers(self, request):
@@ -881,65 +1249,217 @@ class ConferenceApi(remote.Service):
             items= [self._copySpeakerToForm(speaker) for speaker in speakers]
         )
 
-    @endpoints.method(message_types.VoidMessage, SessionForms,
+    @instrumentation.method(SESSION_PAGE_REQUEST, SessionForms,
                       path='session/not_workshop_not_after_seven_pm',
                 http_method='GET', name='getSessionNoWshopUptoSevenPM')
     def getSessionNoWshopUptoSevenPM(self, request):
-        """Get all session that not a workshop and not over seven p.m"""
+        """Get all session that not a workshop and not over seven p.m,
+        one page at a time; continue while there is a nextPageToken."""
         user = endpoints.get_current_user()
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
-        # get the date information
-
-        sevenpm = datetime.strptime("19:00:00", '%H:%M:%S')
-        sevenpm = sevenpm.time()
-        sessions = Session.query(Session.typeOfSession != "Workshop").fetch()
 
-        # search for each session, get the time information and compare the time
-        filtered_sessions = [session for session in sessions if session.startTime < sevenpm]
+        # the datastore selects sessions starting before seven p.m.;
+        # workshops are dropped in memory, see searchSessions
+        return self._searchSessions(SessionSearchForm(
+            excludeTypes=['Workshop'], startBefore='19:00',
+            pageSize=request.pageSize, pageToken=request.pageToken))
 
-        return SessionForms(
-            items=[self._copySessionToForm(session) for session in filtered_sessions]
-        )
+    def _sessionSearchPlan(self, request):
+        """Return the QueryPlan of a SessionSearchForm, see planner.py."""
+        def parse(value, fmt, what):
+            try:
+                return datetime.strptime(value, fmt)
+            except ValueError:
+                raise endpoints.BadRequestException(
+                    "%s must be formatted as %s" % (what, fmt))
+
+        filters = [{'field': 'typeBucket', 'operator': '!=',
+                    'value': normalizeSessionType(t)}
+                   for t in request.excludeTypes]
+        if request.startAfter or request.startBefore:
+            # sessions without a startTime are outside every time window
+            start = 0
+            if request.startAfter:
+                start = parse(request.startAfter, '%H:%M', 'startAfter')
+                start = start.hour * 60 + start.minute
+            filters.append({'field': 'startMinute', 'operator': '>=',
+                            'value': start})
+            if request.startBefore:
+                end = parse(request.startBefore, '%H:%M', 'startBefore')
+                filters.append({'field': 'startMinute', 'operator': '<',
+                                'value': end.hour * 60 + end.minute})
+        if request.dateFrom:
+            filters.append({'field': 'date', 'operator': '>=',
+                            'value': parse(request.dateFrom, '%Y-%m-%d',
+                                           'dateFrom').date()})
+        if request.dateTo:
+            filters.append({'field': 'date', 'operator': '<=',
+                            'value': parse(request.dateTo, '%Y-%m-%d',
+                                           'dateTo').date()})
+        return planner.plan(Session, filters, sort='startMinute',
+                            ancestor=bool(request.websafeConferenceKey))
+
+    @instrumentation.method(SessionSearchForm, SessionForms,
+            path='session/search',
+            http_method='POST', name='searchSessions')
+    def searchSessions(self, request):
+        """Search sessions by conference, start time window, date range and
+        excluded types, one page at a time. Sessions are ordered by start
+        time, or by date and then start time when a date range is given
+        without a time window. A page may hold fewer than pageSize
+        sessions; continue while there is a nextPageToken."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        return self._searchSessions(request)
+
+    def _searchSessions(self, request):
+        """Run searchSessions for request, a SessionSearchForm."""
+        page_size = request.pageSize or MAX_PAGE_SIZE
+        if page_size < 0 or page_size > MAX_PAGE_SIZE:
+            raise endpoints.BadRequestException(
+                "pageSize must be between 1 and %d" % MAX_PAGE_SIZE)
+        cursor = None
+        if request.pageToken:
+            try:
+                cursor = Cursor(urlsafe=request.pageToken)
+            except BadValueError:
+                raise endpoints.BadRequestException("Invalid pageToken.")
+
+        plan = self._sessionSearchPlan(request)
+        if plan.empty:
+            return SessionForms()
+        ancestor = None
+        if request.websafeConferenceKey:
+            ancestor = ndb.Key(urlsafe=request.websafeConferenceKey)
+
+        # stream the datastore results through the residual filters; stop
+        # at a full page or after MAX_SEARCH_SCAN sessions
+        it = plan.query(ancestor=ancestor).iter(
+            start_cursor=cursor, produce_cursors=True,
+            batch_size=min(2 * page_size, MAX_PAGE_SIZE))
+        sessions = []
+        scanned = 0
+        next_token = None
+        for sess in it:
+            scanned += 1
+            if plan.matches(sess):
+                sessions.append(sess)
+            if len(sessions) == page_size or scanned == MAX_SEARCH_SCAN:
+                if it.has_next():
+                    next_token = it.cursor_after().urlsafe()
+                break
+
+        forms = self._copySessionsToForms(sessions)
+        forms.nextPageToken = next_token
+        return forms
 
     # ----- Task 4 ------
     @staticmethod
-    def _checkFeaturedSpeaker(conf_urlsafekey, speaker_name, speaker_prof):
-        """Add Task push queue for checking feature speaker. 
-        When a new session is added to a conference, check the speaker. 
-        If there is more than one session by this speaker at this conference,
-        also add a new Memcache entry that features the speaker and
-        session names. """
-
-        if (not conf_urlsafekey):
+    def _checkFeaturedSpeaker(conf_urlsafekey, sess_urlsafekeys):
+        """Add Task push queue for checking feature speaker.
+        When new sessions are added to a conference, count them towards
+        their speakers' sessions at that conference. A speaker with more
+        than one session and at least as many as the current featured
+        speaker becomes the conference's featured speaker, stored in the
+        datastore and in a per-conference Memcache entry."""
+
+        if not conf_urlsafekey or not sess_urlsafekeys:
             raise endpoints.BadRequestException("Invalid uslsafekey")
-        conf = ndb.Key(urlsafe=conf_urlsafekey).get()
-        squery = Session.query(ancestor=conf.key)
+        conf_key = ndb.Key(urlsafe=conf_urlsafekey)
+        sessions = [sess for sess in ndb.get_multi(
+                        [ndb.Key(urlsafe=wssk) for wssk in sess_urlsafekeys])
+                    if sess and sess.speakerKey and
+                    sess.key.parent() == conf_key]
+        if not sessions:
+            return
+
+        featured = ConferenceApi._countSpeakerSessions(conf_key, sessions)
+        if featured:
+            memcache.set(MEMCACHE_FEATURED_SPEAKER + conf_urlsafekey,
+                         ConferenceApi._formatFeaturedSpeaker(featured),
+                         time=FEATURED_SPEAKER_CACHE_TIME)
 
-        # check if Speaker entity has already existed
-        q_speaker = Speaker.query(Speaker.fullname == speaker_name)
-        existed_speaker = q_speaker.get()
-        profession = speaker_prof
-        if existed_speaker:
-            if existed_speaker.fullname == speaker_name:
-                # Search all session from the speaker
-                squery = Session.query(Session.speakerKey == existed_speaker.key)
-                featSessions = squery.fetch() 
-                sessNames = [sess.name for sess in featSessions ]
-                # add a new memcache
-                fspeaker = FEATURED_SPEAKER_TPL %(speaker_name, sessNames )
-                memcache.set(MEMCACHE_FEATURED_SPEAKER, fspeaker)
-        else:
-            print "speaker does not exist yet"
+    @staticmethod
+    @ndb.transactional()
+    def _countSpeakerSessions(conf_key, sessions):
+        """Add sessions to their speakers' SpeakerSessions and update the
+        conference's FeaturedSpeaker. All are children of the conference,
+        so this is a single entity group transaction. Returns the
+        FeaturedSpeaker if it changed, None otherwise."""
+        counts_keys = []
+        for session in sessions:
+            counts_key = ndb.Key(SpeakerSessions, session.speakerKey.id(),
+                                 parent=conf_key)
+            if counts_key not in counts_keys:
+                counts_keys.append(counts_key)
+        featured_key = ndb.Key(FeaturedSpeaker, FEATURED_SPEAKER_ID,
+                               parent=conf_key)
+        uow = unitofwork.UnitOfWork()
+        entities = [uow.track(entity) for entity in
+                    ndb.get_multi(counts_keys + [featured_key])]
+        featured = entities.pop()
+        all_counts = dict(zip(counts_keys, entities))
+
+        changed = []
+        for session in sessions:
+            counts_key = ndb.Key(SpeakerSessions, session.speakerKey.id(),
+                                 parent=conf_key)
+            counts = all_counts[counts_key]
+            if not counts:
+                counts = all_counts[counts_key] = uow.add(SpeakerSessions(
+                    key=counts_key, speakerKey=session.speakerKey,
+                    speakerName=session.speakerName))
+            # task retries must not count a session twice
+            if session.key in counts.sessionKeys:
+                continue
+            counts.sessionKeys.append(session.key)
+            counts.sessionNames.append(session.name)
+            if counts not in changed:
+                changed.append(counts)
+
+        best = featured
+        for counts in changed:
+            num_sessions = len(counts.sessionKeys)
+            if num_sessions > 1 and (
+                    not best or best.speakerKey == counts.speakerKey or
+                    num_sessions >= len(best.sessionNames)):
+                best = FeaturedSpeaker(key=featured_key,
+                                       speakerKey=counts.speakerKey,
+                                       speakerName=counts.speakerName,
+                                       sessionNames=counts.sessionNames)
+        if best is not featured:
+            uow.add(best)
+
+        uow.flush()
+        return best if best is not featured else None
+
+    @staticmethod
+    def _formatFeaturedSpeaker(featured):
+        """Return the featured speaker announcement string."""
+        return FEATURED_SPEAKER_TPL % (featured.speakerName,
+                                       ', '.join(featured.sessionNames))
 
-    @endpoints.method(message_types.VoidMessage, StringMessage,
+    @instrumentation.method(CONF_GET_REQUEST, StringMessage,
             path='session/featured_speaker/get',
             http_method='GET', name='getFeaturedSpeaker')
     def getFeaturedSpeaker(self, request):
-        """Return featured speaker in a conference from memcache"""
-        fspeaker= memcache.get(MEMCACHE_FEATURED_SPEAKER)
-        if not fspeaker:
-            fspeaker = ""
+        """Return featured speaker of a conference from memcache"""
+        wsck = request.websafeConferenceKey
+        if not wsck:
+            raise endpoints.BadRequestException(
+                "'websafeConferenceKey' field required")
+        fspeaker = memcache.get(MEMCACHE_FEATURED_SPEAKER + wsck)
+        if fspeaker is None:
+            # single get of the precomputed entity, then cache it; add, so
+            # a copy read before a featured speaker task committed can't
+            # replace the one the task set
+            featured = ndb.Key(FeaturedSpeaker, FEATURED_SPEAKER_ID,
+                               parent=ndb.Key(urlsafe=wsck)).get()
+            fspeaker = self._formatFeaturedSpeaker(featured) if featured else ""
+            memcache.add(MEMCACHE_FEATURED_SPEAKER + wsck, fspeaker,
+                         time=FEATURED_SPEAKER_CACHE_TIME)
         return StringMessage(data=fspeaker)
 
 api = endpoints.api_server([ConferenceApi])# register API
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+"""facets.py
+
+Udacity conference server-side Python App Engine conference facet counts
+
+The number of conferences per city, topic and month is kept in
+NUM_FACET_SHARDS FacetCounts root entities; each update adds its deltas
+to a randomly chosen shard, and the counts are the sum of all shards.
+Reading them is one get_multi of the shards, or one memcache call, no
+matter how many conferences there are.
+
+The values a conference is counted under are remembered in its
+ConferenceFacets child, and changed in the same transaction as the shard,
+so a conference is counted exactly once even if its task runs twice.
+Conferences are counted by a task once they are created or updated.
+"""
+
+import collections
+import random
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import caching
+from models import ConferenceFacets, FacetCounts
+
+FACETS = ('city', 'topic', 'month')
+NUM_FACET_SHARDS = 10
+FACETS_ID = 'facets'
+UPDATE_URL = '/tasks/update_facets'
+MEMCACHE_FACETS_KEY = "CONFERENCE_FACETS"
+FACETS_CACHE_TIME = 10 * 60     # seconds
+
+
+def shardKeys():
+    """Return the keys of all FacetCounts shards."""
+    return [ndb.Key(FacetCounts, 'shard-%d' % i)
+            for i in range(NUM_FACET_SHARDS)]
+
+
+def facetsKey(conf_key):
+    """Return the key of the ConferenceFacets of conf_key."""
+    return ndb.Key(ConferenceFacets, FACETS_ID, parent=conf_key)
+
+
+def facetValues(conf):
+    """Return the {facet: [value, ...]} conf is counted under."""
+    values = {'city': [], 'topic': [], 'month': []}
+    if conf.city:
+        values['city'].append(conf.city)
+    values['topic'] = sorted(set(topic for topic in conf.topics if topic))
+    if conf.month:
+        values['month'].append(str(conf.month))
+    return values
+
+
+@ndb.transactional(xg=True)
+def _countGroup(conf_keys):
+    """Count the conferences conf_keys, all in one entity group, under
+    their current values, or uncount the deleted ones. The conferences
+    are read in the transaction, so a concurrent update either commits
+    first or makes it retry. Returns True if any count changed."""
+    entities = ndb.get_multi(list(conf_keys) +
+                             [facetsKey(key) for key in conf_keys])
+    confs, markers = entities[:len(conf_keys)], entities[len(conf_keys):]
+    deltas = collections.defaultdict(int)
+    puts = []
+    deletes = []
+    for key, conf, marker in zip(conf_keys, confs, markers):
+        old = marker.values if marker else {}
+        new = facetValues(conf) if conf else {}
+        if old == new:
+            continue
+        for facet in FACETS:
+            for value in old.get(facet, []):
+                deltas[(facet, value)] -= 1
+            for value in new.get(facet, []):
+                deltas[(facet, value)] += 1
+        if conf:
+            puts.append(ConferenceFacets(key=facetsKey(key), values=new))
+        elif marker:
+            deletes.append(marker.key)
+
+    deltas = dict((fv, delta) for fv, delta in deltas.items() if delta)
+    if deltas:
+        shard_key = random.choice(shardKeys())
+        shard = shard_key.get() or FacetCounts(key=shard_key, counts={})
+        for (facet, value), delta in deltas.items():
+            counts = shard.counts.setdefault(facet, {})
+            counts[value] = counts.get(value, 0) + delta
+            if not counts[value]:
+                del counts[value]
+        puts.append(shard)
+    ndb.put_multi(puts)
+    ndb.delete_multi(deletes)
+    return bool(deltas)
+
+
+def _invalidate():
+    """Drop the cached counts; a reader that summed the shards before the
+    change can't put its copy back for INVALIDATION_LOCK_TIME."""
+    memcache.delete(MEMCACHE_FACETS_KEY,
+                    seconds=caching.INVALIDATION_LOCK_TIME)
+
+
+def countConferences(confs):
+    """Bring the facet counts of confs up to date; one transaction per
+    entity group, so a bulk import chunk is counted at once."""
+    groups = collections.OrderedDict()
+    for conf in confs:
+        groups.setdefault(conf.key.root(), []).append(conf.key)
+    changed = False
+    for group in groups.values():
+        if _countGroup(group):
+            changed = True
+    if changed:
+        _invalidate()
+
+
+def countConference(conf_key):
+    """Count, or uncount if it no longer exists, the conference conf_key."""
+    if _countGroup([conf_key]):
+        _invalidate()
+
+
+def scheduleUpdate(conf_key):
+    """Enqueue the facet count update of conf_key; within a transaction
+    the task is only added if the transaction commits."""
+    taskqueue.add(url=UPDATE_URL,
+                  params={'websafeConferenceKey': conf_key.urlsafe()},
+                  transactional=ndb.in_transaction())
+
+
+def getFacets():
+    """Return the {facet: {value: count}} of all conferences."""
+    counts = memcache.get(MEMCACHE_FACETS_KEY)
+    if counts is None:
+        counts = dict((facet, collections.defaultdict(int))
+                      for facet in FACETS)
+        for shard in ndb.get_multi(shardKeys()):
+            if not shard:
+                continue
+            for facet, values in shard.counts.items():
+                for value, count in values.items():
+                    counts[facet][value] += count
+        counts = dict((facet, dict((value, count)
+                                   for value, count in values.items()
+                                   if count > 0))
+                      for facet, values in counts.items())
+        memcache.add(MEMCACHE_FACETS_KEY, counts, time=FACETS_CACHE_TIME)
+    return counts
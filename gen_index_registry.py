@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+"""gen_index_registry.py
+
+Regenerate index_registry.py from index.yaml. index.yaml isn't uploaded
+with the application, so the query planner (planner.py) reads the composite
+indexes from the generated module instead. Run after editing index.yaml:
+
+    python gen_index_registry.py
+"""
+
+import os
+import pprint
+
+import yaml
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+HEADER = '''#!/usr/bin/env python
+
+"""index_registry.py
+
+Composite indexes declared in index.yaml, as used by planner.py.
+GENERATED by gen_index_registry.py -- do not edit by hand.
+"""
+
+'''
+
+
+def main():
+    with open(os.path.join(HERE, 'index.yaml')) as f:
+        config = yaml.safe_load(f)
+
+    indexes = {}
+    for index in config.get('indexes') or []:
+        properties = tuple(
+            (prop['name'], prop.get('direction', 'asc'))
+            for prop in index.get('properties', []))
+        entry = (bool(index.get('ancestor', False)), properties)
+        kind_indexes = indexes.setdefault(index['kind'], [])
+        if entry not in kind_indexes:
+            kind_indexes.append(entry)
+
+    with open(os.path.join(HERE, 'index_registry.py'), 'w') as f:
+        f.write(HEADER)
+        f.write('# {kind: [(ancestor, ((property, direction), ...)), ...]}\n')
+        f.write('INDEXES = %s\n' % pprint.pformat(indexes, width=79))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+"""index_registry.py
+
+Composite indexes declared in index.yaml, as used by planner.py.
+GENERATED by gen_index_registry.py -- do not edit by hand.
+"""
+
+# {kind: [(ancestor, ((property, direction), ...)), ...]}
+INDEXES = {'Conference': [(False,
+                 (('name', 'asc'),
+                  ('city', 'asc'),
+                  ('maxAttendees', 'asc'),
+                  ('organizerUserId', 'asc'),
+                  ('seatsAvailable', 'asc'),
+                  ('startDate', 'asc'))),
+                (True,
+                 (('name', 'asc'),
+                  ('city', 'asc'),
+                  ('maxAttendees', 'asc'),
+                  ('organizerUserId', 'asc'),
+                  ('seatsAvailable', 'asc'),
+                  ('startDate', 'asc'))),
+                (False,
+                 (('city', 'asc'),
+                  ('maxAttendees', 'asc'),
+                  ('month', 'asc'),
+                  ('name', 'asc'))),
+                (False,
+                 (('city', 'asc'),
+                  ('maxAttendees', 'asc'),
+                  ('month', 'asc'),
+                  ('topics', 'asc'),
+                  ('name', 'asc'))),
+                (False,
+                 (('city', 'asc'), ('maxAttendees', 'asc'), ('name', 'asc'))),
+                (False, (('city', 'asc'), ('month', 'asc'), ('name', 'asc'))),
+                (False,
+                 (('city', 'asc'),
+                  ('month', 'asc'),
+                  ('topics', 'asc'),
+                  ('name', 'asc'))),
+                (False, (('city', 'asc'), ('name', 'asc'))),
+                (False, (('city', 'asc'), ('topics', 'asc'), ('name', 'asc'))),
+                (False,
+                 (('maxAttendees', 'asc'), ('month', 'asc'), ('name', 'asc'))),
+                (False,
+                 (('maxAttendees', 'asc'),
+                  ('month', 'asc'),
+                  ('topics', 'asc'),
+                  ('name', 'asc'))),
+                (False, (('maxAttendees', 'asc'), ('name', 'asc'))),
+                (False,
+                 (('maxAttendees', 'asc'),
+                  ('topics', 'asc'),
+                  ('name', 'asc'))),
+                (False, (('month', 'asc'), ('name', 'asc'))),
+                (False,
+                 (('month', 'asc'), ('topics', 'asc'), ('name', 'asc'))),
+                (False, (('topics', 'asc'), ('name', 'asc')))],
+ 'SearchPosting': [(False,
+                    (('term', 'asc'),
+                     ('weight', 'desc'),
+                     ('conference', 'asc')))],
+ 'Session': [(False, (('speakerKey', 'asc'), ('typeOfSession', 'asc'))),
+             (False, (('date', 'asc'), ('startMinute', 'asc'))),
+             (True, (('startMinute', 'asc'),)),
+             (True, (('date', 'asc'), ('startMinute', 'asc')))]}
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+"""instrumentation.py
+
+Udacity conference server-side Python App Engine endpoint instrumentation
+
+method() is endpoints.method() plus a record of every call: wall time,
+datastore gets, puts, deletes and queries, entities read, memcache calls
+and response size. The RPCs are counted by API proxy hooks into a per
+thread (per request) record. Each call adds its record to per-endpoint
+counters in memcache, including a latency histogram that percentiles are
+estimated from; a sample of the calls, and every slow one, is logged as a
+JSON line. getStats() returns the aggregates, see /_stats in main.py.
+"""
+
+import functools
+import json
+import logging
+import random
+import threading
+import time
+
+import endpoints
+from protorpc import protojson
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+MEMCACHE_STATS_PREFIX = "ENDPOINT_STATS:"
+STATS_PERIOD = 60 * 60              # seconds aggregated together
+# upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS = (5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000,
+                   60000)
+PERCENTILES = (50, 90, 99)
+LOG_SAMPLE_RATE = 0.01
+SLOW_CALL_MS = 1000
+COUNTERS = ('datastoreGets', 'datastorePuts', 'datastoreDeletes',
+            'datastoreQueries', 'entitiesRead', 'memcacheCalls',
+            'responseBytes')
+
+_local = threading.local()
+_endpoints = []     # names of the instrumented endpoints
+
+
+def _postCall(service, call, request, response):
+    """API proxy post-call hook; counts the RPC in the current record."""
+    record = getattr(_local, 'record', None)
+    if record is None:
+        return
+    if service == 'datastore_v3':
+        if call == 'Get':
+            record['datastoreGets'] += 1
+            record['entitiesRead'] += sum(1 for e in response.entity_list()
+                                          if e.has_entity())
+        elif call == 'Put':
+            record['datastorePuts'] += 1
+        elif call == 'Delete':
+            record['datastoreDeletes'] += 1
+        elif call == 'RunQuery':
+            record['datastoreQueries'] += 1
+            record['entitiesRead'] += response.result_size()
+        elif call == 'Next':
+            record['entitiesRead'] += response.result_size()
+    elif service == 'memcache':
+        record['memcacheCalls'] += 1
+
+
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+    'instrumentation', _postCall)
+
+
+def _bucket(ms):
+    """Return the index of the latency bucket of ms milliseconds."""
+    for i, bound in enumerate(LATENCY_BUCKETS):
+        if ms <= bound:
+            return i
+    return len(LATENCY_BUCKETS) - 1
+
+
+def _period():
+    """Return the number of the current stats period."""
+    return int(time.time() // STATS_PERIOD)
+
+
+def _record(name, record, ms, error):
+    """Add the record of one call to the memcache counters and log it if
+    it is sampled or slow."""
+    offsets = {'calls': 1, 'ms': int(ms), 'latency:%d' % _bucket(ms): 1}
+    if error:
+        offsets['errors'] = 1
+    for counter in COUNTERS:
+        if record[counter]:
+            offsets[counter] = record[counter]
+    memcache.offset_multi(
+        offsets, initial_value=0,
+        key_prefix='%s%d:%s:' % (MEMCACHE_STATS_PREFIX, _period(), name))
+
+    if ms >= SLOW_CALL_MS or random.random() < LOG_SAMPLE_RATE:
+        entry = dict(record, endpoint=name, ms=int(ms), error=error)
+        logging.info('endpoint_call %s', json.dumps(entry, sort_keys=True))
+
+
+def method(*args, **kwargs):
+    """endpoints.method() that also instruments the decorated method."""
+    def decorator(func):
+        name = kwargs.get('name', func.__name__)
+        _endpoints.append(name)
+
+        @functools.wraps(func)
+        def wrapper(self, request):
+            outer = getattr(_local, 'record', None)
+            record = dict((counter, 0) for counter in COUNTERS)
+            _local.record = record
+            start = time.time()
+            error = None
+            try:
+                response = func(self, request)
+                record['responseBytes'] = len(
+                    protojson.encode_message(response))
+                return response
+            except Exception as e:
+                error = type(e).__name__
+                raise
+            finally:
+                _local.record = None
+                _record(name, record, (time.time() - start) * 1000, error)
+                _local.record = outer
+        return endpoints.method(*args, **kwargs)(wrapper)
+    return decorator
+
+
+def _percentile(histogram, calls, p):
+    """Return the upper bound of the latency bucket holding percentile p."""
+    seen = 0
+    for i, bound in enumerate(LATENCY_BUCKETS):
+        seen += histogram.get(i, 0)
+        if seen * 100 >= p * calls:
+            return bound
+    return LATENCY_BUCKETS[-1]
+
+
+def getStats(period=None):
+    """Return {endpoint: stats} for the calls of one stats period, the
+    current one by default. Percentiles are bucket upper bounds."""
+    period = _period() if period is None else period
+    fields = ['calls', 'errors', 'ms'] + list(COUNTERS) + \
+        ['latency:%d' % i for i in range(len(LATENCY_BUCKETS))]
+    names = sorted(set(_endpoints))
+    values = memcache.get_multi(
+        ['%s:%s' % (name, field) for name in names for field in fields],
+        key_prefix='%s%d:' % (MEMCACHE_STATS_PREFIX, period))
+
+    stats = {}
+    for name in names:
+        get = lambda field: values.get('%s:%s' % (name, field), 0)
+        calls = get('calls')
+        if not calls:
+            continue
+        histogram = dict((i, get('latency:%d' % i))
+                         for i in range(len(LATENCY_BUCKETS)))
+        endpoint = {'calls': calls, 'errors': get('errors'),
+                    'meanMs': get('ms') / float(calls)}
+        for p in PERCENTILES:
+            endpoint['p%dMs' % p] = _percentile(histogram, calls, p)
+        for counter in COUNTERS:
+            endpoint['mean' + counter[0].upper() + counter[1:]] = \
+                get(counter) / float(calls)
+        stats[name] = endpoint
+    return stats
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+"""loadtest_seats.py
+
+Load test of the sharded seat counter (seats.py) against the local
+datastore stub. Concurrent registrants take seats of one conference,
+first from the single Conference entity as before seats.py, then through
+ConferenceApi._conferenceRegistration, the code registerForConference
+runs; for each the throughput, the transactions begun per registration
+and the refused and failed registrations are printed. Every run also
+checks that no seat is sold twice, including after maxAttendees is cut
+with seats.adjustSeats. Run with the App Engine SDK on the Python path:
+
+    python loadtest_seats.py [--registrants 500] [--threads 25]
+
+The stub has no per entity group write limit, so contention shows up as
+retried and failed transactions rather than as the ~1 write per second
+of production. Each registrant is a user of its own: endpoints reads the
+current user from os.environ, which threads share, so the load test
+answers endpoints.get_current_user from a thread local instead.
+"""
+
+import argparse
+import os
+import threading
+import time
+
+import endpoints
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore_errors
+from google.appengine.api import users
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from conference import CONF_GET_REQUEST, ConferenceApi
+from models import ConflictException, Conference, Profile
+import seats
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+_current = threading.local()
+
+
+def _currentUser():
+    return getattr(_current, 'user', None)
+
+
+class Counter(object):
+    """Thread safe counters of one run; attempts counts the datastore
+    transactions begun."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.attempts = 0
+        self.registered = 0
+        self.refused = 0
+        self.failed = 0
+
+    def add(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+
+def _newConference(seats_available):
+    conf = Conference(name='Load test', maxAttendees=seats_available,
+                      seatsAvailable=seats_available)
+    conf.put()
+    return conf
+
+
+def _registerUnsharded(conf_key):
+    """Take a seat from Conference.seatsAvailable, as before seats.py."""
+    @ndb.transactional()
+    def take():
+        conf = conf_key.get()
+        if conf.seatsAvailable <= 0:
+            return False
+        conf.seatsAvailable -= 1
+        conf.put()
+        return True
+    return take()
+
+
+def _register(conf_key):
+    """Register the current user through the registerForConference code."""
+    request = CONF_GET_REQUEST.combined_message_class(
+        websafeConferenceKey=conf_key.urlsafe())
+    return ConferenceApi()._conferenceRegistration(request).data
+
+
+def _run(register, registrants, threads):
+    """Run registrants registrations, each by a new user, on threads
+    threads. Returns the Counter and the elapsed seconds."""
+    counter = Counter()
+    todo = [registrants]
+    lock = threading.Lock()
+
+    def countTransactions(service, call, request, response):
+        if call == 'BeginTransaction':
+            counter.add('attempts')
+
+    def worker():
+        while True:
+            with lock:
+                if not todo[0]:
+                    return
+                todo[0] -= 1
+                n = todo[0]
+            _current.user = users.User('registrant%d-%d@example.com' % (
+                id(counter), n))
+            try:
+                if register():
+                    counter.add('registered')
+                else:
+                    counter.add('refused')
+            except ConflictException:
+                # sold out, or every shard picked ran dry
+                counter.add('refused')
+            except datastore_errors.TransactionFailedError:
+                counter.add('failed')
+
+    hooks = apiproxy_stub_map.apiproxy.GetPreCallHooks()
+    hooks.Append('loadtest-%d' % id(counter), countTransactions,
+                 'datastore_v3')
+
+    workers = [threading.Thread(target=worker) for i in range(threads)]
+    start = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.time() - start
+    hooks.Clear()
+    return counter, elapsed
+
+
+def _report(name, counter, elapsed, registrants):
+    print('%-10s %6.1f registrations/s  %5.2f transactions/registration  '
+          '%d registered  %d refused  %d failed' % (
+              name, registrants / elapsed,
+              counter.attempts / float(max(counter.registered, 1)),
+              counter.registered, counter.refused, counter.failed))
+
+
+def _shardSeats(conf):
+    return [shard.seatsAvailable
+            for shard in ndb.get_multi(seats.shardKeys(conf))]
+
+
+def _attendees(conf_key):
+    """Return the number of profiles registered for the conference."""
+    return Profile.query(
+        Profile.conferenceKeysToAttend == conf_key.urlsafe()).count()
+
+
+def loadTest(registrants, threads):
+    seats_available = registrants * 2
+
+    conf = _newConference(seats_available)
+    counter, elapsed = _run(lambda: _registerUnsharded(conf.key),
+                            registrants, threads)
+    _report('unsharded', counter, elapsed, registrants)
+    assert conf.key.get().seatsAvailable == \
+        seats_available - counter.registered
+
+    # the first registration splits the seats into shards
+    conf_key = _newConference(seats_available).key
+    counter, elapsed = _run(lambda: _register(conf_key), registrants, threads)
+    _report('sharded', counter, elapsed, registrants)
+    assert sum(_shardSeats(conf_key.get())) == \
+        seats_available - counter.registered
+    assert _attendees(conf_key) == counter.registered
+
+
+def cutTest(threads):
+    """Cut 100 seats on 10 shards by 50: at most 50 registrations may
+    succeed, and a cut below the seats taken must be refused."""
+    conf = seats.initShards(_newConference(100).key, num_shards=10)
+
+    @ndb.transactional(xg=True)
+    def cut(delta):
+        return seats.adjustSeats(conf, delta)
+
+    assert cut(-50)
+    assert min(_shardSeats(conf)) >= 0
+    counter, elapsed = _run(lambda: _register(conf.key), 90, threads)
+    # registrations that failed on contention leave their seat behind
+    left = sum(_shardSeats(conf))
+    assert counter.registered + left == 50, (counter.registered, left)
+    assert _attendees(conf.key) == counter.registered
+    assert min(_shardSeats(conf)) >= 0
+    assert not cut(-left - 1)
+    print('cut        50 of 100 seats: %d of 90 registrations accepted, '
+          '%d refused, %d failed' % (counter.registered, counter.refused,
+                                     counter.failed))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load test of the sharded seat counter.')
+    parser.add_argument('--registrants', type=int, default=500)
+    parser.add_argument('--threads', type=int, default=25)
+    args = parser.parse_args()
+
+    tb = testbed.Testbed()
+    tb.activate()
+    tb.init_datastore_v3_stub()
+    tb.init_memcache_stub()
+    tb.init_taskqueue_stub(root_path=HERE)
+    get_current_user = endpoints.get_current_user
+    endpoints.get_current_user = _currentUser
+    try:
+        loadTest(args.registrants, args.threads)
+        cutTest(args.threads)
+    finally:
+        endpoints.get_current_user = get_current_user
+        tb.deactivate()
+
+
+if __name__ == '__main__':
+    main()
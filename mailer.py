@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+"""mailer.py
+
+Udacity conference server-side Python App Engine confirmation mails
+
+Creating conferences only adds a small task to the confirmation-mail pull
+queue: the organizer's email and the websafe keys of the new conferences.
+A cron job leases the tasks in batches, merges them into one digest mail
+per organizer, renders it from the current conference data and sends at
+most MAX_MAILS_PER_RUN mails per run; the rest wait for the next run.
+"""
+
+import collections
+import json
+
+from google.appengine.api import app_identity
+from google.appengine.api import mail
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+MAIL_QUEUE = 'confirmation-mail'
+LEASE_SECONDS = 60
+LEASE_BATCH = 100           # tasks leased at once
+MAX_MAILS_PER_RUN = 50      # the cron runs every minute
+
+
+def confirmationTask(email, conf_keys):
+    """Return the pull task asking for a confirmation of the conferences
+    conf_keys to email."""
+    payload = json.dumps({'email': email,
+                          'conferences': [key.urlsafe() for key in conf_keys]})
+    return taskqueue.Task(payload=payload, method='PULL')
+
+
+def enqueueConfirmation(email, conf_keys, transactional=False):
+    """Queue the confirmation of the conferences conf_keys to email."""
+    taskqueue.Queue(MAIL_QUEUE).add(confirmationTask(email, conf_keys),
+                                    transactional=transactional)
+
+
+def _renderConference(conf):
+    """Return the lines describing conf in a confirmation mail."""
+    dates = ''
+    if conf.startDate:
+        dates = ', %s' % conf.startDate
+        if conf.endDate and conf.endDate != conf.startDate:
+            dates += ' - %s' % conf.endDate
+    return u'%s (%s%s)' % (conf.name, conf.city or '', dates)
+
+
+def _sendDigest(email, confs):
+    """Send one mail confirming all of confs to email."""
+    if len(confs) == 1:
+        subject = 'You created a new Conference!'
+        intro = 'Hi, you have created a following conference:'
+    else:
+        subject = 'You created %d new Conferences!' % len(confs)
+        intro = 'Hi, you have created the following conferences:'
+    body = u'%s\r\n\r\n%s' % (
+        intro, u'\r\n'.join(_renderConference(conf) for conf in confs))
+    mail.send_mail(
+        'noreply@%s.appspotmail.com' % (
+            app_identity.get_application_id()),     # from
+        email,                                      # to
+        subject,                                    # subj
+        body.encode('utf-8'))                       # body
+
+
+def sendConfirmations():
+    """Send the queued confirmations as digests, one mail per organizer
+    and batch. Returns the number of mails sent."""
+    queue = taskqueue.Queue(MAIL_QUEUE)
+    sent = 0
+    while sent < MAX_MAILS_PER_RUN:
+        tasks = queue.lease_tasks(LEASE_SECONDS, LEASE_BATCH)
+        if not tasks:
+            break
+
+        groups = collections.OrderedDict()  # email: ([task], [conf key])
+        for task in tasks:
+            payload = json.loads(task.payload)
+            group = groups.setdefault(payload['email'], ([], []))
+            group[0].append(task)
+            group[1].extend(ndb.Key(urlsafe=wsck)
+                            for wsck in payload['conferences'])
+
+        keys = list(set(key for group in groups.values() for key in group[1]))
+        confs = dict(zip(keys, ndb.get_multi(keys)))
+
+        for email, (group_tasks, conf_keys) in groups.items():
+            if sent >= MAX_MAILS_PER_RUN:
+                # give the rest back for the next run
+                for task in group_tasks:
+                    queue.modify_task_lease(task, 0)
+                continue
+            # conferences deleted since need no confirmation
+            group_confs = [confs[key] for key in
+                           collections.OrderedDict.fromkeys(conf_keys)
+                           if confs[key]]
+            if group_confs:
+                _sendDigest(email, group_confs)
+                sent += 1
+            queue.delete_tasks(group_tasks)
+    return sent
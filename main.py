@@ -13,11 +13,25 @@ Author: Yongkie Wiyogo
 date: 2015-10-10
 """
 
+import json
+import logging
+
 import webapp2
 from google.appengine.api import app_identity
 from google.appengine.api import mail
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
 from google.appengine.ext import webapp
 from conference import ConferenceApi
+import agenda
+import bulkimport
+import caching
+import facets
+import instrumentation
+import mailer
+import migrations
+import seats
+import textsearch
 
 __author__ = 'Yongkie Wiyogo'
 
@@ -31,7 +45,8 @@ class SetAnnouncementHandler(webapp2.RequestHandler):
 
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
     def post(self):
-        """Send email confirming Conference creation."""
+        """Send email confirming Conference creation.
+        Only for tasks queued before mailer.py took over."""
         mail.send_mail(
             'noreply@%s.appspotmail.com' % (
                 app_identity.get_application_id()),     # from
@@ -43,19 +58,177 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
         )
 
 
+class SendConfirmationMailsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Send queued conference confirmations as digests"""
+        mailer.sendConfirmations()
+        self.response.set_status(204)
+
+
 class GetFeaturedSpeaker(webapp2.RequestHandler):
     def post(self):
         """Safe feature speaker"""
         # the request properties are defined in _checkFeaturedSpeaker
         conference_key = self.request.get('conf_urlsafekey')
-        sp_name = self.request.get('speaker_name')
-        sp_prof = self.request.get('speaker_prof')
-        ConferenceApi._checkFeaturedSpeaker(conference_key, sp_name, sp_prof)
+        session_keys = self.request.get_all('sess_urlsafekey')
+        if not session_keys and self.request.get('speaker_name'):
+            # queued before tasks named their sessions: without them the
+            # task can't be processed, and retrying would only fail again
+            logging.warning('Dropping legacy featured speaker task for %s',
+                            conference_key)
+            self.response.set_status(200)
+            return
+        ConferenceApi._checkFeaturedSpeaker(conference_key, session_keys)
+        self.response.set_status(204)
+
+
+class ReconcileSeatsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Write the seat shard total back to the conference"""
+        wsck = self.request.get('websafeConferenceKey')
+        seats.reconcile(ndb.Key(urlsafe=wsck))
+        # the agenda shows the seats once the seat cache has expired
+        agenda.scheduleRebuild(ndb.Key(urlsafe=wsck))
+        self.response.set_status(204)
+
+
+class RebuildAgendaHandler(webapp2.RequestHandler):
+    def post(self):
+        """Rebuild the agenda of a conference"""
+        wsck = self.request.get('websafeConferenceKey')
+        agenda.rebuild(ndb.Key(urlsafe=wsck))
+        self.response.set_status(204)
+
+
+class IndexConferenceHandler(webapp2.RequestHandler):
+    def post(self):
+        """Update the search postings of a conference"""
+        wsck = self.request.get('websafeConferenceKey')
+        textsearch.indexConference(ndb.Key(urlsafe=wsck))
+        self.response.set_status(204)
+
+
+class UpdateFacetsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Update the facet counts of a conference"""
+        wsck = self.request.get('websafeConferenceKey')
+        facets.countConference(ndb.Key(urlsafe=wsck))
+        self.response.set_status(204)
+
+
+class BumpListingGenerationHandler(webapp2.RequestHandler):
+    def post(self):
+        """Drop conference listings built before recent writes settled"""
+        caching.bumpListingGeneration(delayed=True)
+        self.response.set_status(204)
+
+
+class ImportConferencesChunkHandler(webapp2.RequestHandler):
+    def post(self):
+        """Create the conferences of one bulk import chunk"""
+        chunk_key = ndb.Key(urlsafe=self.request.get('websafeChunkKey'))
+        bulkimport.processChunk(chunk_key)
+        self.response.set_status(204)
+
+
+class BackfillSessionSpeakersHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start the Session speaker backfill"""
+        taskqueue.add(url=migrations.BACKFILL_SESSION_SPEAKERS_URL)
+        self.response.set_status(202)
+
+    def post(self):
+        """Backfill one batch of sessions"""
+        migrations.backfillSessionSpeakers(self.request.get('cursor') or None)
+        self.response.set_status(204)
+
+
+class DedupeSpeakersHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start the Speaker key migration"""
+        taskqueue.add(url=migrations.DEDUPE_SPEAKERS_URL)
+        self.response.set_status(202)
+
+    def post(self):
+        """Migrate one batch of speakers"""
+        migrations.dedupeSpeakers(self.request.get('cursor') or None)
+        self.response.set_status(204)
+
+
+class RekeyWishListsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start the WishList key migration"""
+        taskqueue.add(url=migrations.REKEY_WISHLISTS_URL)
+        self.response.set_status(202)
+
+    def post(self):
+        """Migrate one batch of wishlist entries"""
+        migrations.rekeyWishLists(self.request.get('cursor') or None)
+        self.response.set_status(204)
+
+
+class BackfillSessionSearchHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start the session search fields backfill"""
+        taskqueue.add(url=migrations.BACKFILL_SESSION_SEARCH_URL)
+        self.response.set_status(202)
+
+    def post(self):
+        """Backfill one batch of sessions"""
+        migrations.backfillSessionSearch(self.request.get('cursor') or None)
         self.response.set_status(204)
 
 
+class IndexConferencesHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start indexing every conference for search"""
+        taskqueue.add(url=migrations.INDEX_CONFERENCES_URL)
+        self.response.set_status(202)
+
+    def post(self):
+        """Index one batch of conferences"""
+        migrations.indexConferences(self.request.get('cursor') or None)
+        self.response.set_status(204)
+
+
+class CountConferenceFacetsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start counting every conference in the facet counts"""
+        taskqueue.add(url=migrations.COUNT_CONFERENCE_FACETS_URL)
+        self.response.set_status(202)
+
+    def post(self):
+        """Count one batch of conferences"""
+        migrations.countConferenceFacets(self.request.get('cursor') or None)
+        self.response.set_status(204)
+
+
+class StatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Show the per-endpoint statistics of the current hour and the
+        profile cache counters of this instance"""
+        stats = {'endpoints': instrumentation.getStats(),
+                 'profileCache': caching.profileCache.stats()}
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(stats, indent=2, sort_keys=True))
+
+
 app = webapp2.WSGIApplication([
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/_stats', StatsHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
+    ('/crons/send_confirmation_mails', SendConfirmationMailsHandler),
     ('/tasks/get_featured_speaker', GetFeaturedSpeaker),
+    ('/tasks/reconcile_seats', ReconcileSeatsHandler),
+    (agenda.REBUILD_URL, RebuildAgendaHandler),
+    (caching.BUMP_LISTING_GENERATION_URL, BumpListingGenerationHandler),
+    (textsearch.INDEX_URL, IndexConferenceHandler),
+    (facets.UPDATE_URL, UpdateFacetsHandler),
+    ('/tasks/backfill_session_speakers', BackfillSessionSpeakersHandler),
+    ('/tasks/dedupe_speakers', DedupeSpeakersHandler),
+    ('/tasks/rekey_wishlists', RekeyWishListsHandler),
+    ('/tasks/backfill_session_search', BackfillSessionSearchHandler),
+    ('/tasks/index_conferences', IndexConferencesHandler),
+    ('/tasks/count_conference_facets', CountConferenceFacetsHandler),
+    (bulkimport.PROCESS_CHUNK_URL, ImportConferencesChunkHandler),
 ], debug=True)
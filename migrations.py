@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+"""migrations.py
+
+Udacity conference server-side Python App Engine one-off data migrations
+
+Each migration processes one batch of entities per task and re-enqueues
+itself with the query cursor until the whole kind has been visited.
+"""
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from conference import FEATURED_SPEAKER_ID
+from models import Conference
+from models import FeaturedSpeaker, Session, Speaker, SpeakerSessions
+from models import WishList
+import facets
+from speakers import getSpeakerKeys, speakerKey
+import textsearch
+
+BATCH_SIZE = 100
+BACKFILL_SESSION_SPEAKERS_URL = '/tasks/backfill_session_speakers'
+DEDUPE_SPEAKERS_URL = '/tasks/dedupe_speakers'
+REKEY_WISHLISTS_URL = '/tasks/rekey_wishlists'
+BACKFILL_SESSION_SEARCH_URL = '/tasks/backfill_session_search'
+INDEX_CONFERENCES_URL = '/tasks/index_conferences'
+COUNT_CONFERENCE_FACETS_URL = '/tasks/count_conference_facets'
+
+
+def _fetchBatch(query, cursor, next_url):
+    """Fetch one batch of query starting at the websafe cursor and enqueue
+    the task for the next batch, if any. Returns the fetched entities."""
+    start = Cursor(urlsafe=cursor) if cursor else None
+    entities, next_cursor, more = query.fetch_page(BATCH_SIZE,
+                                                   start_cursor=start)
+    if more and next_cursor:
+        taskqueue.add(url=next_url, params={'cursor': next_cursor.urlsafe()})
+    return entities
+
+
+def backfillSessionSpeakers(cursor=None):
+    """Link the sessions of one batch that only name their speaker to the
+    Speaker, which speaker queries filter on, and copy Speaker.fullname
+    into Session.speakerName. Returns the number of sessions updated."""
+    sessions = _fetchBatch(Session.query().order(Session.key), cursor,
+                           BACKFILL_SESSION_SPEAKERS_URL)
+
+    unlinked = [sess for sess in sessions
+                if not sess.speakerKey and sess.speakerName and
+                speakerKey(sess.speakerName)]
+    if unlinked:
+        linked = getSpeakerKeys(dict((sess.speakerName, None)
+                                     for sess in unlinked))
+        for sess in unlinked:
+            sess.speakerKey = linked[sess.speakerName]
+
+    speaker_keys = list(set(sess.speakerKey for sess in sessions
+                            if sess.speakerKey))
+    speakers = dict(zip(speaker_keys, ndb.get_multi(speaker_keys)))
+
+    changed = list(unlinked)
+    for sess in sessions:
+        speaker = speakers.get(sess.speakerKey)
+        if speaker and sess.speakerName != speaker.fullname:
+            sess.speakerName = speaker.fullname
+            if sess not in changed:
+                changed.append(sess)
+    ndb.put_multi(changed)
+    return len(changed)
+
+
+@ndb.transactional()
+def _mergeSpeakerSessions(conf_key, remap):
+    """Move the SpeakerSessions of the old speaker keys in remap, an
+    {old key: new key} dict, to the new keys and repoint the conference's
+    FeaturedSpeaker."""
+    old_keys = [ndb.Key(SpeakerSessions, old.id(), parent=conf_key)
+                for old in remap]
+    new_keys = dict((new, ndb.Key(SpeakerSessions, new.id(), parent=conf_key))
+                    for new in remap.values())
+    featured_key = ndb.Key(FeaturedSpeaker, FEATURED_SPEAKER_ID,
+                           parent=conf_key)
+    entities = ndb.get_multi(old_keys + new_keys.values() + [featured_key])
+    featured = entities.pop()
+    loaded = dict((key, entity) for key, entity in
+                  zip(old_keys + new_keys.values(), entities))
+
+    changed = {}
+    for old in remap:
+        counts = loaded[ndb.Key(SpeakerSessions, old.id(), parent=conf_key)]
+        if not counts:
+            continue
+        new = remap[old]
+        target = changed.get(new) or loaded[new_keys[new]] or \
+            SpeakerSessions(key=new_keys[new], speakerKey=new,
+                            speakerName=counts.speakerName)
+        for sess_key, name in zip(counts.sessionKeys, counts.sessionNames):
+            if sess_key not in target.sessionKeys:
+                target.sessionKeys.append(sess_key)
+                target.sessionNames.append(name)
+        changed[new] = target
+    puts = changed.values()
+    if featured and featured.speakerKey in remap:
+        featured.speakerKey = remap[featured.speakerKey]
+        puts.append(featured)
+
+    ndb.put_multi(puts)
+    ndb.delete_multi([key for key in old_keys if loaded[key]])
+
+
+def dedupeSpeakers(cursor=None):
+    """Move one batch of Speakers to keys derived from their normalized
+    fullname, merging duplicates: Session.speakerKey and the featured
+    speaker counters are rewritten, then the old Speaker is deleted.
+    Returns the number of Speakers moved.
+
+    Sessions are found with an eventually consistent query, so run the
+    migration while no sessions are being created."""
+    speakers = _fetchBatch(Speaker.query().order(Speaker.key), cursor,
+                           DEDUPE_SPEAKERS_URL)
+    stale = [sp for sp in speakers
+             if speakerKey(sp.fullname) and sp.key != speakerKey(sp.fullname)]
+    if not stale:
+        return 0
+
+    # create the canonical Speakers that don't exist yet
+    canonical = list(set(speakerKey(sp.fullname) for sp in stale))
+    existing = set(sp.key for sp in ndb.get_multi(canonical) if sp)
+    created = {}
+    for sp in stale:
+        key = speakerKey(sp.fullname)
+        if key not in existing and key not in created:
+            created[key] = Speaker(key=key, fullname=sp.fullname,
+                                   profession=sp.profession)
+    ndb.put_multi(created.values())
+
+    # repoint the sessions of every stale Speaker
+    futures = [Session.query(Session.speakerKey == sp.key).fetch_async()
+               for sp in stale]
+    sessions = []
+    remaps = {}
+    for sp, future in zip(stale, futures):
+        for sess in future.get_result():
+            sess.speakerKey = speakerKey(sp.fullname)
+            sessions.append(sess)
+            remaps.setdefault(sess.key.parent(), {})[sp.key] = sess.speakerKey
+    ndb.put_multi(sessions)
+    for conf_key, remap in remaps.items():
+        _mergeSpeakerSessions(conf_key, remap)
+
+    ndb.delete_multi([sp.key for sp in stale])
+    return len(stale)
+
+
+def rekeyWishLists(cursor=None):
+    """Move one batch of WishList entries to keys derived from their
+    session, dropping duplicate entries. Returns the number moved."""
+    entries = _fetchBatch(WishList.query().order(WishList.key), cursor,
+                          REKEY_WISHLISTS_URL)
+    stale = [wl for wl in entries
+             if wl.key.id() != wl.sessionKey.urlsafe()]
+    moved = {}
+    for wl in stale:
+        key = ndb.Key(WishList, wl.sessionKey.urlsafe(), parent=wl.key.parent())
+        moved[key] = WishList(key=key, sessionKey=wl.sessionKey,
+                              userID=wl.userID)
+    ndb.put_multi(moved.values())
+    ndb.delete_multi([wl.key for wl in stale])
+    return len(stale)
+
+
+def backfillSessionSearch(cursor=None):
+    """Write one batch of sessions back so their computed search fields
+    (startMinute, typeBucket) are stored and indexed. Returns the number
+    of sessions written."""
+    sessions = _fetchBatch(Session.query().order(Session.key), cursor,
+                           BACKFILL_SESSION_SEARCH_URL)
+    ndb.put_multi(sessions)
+    return len(sessions)
+
+
+def indexConferences(cursor=None):
+    """Add one batch of conferences to the free-text search index.
+    Returns the number of conferences indexed."""
+    confs = _fetchBatch(Conference.query().order(Conference.key), cursor,
+                        INDEX_CONFERENCES_URL)
+    textsearch.indexConferences(confs)
+    return len(confs)
+
+
+def countConferenceFacets(cursor=None):
+    """Count one batch of conferences in the facet counts. Conferences
+    counted before are left alone. Returns the number visited."""
+    confs = _fetchBatch(Conference.query().order(Conference.key), cursor,
+                        COUNT_CONFERENCE_FACETS_URL)
+    facets.countConferences(confs)
+    return len(confs)
@@ -69,6 +69,78 @@ class Conference(ndb.Model):
     endDate         = ndb.DateProperty()
     maxAttendees    = ndb.IntegerProperty()
     seatsAvailable  = ndb.IntegerProperty()
+    seatShards      = ndb.IntegerProperty(default=0) # 0: not sharded yet
+
+
+class SeatShard(ndb.Model):
+    """SeatShard -- one slice of a conference's available seats.
+    Shards are root entities so registrations don't contend on the
+    Conference entity group, see seats.py"""
+    conference      = ndb.KeyProperty(kind=Conference, required=True)
+    seatsAvailable  = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class NearlySoldOut(ndb.Model):
+    """NearlySoldOut -- conferences with only a few seats left; a single
+    entity, see announcements.py"""
+    conferenceKeys  = ndb.KeyProperty(kind=Conference, repeated=True,
+                                      indexed=False)
+    conferenceNames = ndb.StringProperty(repeated=True, indexed=False)
+
+
+class ImportRowError(ndb.Model):
+    """ImportRowError -- why one row of a conference import was rejected"""
+    row             = ndb.IntegerProperty()
+    message         = ndb.StringProperty(indexed=False)
+
+
+class ConferenceImport(ndb.Model):
+    """ConferenceImport -- progress of one bulk conference import; a child
+    of the organizer's Profile, see bulkimport.py"""
+    email           = ndb.StringProperty(indexed=False)
+    status          = ndb.StringProperty(default='RUNNING')
+    totalRows       = ndb.IntegerProperty(default=0)
+    chunks          = ndb.IntegerProperty(default=0)
+    chunksDone      = ndb.IntegerProperty(default=0)
+    createdRows     = ndb.IntegerProperty(default=0)
+    errorRows       = ndb.IntegerProperty(default=0)
+    errors          = ndb.LocalStructuredProperty(ImportRowError,
+                                                  repeated=True)
+    created         = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class ConferenceImportChunk(ndb.Model):
+    """ConferenceImportChunk -- up to CHUNK_SIZE parsed rows of an import,
+    written by one task; a child of the ConferenceImport"""
+    rows            = ndb.JsonProperty(compressed=True) # [[row, {...}], ...]
+    firstId         = ndb.IntegerProperty(indexed=False) # allocated ids
+    done            = ndb.BooleanProperty(default=False, indexed=False)
+
+
+class SearchPosting(ndb.Model):
+    """SearchPosting -- one term of a conference's text, keyed by
+    "term websafeKey"; the free-text search index, see textsearch.py"""
+    term            = ndb.StringProperty(required=True)
+    conference      = ndb.KeyProperty(kind=Conference, required=True)
+    weight          = ndb.IntegerProperty(required=True)
+
+
+class FacetCounts(ndb.Model):
+    """FacetCounts -- one shard of the conference counts per city, topic
+    and month, see facets.py"""
+    counts          = ndb.JsonProperty() # {facet: {value: count}}
+
+
+class ConferenceFacets(ndb.Model):
+    """ConferenceFacets -- the facet values a conference is counted under;
+    a child of the Conference"""
+    values          = ndb.JsonProperty() # {facet: [value, ...]}
+
+
+class ConferenceTerms(ndb.Model):
+    """ConferenceTerms -- the terms a conference is indexed under; a child
+    of the Conference"""
+    weights         = ndb.JsonProperty() # {term: weight}
 
 
 class ConferenceForm(messages.Message):
@@ -90,6 +162,10 @@ class ConferenceForm(messages.Message):
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+    queryPlan = messages.StringField(3) # only set for debug queries
+    etag = messages.StringField(4)
+    notModified = messages.BooleanField(5)
 
 
 class TeeShirtSize(messages.Enum):
@@ -121,13 +197,76 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2)
+    pageToken = messages.StringField(3)
+    fields = messages.StringField(4, repeated=True)
+    debug = messages.BooleanField(5)
+    ifNoneMatch = messages.StringField(6) # etag of the client's copy
+
+
+class ImportFormat(messages.Enum):
+    """ImportFormat -- format of a bulk conference import"""
+    JSONL = 1   # one ConferenceForm JSON object per line
+    CSV = 2     # header row of ConferenceForm field names; topics split on ;
+
+
+class ConferenceImportForm(messages.Message):
+    """ConferenceImportForm -- bulk conference import inbound form message"""
+    data = messages.StringField(1)
+    format = messages.EnumField('ImportFormat', 2, default='JSONL')
+
+
+class ImportRowErrorForm(messages.Message):
+    """ImportRowErrorForm -- rejected import row outbound form message"""
+    row = messages.IntegerField(1)
+    message = messages.StringField(2)
+
+
+class ConferenceImportStatusForm(messages.Message):
+    """ConferenceImportStatusForm -- bulk import progress outbound form message"""
+    websafeKey = messages.StringField(1)
+    status = messages.StringField(2)
+    totalRows = messages.IntegerField(3)
+    chunks = messages.IntegerField(4)
+    chunksDone = messages.IntegerField(5)
+    createdRows = messages.IntegerField(6)
+    errorRows = messages.IntegerField(7)
+    errors = messages.MessageField(ImportRowErrorForm, 8, repeated=True)
+
+
+class FacetCountForm(messages.Message):
+    """FacetCountForm -- number of conferences with one facet value"""
+    value = messages.StringField(1)
+    count = messages.IntegerField(2)
+
+
+class ConferenceFacetsForm(messages.Message):
+    """ConferenceFacetsForm -- conference counts per city, topic and month
+    outbound form message"""
+    cities = messages.MessageField(FacetCountForm, 1, repeated=True)
+    topics = messages.MessageField(FacetCountForm, 2, repeated=True)
+    months = messages.MessageField(FacetCountForm, 3, repeated=True)
+
+
+class SearchMode(messages.Enum):
+    """SearchMode -- how the terms of a conference search combine"""
+    ALL = 1     # conferences matching every term
+    ANY = 2     # conferences matching at least one term
+
+
+class ConferenceSearchForm(messages.Message):
+    """ConferenceSearchForm -- free-text conference search inbound form message"""
+    query = messages.StringField(1)
+    mode = messages.EnumField('SearchMode', 2, default='ALL')
+    pageSize = messages.IntegerField(3)
+    pageToken = messages.StringField(4)
 
 # ------------- Nanodegree P4 --------------------
 # Task 1 Design choices
 
 
 class Speaker(ndb.Model):
-    """Speaker """
+    """Speaker -- keyed by the normalized fullname, see speakers.py"""
     fullname    = ndb.StringProperty(required=True)
     profession  = ndb.StringProperty()
 
@@ -142,15 +281,43 @@ class SpeakerForms(messages.Message):
     """WishlistForms -- multiple Conference outbound form message"""
     items = messages.MessageField(SpeakerForm, 1, repeated=True)
 
+def normalizeSessionType(typeOfSession):
+    """Return the normalized session type that sessions are searched by."""
+    return ' '.join((typeOfSession or '').split()).upper()
+
+
 class Session(ndb.Model):
     """Session class """
     name          = ndb.StringProperty(required=True)
     highlights    = ndb.StringProperty()
     speakerKey    = ndb.KeyProperty()
+    speakerName   = ndb.StringProperty(indexed=False) # denormalized Speaker.fullname
     duration      = ndb.IntegerProperty()
     typeOfSession = ndb.StringProperty(default='NOT_SPECIFIED')
     date          = ndb.DateProperty()
     startTime     = ndb.TimeProperty()
+    # indexed search fields, see searchSessions in conference.py
+    startMinute   = ndb.ComputedProperty(lambda self: self.startTime.hour * 60 +
+                                         self.startTime.minute
+                                         if self.startTime else None)
+    typeBucket    = ndb.ComputedProperty(lambda self: normalizeSessionType(self.typeOfSession))
+
+
+class SpeakerSessions(ndb.Model):
+    """SpeakerSessions -- sessions of one speaker at one conference.
+    Child of the Conference, keyed by the speaker key id"""
+    speakerKey    = ndb.KeyProperty(required=True)
+    speakerName   = ndb.StringProperty(indexed=False)
+    sessionKeys   = ndb.KeyProperty(repeated=True, indexed=False)
+    sessionNames  = ndb.StringProperty(repeated=True, indexed=False)
+
+
+class FeaturedSpeaker(ndb.Model):
+    """FeaturedSpeaker -- current featured speaker of a conference.
+    Single child entity of the Conference, see FEATURED_SPEAKER_ID"""
+    speakerKey    = ndb.KeyProperty(required=True)
+    speakerName   = ndb.StringProperty(indexed=False)
+    sessionNames  = ndb.StringProperty(repeated=True, indexed=False)
 
 
 class SessionForm(messages.Message):
@@ -170,10 +337,40 @@ class SessionForm(messages.Message):
 class SessionForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+
+class ConferenceAgenda(ndb.Model):
+    """ConferenceAgenda -- precomputed ConferenceAgendaForm of one
+    conference; a child of the Conference, see agenda.py"""
+    payload         = ndb.BlobProperty() # zlib compressed protojson
+    version         = ndb.IntegerProperty(indexed=False)
+
+
+class ConferenceAgendaForm(messages.Message):
+    """ConferenceAgendaForm -- conference with its sessions and speakers
+    outbound form message"""
+    conference = messages.MessageField(ConferenceForm, 1)
+    sessions = messages.MessageField(SessionForm, 2, repeated=True)
+    speakers = messages.MessageField(SpeakerForm, 3, repeated=True)
+    version = messages.IntegerField(4)
+
+
+class SessionSearchForm(messages.Message):
+    """SessionSearchForm -- session search inbound form message"""
+    websafeConferenceKey = messages.StringField(1)
+    excludeTypes = messages.StringField(2, repeated=True)
+    startAfter = messages.StringField(3) # HH:MM, inclusive
+    startBefore = messages.StringField(4) # HH:MM, exclusive
+    dateFrom = messages.StringField(5) # YYYY-MM-DD, inclusive
+    dateTo = messages.StringField(6) # YYYY-MM-DD, inclusive
+    pageSize = messages.IntegerField(7)
+    pageToken = messages.StringField(8)
 
 
 class WishList(ndb.Model):
-    """USer wishlist for sessions"""
+    """USer wishlist for sessions -- child of the user's Profile, keyed by
+    the websafe session key"""
     sessionKey    = ndb.KeyProperty(required=True)
     userID        = ndb.StringProperty()
 
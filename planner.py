@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+"""planner.py
+
+Udacity conference server-side Python App Engine query planner
+
+Turns the normalized filters of a query into a QueryPlan. The filters
+that one composite index from index_registry.py can serve run in the
+datastore. The rest are applied in memory to the query results: NE
+filters (which the datastore would split into several subqueries), a
+second inequality field, extra values of a repeated property, and
+combinations that no index covers.
+"""
+
+import operator
+
+from google.appengine.ext import ndb
+
+from index_registry import INDEXES
+
+EQUALITY = '='
+INEQUALITIES = ('<', '<=', '>', '>=')
+COMPARATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+class Predicate(object):
+    """One normalized filter: field operator value."""
+
+    def __init__(self, field, op, value):
+        self.field = field
+        self.operator = op
+        self.value = value
+
+    def __eq__(self, other):
+        return (self.field, self.operator, self.value) == \
+            (other.field, other.operator, other.value)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.field, self.operator, self.value))
+
+    def __repr__(self):
+        return '%s %s %r' % (self.field, self.operator, self.value)
+
+    def matches(self, obj):
+        """Evaluate the predicate against an entity or form message with
+        datastore semantics: a repeated value matches if any item does,
+        and a missing value only matches NE."""
+        value = getattr(obj, self.field, None)
+        compare = COMPARATORS[self.operator]
+        if isinstance(value, (list, tuple)):
+            return any(compare(item, self.value) for item in value)
+        if value is None:
+            return self.operator == '!='
+        return compare(value, self.value)
+
+
+class QueryPlan(object):
+    """Datastore filters, sort orders and the index that serves them,
+    plus the residual predicates to apply in memory."""
+
+    def __init__(self, model, sort, pushed=(), inequality=None, index=None,
+                 residual=(), empty=False, ancestor=False):
+        self.model = model
+        self.sort = sort
+        self.ancestor = ancestor
+        self.pushed = list(pushed)
+        self.inequality = inequality
+        self.index = index
+        self.residual = list(residual)
+        self.empty = empty
+
+    def query(self, **kwargs):
+        """Return the ndb query for the datastore part of the plan."""
+        q = self.model.query(**kwargs)
+        for pred in self.pushed:
+            # the property converts the value to its datastore type, e.g.
+            # a date to the datetime a DateProperty stores
+            prop = self.model._properties.get(pred.field)
+            if prop is not None:
+                q = q.filter(prop._comparison(pred.operator, pred.value))
+            else:
+                q = q.filter(ndb.query.FilterNode(pred.field, pred.operator,
+                                                  pred.value))
+        # If exists, sort on inequality filter first
+        if self.inequality:
+            q = q.order(ndb.GenericProperty(self.inequality))
+        return q.order(ndb.GenericProperty(self.sort))
+
+    def matches(self, obj):
+        """True if obj satisfies every residual predicate."""
+        return all(pred.matches(obj) for pred in self.residual)
+
+    def apply(self, results):
+        """Return the results that satisfy every residual predicate."""
+        if not self.residual:
+            return list(results)
+        return [r for r in results if self.matches(r)]
+
+    def describe(self):
+        """Return a one-line, human readable description of the plan."""
+        if self.empty:
+            return 'empty: contradictory filters'
+        if self.index:
+            index = '%s(%s%s)' % (self.model._get_kind(),
+                                  'ancestor, ' if self.ancestor else '',
+                                  ', '.join(self.index))
+        else:
+            index = 'built-in(%s)' % self.sort
+        return 'index=%s datastore=[%s] residual=[%s]' % (
+            index,
+            ', '.join(repr(pred) for pred in self.pushed),
+            ', '.join(repr(pred) for pred in self.residual))
+
+
+def normalize(filters):
+    """Return the list of distinct Predicates for filters, given as dicts
+    with field, operator and (already typed) value."""
+    predicates = []
+    for f in filters:
+        pred = Predicate(f['field'], f['operator'], f['value'])
+        if pred not in predicates:
+            predicates.append(pred)
+    return predicates
+
+
+def _contradicts(predicates, repeated):
+    """True if a non-repeated field is required to equal two values."""
+    seen = {}
+    for pred in predicates:
+        if pred.operator != EQUALITY or pred.field in repeated:
+            continue
+        if seen.setdefault(pred.field, pred.value) != pred.value:
+            return True
+    return False
+
+
+def plan(model, filters, sort='name', ancestor=False):
+    """Return the cheapest QueryPlan for filters on model, ordered by sort.
+
+    Candidates are the built-in index on sort (only inequality filters on
+    sort itself) and every composite index of model that ends with sort:
+    with only equality filters in front of it (plus inequality filters on
+    sort), or with equality filters and then one inequality field. The
+    candidate that lets the datastore apply the most predicates wins; ties
+    go to the smaller index. For ancestor queries (the caller passes the
+    ancestor to QueryPlan.query) only ancestor indexes are candidates.
+    """
+    predicates = normalize(filters)
+    repeated = set(name for name, prop in model._properties.items()
+                   if prop._repeated)
+    if _contradicts(predicates, repeated):
+        return QueryPlan(model, sort, residual=predicates, empty=True)
+
+    equalities = {}
+    ranges = {}
+    for pred in predicates:
+        if pred.operator == EQUALITY:
+            equalities.setdefault(pred.field, []).append(pred)
+        elif pred.operator in INEQUALITIES:
+            ranges.setdefault(pred.field, []).append(pred)
+
+    # an ancestor query ordered by a property always needs a composite
+    # index; the fallback plan relies on one on (ancestor, sort)
+    candidates = [QueryPlan(model, sort, ancestor=ancestor,
+                            index=[sort] if ancestor else None,
+                            pushed=ranges.get(sort, []))]
+    for is_ancestor, properties in INDEXES.get(model._get_kind(), []):
+        names = [name for name, direction in properties]
+        if is_ancestor != ancestor or names[-1] != sort or \
+                len(set(names)) != len(names) or \
+                any(direction != 'asc' for name, direction in properties):
+            continue
+        prefix = names[:-1]
+
+        # equality filters only, then the sort order
+        if all(name in equalities for name in prefix):
+            candidates.append(QueryPlan(
+                model, sort, index=names, ancestor=ancestor,
+                pushed=[equalities[name][0] for name in prefix] +
+                       ranges.get(sort, [])))
+
+        # equality filters, then one inequality field and the sort order
+        if prefix and prefix[-1] in ranges and \
+                all(name in equalities for name in prefix[:-1]):
+            candidates.append(QueryPlan(
+                model, sort, index=names, inequality=prefix[-1],
+                ancestor=ancestor,
+                pushed=[equalities[name][0] for name in prefix[:-1]] +
+                       ranges[prefix[-1]]))
+
+    best = max(candidates,
+               key=lambda p: (len(p.pushed), -len(p.index or ())))
+    best.residual = [pred for pred in predicates if pred not in best.pushed]
+    return best
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+"""seats.py
+
+Udacity conference server-side Python App Engine sharded seat counter
+
+The available seats of a conference are split across NUM_SEAT_SHARDS
+SeatShard root entities. Registrations take or give back a seat on a
+randomly chosen shard, so concurrent registrants no longer contend on the
+Conference entity group. The total is cached in memcache and written back
+to Conference.seatsAvailable by a deferred reconciliation task, which keeps
+queries and the announcement cron eventually consistent.
+"""
+
+import random
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import caching
+from models import SeatShard
+
+NUM_SEAT_SHARDS = 10
+MEMCACHE_SEATS_PREFIX = "SEATS_AVAILABLE:"
+SEATS_CACHE_TIME = 60           # seconds
+RECONCILE_INTERVAL = 30         # seconds between write-backs per conference
+RECONCILE_URL = '/tasks/reconcile_seats'
+
+
+def shardKeys(conf):
+    """Return the keys of all SeatShards of a sharded conference."""
+    wsck = conf.key.urlsafe()
+    return [ndb.Key(SeatShard, '%s-%d' % (wsck, i))
+            for i in range(conf.seatShards)]
+
+
+@ndb.transactional(xg=True)
+def initShards(conf_key, num_shards=NUM_SEAT_SHARDS):
+    """Split the conference's current seatsAvailable across num_shards
+    SeatShards. Returns the (possibly already) sharded Conference."""
+    conf = conf_key.get()
+    if conf.seatShards:
+        return conf
+
+    seats = conf.seatsAvailable or 0
+    conf.seatShards = num_shards
+    shards = []
+    for i, key in enumerate(shardKeys(conf)):
+        share = seats // num_shards + (1 if i < seats % num_shards else 0)
+        shards.append(SeatShard(key=key, conference=conf_key,
+                                seatsAvailable=share))
+    ndb.put_multi(shards + [conf])
+    return conf
+
+
+def pickShard(conf, reg=True):
+    """Return a random shard key to register (reg=True) or unregister on.
+    For registration only shards with seats left are considered; returns
+    None when the conference is sold out."""
+    keys = shardKeys(conf)
+    if not reg:
+        return random.choice(keys)
+    shards = ndb.get_multi(keys)
+    candidates = [shard.key for shard in shards
+                  if shard and shard.seatsAvailable > 0]
+    if not candidates:
+        return None
+    return random.choice(candidates)
+
+
+def adjustSeats(conf, delta):
+    """Add delta (may be negative) seats to the shards of conf; meant to be
+    called inside the caller's xg transaction, e.g. when maxAttendees
+    changes. New seats go to one random shard; seats are taken away from
+    the shards that have seats left, so no shard goes below zero. Returns
+    False, changing nothing, if fewer than -delta seats are left."""
+    if delta >= 0:
+        shard = random.choice(shardKeys(conf)).get()
+        shard.seatsAvailable += delta
+        changed = [shard]
+    else:
+        shards = sorted((shard for shard in ndb.get_multi(shardKeys(conf))
+                         if shard and shard.seatsAvailable > 0),
+                        key=lambda shard: -shard.seatsAvailable)
+        if sum(shard.seatsAvailable for shard in shards) < -delta:
+            return False
+        remaining = -delta
+        changed = []
+        for shard in shards:
+            if not remaining:
+                break
+            taken = min(remaining, shard.seatsAvailable)
+            shard.seatsAvailable -= taken
+            remaining -= taken
+            changed.append(shard)
+    ndb.put_multi(changed)
+    ndb.get_context().call_on_commit(
+        lambda: memcache.delete(MEMCACHE_SEATS_PREFIX + conf.key.urlsafe()))
+    return True
+
+
+def getSeatsAvailableMulti(confs):
+    """Return a {websafeKey: seatsAvailable} dict for sharded confs,
+    summing the shards of any conference whose total isn't cached."""
+    confs = [conf for conf in confs if conf.seatShards]
+    wscks = [conf.key.urlsafe() for conf in confs]
+    totals = memcache.get_multi(wscks, key_prefix=MEMCACHE_SEATS_PREFIX)
+
+    missing = [conf for conf in confs if conf.key.urlsafe() not in totals]
+    if missing:
+        keys = []
+        for conf in missing:
+            keys.extend(shardKeys(conf))
+        loaded = dict((conf.key.urlsafe(), 0) for conf in missing)
+        for shard in ndb.get_multi(keys):
+            if shard:
+                loaded[shard.conference.urlsafe()] += shard.seatsAvailable
+        memcache.add_multi(loaded, time=SEATS_CACHE_TIME,
+                           key_prefix=MEMCACHE_SEATS_PREFIX)
+        totals.update(loaded)
+    return totals
+
+
+def seatsChanged(conf, delta):
+    """Record a committed change of delta seats: update the cached total
+    and schedule the write-back to Conference.seatsAvailable. Returns the
+    new number of available seats."""
+    wsck = conf.key.urlsafe()
+    total = None
+    if delta > 0:
+        total = memcache.incr(MEMCACHE_SEATS_PREFIX + wsck, delta)
+    elif delta < 0:
+        total = memcache.decr(MEMCACHE_SEATS_PREFIX + wsck, -delta)
+
+    # one named task per conference and interval coalesces the write-backs;
+    # it runs after the interval closes so it sees every change made in it
+    now = time.time()
+    bucket = int(now // RECONCILE_INTERVAL)
+    try:
+        taskqueue.add(url=RECONCILE_URL,
+                      name='reconcile-seats-%s-%d' % (wsck, bucket),
+                      params={'websafeConferenceKey': wsck},
+                      countdown=int((bucket + 1) * RECONCILE_INTERVAL - now) + 1)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+    if total is None:
+        total = getSeatsAvailableMulti([conf])[wsck]
+    return total
+
+
+def reconcile(conf_key):
+    """Write the sum of the shards back to Conference.seatsAvailable.
+    Returns the total."""
+    conf = conf_key.get()
+    if not conf or not conf.seatShards:
+        return None
+    total = sum(shard.seatsAvailable
+                for shard in ndb.get_multi(shardKeys(conf)) if shard)
+    memcache.set(MEMCACHE_SEATS_PREFIX + conf_key.urlsafe(), total,
+                 time=SEATS_CACHE_TIME)
+
+    @ndb.transactional()
+    def _writeBack():
+        conf = conf_key.get()
+        if conf.seatsAvailable != total:
+            conf.seatsAvailable = total
+            conf.put()
+            return True
+        return False
+
+    if _writeBack():
+        # listings show the written back seatsAvailable
+        caching.bumpListingGeneration()
+    return total
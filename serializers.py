@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+"""serializers.py
+
+Udacity conference server-side Python App Engine entity <-> message copiers
+
+For every registered (Model, Message) pair, a copy plan is compiled once,
+at import time. The plan lists the message fields the model also has,
+each with its date/time/key/enum conversion already chosen. Copying an
+entity then runs a tight loop over that plan. There are no all_fields(),
+hasattr() or field name checks per entity.
+
+conferenceDataFromForm() and sessionDataFromForm() go the other way, for
+creating Conferences and Sessions.
+"""
+
+from datetime import datetime
+
+from protorpc import messages
+from google.appengine.ext import ndb
+
+from models import Conference, ConferenceForm
+from models import ConferenceImport, ConferenceImportStatusForm
+from models import ImportRowError, ImportRowErrorForm
+from models import Profile, ProfileForm
+from models import Session, SessionForm
+from models import Speaker, SpeakerForm
+from models import WishList, WishListForm
+
+DEFAULTS = {
+    "city": "Default City",
+    "maxAttendees": 0,
+    "seatsAvailable": 0,
+    "topics": [ "Default", "Topic" ],
+}
+
+SESSION_DEFAULTS = {
+    "duration": 0,
+    "typeOfSession": "NOT_SPECIFIED"
+}
+
+# property types that are sent to the client as their str()
+_STRINGIFIED = (ndb.DateProperty, ndb.TimeProperty, ndb.DateTimeProperty,
+                ndb.KeyProperty)
+
+
+def _converterFor(prop, field):
+    """Return the function converting a value of ndb property prop into a
+    value of message field field, or None to copy it unchanged."""
+    if isinstance(field, messages.StringField) and \
+            isinstance(prop, _STRINGIFIED):
+        return str
+    if isinstance(field, messages.EnumField):
+        enum = field.type
+        return lambda value: getattr(enum, value)
+    if isinstance(field, messages.MessageField) and \
+            isinstance(prop, (ndb.StructuredProperty,
+                              ndb.LocalStructuredProperty)):
+        sub = field.type
+        if prop._repeated:
+            return lambda value: [copy(item, sub) for item in value]
+        return lambda value: copy(value, sub)
+    return None
+
+
+class CopyPlan(object):
+    """Compiled copy of one Model's properties into one Message class."""
+
+    def __init__(self, model, message, key_field=None):
+        self.message = message
+        self.key_field = key_field
+        self.steps = []
+        for field in sorted(message.all_fields(), key=lambda f: f.number):
+            prop = model._properties.get(field.name)
+            if prop is not None:
+                self.steps.append((field.name, _converterFor(prop, field)))
+        self._projected = {}
+
+    def _stepsFor(self, entity):
+        """Return the steps for entity; a projection query result only
+        has its projected properties."""
+        projection = entity._projection
+        if not projection:
+            return self.steps
+        steps = self._projected.get(projection)
+        if steps is None:
+            steps = [step for step in self.steps if step[0] in projection]
+            self._projected[projection] = steps
+        return steps
+
+    def copy(self, entity):
+        """Return a new Message filled from entity."""
+        values = {}
+        for name, convert in self._stepsFor(entity):
+            value = getattr(entity, name)
+            values[name] = convert(value) if convert else value
+        if self.key_field:
+            values[self.key_field] = entity.key.urlsafe()
+        return self.message(**values)
+
+
+_PLANS = {}
+
+
+def register(model, message, key_field=None):
+    """Compile and register the copy plan of model into message.
+    key_field names the message field that receives the websafe key."""
+    _PLANS[(model, message)] = CopyPlan(model, message, key_field)
+
+
+def copy(entity, message):
+    """Copy entity into a new message using the registered plan."""
+    return _PLANS[(type(entity), message)].copy(entity)
+
+
+register(Conference, ConferenceForm, key_field='websafeKey')
+register(Profile, ProfileForm)
+register(Session, SessionForm, key_field='sessionWebsafeKey')
+register(Speaker, SpeakerForm)
+register(WishList, WishListForm)
+register(ImportRowError, ImportRowErrorForm)
+register(ConferenceImport, ConferenceImportStatusForm, key_field='websafeKey')
+
+
+def copySession(session, speaker=None):
+    """Copy session into a new SessionForm, with the name and profession
+    of speaker, its Speaker entity."""
+    sform = copy(session, SessionForm)
+
+    # get speaker properties
+    if speaker:
+        sform.speakerName = str(speaker.fullname)
+        sform.speakerProfession = str(speaker.profession)
+    else:
+        sform.speakerName = "None"
+        sform.speakerProfession = "None"
+    return sform
+
+
+def conferenceDataFromForm(form):
+    """Return the Conference properties for a new conference described by
+    form, a ConferenceForm, as a dict. Missing defaults are filled in on
+    form too, so it can be returned to the client. Raises ValueError for
+    badly formatted dates."""
+    # copy ConferenceForm/ProtoRPC Message into dict
+    data = {field.name: getattr(form, field.name) for field in form.all_fields()}
+    del data['websafeKey']
+    del data['organizerDisplayName']
+
+    # add default values for those missing (data model&outbound Message)
+    for df in DEFAULTS:
+        if data[df] in (None, []):
+            data[df] = DEFAULTS[df]
+            setattr(form, df, DEFAULTS[df])
+
+    # convert dates from strings->Date objects;set month basedon start_date
+    if data['startDate']:
+        data['startDate'] = datetime.strptime(data['startDate'][:10], "%Y-%m-%d").date()
+        data['month'] = data['startDate'].month
+    else:
+        data['month'] = 0
+    if data['endDate']:
+        data['endDate'] = datetime.strptime(data['endDate'][:10], "%Y-%m-%d").date()
+
+    # set seatsAvailable to be same as maxAttendees on creation
+    if data["maxAttendees"] > 0:
+        data["seatsAvailable"] = data["maxAttendees"]
+    return data
+
+
+def sessionDataFromForm(form):
+    """Return the Session properties for a new session described by form,
+    a SessionForm, as a dict; the speakerKey is left to the caller. Missing
+    defaults are filled in on form too. Raises ValueError for badly
+    formatted dates or times."""
+    # copy SessionForm/ProtoRPC Message into dict data
+    data = {field.name: getattr(form, field.name) for field in form.all_fields()}
+    del data['confwebsafekey']
+    del data['sessionWebsafeKey']
+    # speakerName stays on the session (denormalized) for the featured
+    # speaker; speaker queries filter on speakerKey
+    del data['speakerProfession']
+
+    # add default values for those missing
+    # (both data model & outbound Message)
+    for df in SESSION_DEFAULTS:
+        if data[df] in (None, []):
+            data[df] = SESSION_DEFAULTS[df]
+            setattr(form, df, SESSION_DEFAULTS[df])
+
+    # convert dates and times from strings to Date and Time objects;
+    # if the date is missing, the user can add it later
+    if form.date:
+        data['date'] = datetime.strptime(form.date, "%Y-%m-%d").date()
+    if form.startTime:
+        data['startTime'] = datetime.strptime(form.startTime, "%H:%M").time()
+    return data
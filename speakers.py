@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+"""speakers.py
+
+Udacity conference server-side Python App Engine speaker lookup
+
+Speaker entities are keyed by their normalized fullname, so finding a
+speaker is a strongly consistent get instead of a global query, and two
+sessions naming the same speaker at the same time can't create two
+Speakers. Names known to have a Speaker are cached in memcache, which
+saves even the get when sessions are created.
+"""
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Speaker
+
+MEMCACHE_SPEAKER_KEY_PREFIX = "SPEAKER_KEY:"
+SPEAKER_KEY_CACHE_TIME = 60 * 60   # seconds
+
+
+def normalizeName(name):
+    """Return the normalized form of a speaker fullname: lower case, with
+    runs of whitespace collapsed to a single space."""
+    return u' '.join(name.split()).lower()
+
+
+def speakerKey(name):
+    """Return the Speaker key for fullname name, or None if it is blank."""
+    normalized = normalizeName(name)
+    return ndb.Key(Speaker, normalized) if normalized else None
+
+
+def getSpeakerKeys(speakers):
+    """Return a {fullname: Speaker key} dict for speakers, a {fullname:
+    profession} dict; blank names map to None. Speakers that don't exist
+    yet are created with a single put_multi."""
+    keys = dict((name, speakerKey(name)) for name in speakers)
+    wanted = dict((key.id(), key) for key in keys.values() if key)
+    if not wanted:
+        return keys
+
+    cached = memcache.get_multi(wanted.keys(),
+                                key_prefix=MEMCACHE_SPEAKER_KEY_PREFIX)
+    unknown = [key for normalized, key in wanted.items()
+               if normalized not in cached]
+    if unknown:
+        found = set(speaker.key for speaker in ndb.get_multi(unknown)
+                    if speaker)
+        created = {}
+        for name, key in keys.items():
+            if key in unknown and key not in found and key not in created:
+                created[key] = Speaker(key=key, fullname=name,
+                                       profession=speakers[name])
+        ndb.put_multi(created.values())
+        memcache.set_multi(dict((key.id(), key.urlsafe()) for key in unknown),
+                           time=SPEAKER_KEY_CACHE_TIME,
+                           key_prefix=MEMCACHE_SPEAKER_KEY_PREFIX)
+    return keys
@@ -293,6 +293,19 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.conferences = [];
 
+    /**
+     * The conference fields shown in the list; the server only returns these.
+     * @type {string[]}
+     */
+    $scope.listFields = ['websafeKey', 'name', 'city', 'startDate',
+        'organizerDisplayName', 'maxAttendees', 'seatsAvailable'];
+
+    /**
+     * The last queryConferences response per query, for revalidation by etag.
+     * @type {{}}
+     */
+    $scope.queryCache = {};
+
     /**
      * Holds the state if offcanvas is enabled.
      *
@@ -428,7 +441,8 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.queryConferencesAll = function () {
         var sendFilters = {
-            filters: []
+            filters: [],
+            fields: $scope.listFields
         }
         for (var i = 0; i < $scope.filters.length; i++) {
             var filter = $scope.filters[i];
@@ -440,6 +454,11 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                 });
             }
         }
+        var cacheKey = JSON.stringify(sendFilters);
+        var cached = $scope.queryCache[cacheKey];
+        if (cached) {
+            sendFilters.ifNoneMatch = cached.etag;
+        }
         $scope.loading = true;
         gapi.client.conference.queryConferences(sendFilters).
             execute(function (resp) {
@@ -458,8 +477,15 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         $scope.alertStatus = 'success';
                         $log.info($scope.messages);
 
+                        // reuse our copy if the server says it is current
+                        var items = resp.items;
+                        if (resp.notModified && cached) {
+                            items = cached.items;
+                        } else {
+                            $scope.queryCache[cacheKey] = {etag: resp.etag, items: items};
+                        }
                         $scope.conferences = [];
-                        angular.forEach(resp.items, function (conference) {
+                        angular.forEach(items, function (conference) {
                             $scope.conferences.push(conference);
                         });
                     }
@@ -473,7 +499,9 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.getConferencesCreated = function () {
         $scope.loading = true;
-        gapi.client.conference.getConferencesCreated().
+        gapi.client.conference.getConferencesCreated({
+            fields: $scope.listFields
+        }).
             execute(function (resp) {
                 $scope.$apply(function () {
                     $scope.loading = false;
@@ -550,16 +578,19 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
 conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $log, $routeParams, HTTP_ERRORS) {
     $scope.conference = {};
 
+    $scope.sessions = [];
+
     $scope.isUserAttending = false;
 
     /**
      * Initializes the conference detail page.
-     * Invokes the conference.getConference method and sets the returned conference in the $scope.
+     * Invokes the conference.getConferenceAgenda method and sets the returned conference and its sessions
+     * in the $scope.
      *
      */
     $scope.init = function () {
         $scope.loading = true;
-        gapi.client.conference.getConference({
+        gapi.client.conference.getConferenceAgenda({
             websafeConferenceKey: $routeParams.websafeConferenceKey
         }).execute(function (resp) {
             $scope.$apply(function () {
@@ -574,7 +605,8 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
                 } else {
                     // The request has succeeded.
                     $scope.alertStatus = 'success';
-                    $scope.conference = resp.result;
+                    $scope.conference = resp.result.conference;
+                    $scope.sessions = resp.result.sessions || [];
                 }
             });
         });
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+"""textsearch.py
+
+Udacity conference server-side Python App Engine free-text conference search
+
+The name, topics and description of a conference are split into words,
+lowercased and stemmed into terms. Every (term, conference) pair is a
+SearchPosting root entity holding the term's weight in that conference,
+so the posting list of a term is an index scan and writes never contend.
+The terms a conference is indexed under are kept in its ConferenceTerms,
+which lets a reindex write only the postings that changed.
+
+Conferences are indexed by a task once they are created or updated.
+search() reads the MAX_POSTINGS heaviest postings of each query term,
+scores conferences by weight times an inverse frequency of the term and
+returns them best first; the ranked keys are cached briefly in memcache
+so paging through them doesn't run the queries again.
+"""
+
+import collections
+import hashlib
+import math
+import re
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import ConferenceTerms, SearchMode, SearchPosting
+
+TERMS_ID = 'terms'
+INDEX_URL = '/tasks/index_conference'
+MEMCACHE_SEARCH_PREFIX = "CONFERENCE_SEARCH:"
+SEARCH_CACHE_TIME = 60          # seconds
+MAX_POSTINGS = 1000             # postings read per query term
+MAX_RESULTS = 1000              # ranked conferences kept per query
+MAX_QUERY_TERMS = 8
+MAX_TERM_LENGTH = 40
+MIN_STEM_LENGTH = 3
+# weight of one occurrence of a term in each field
+FIELD_WEIGHTS = (('name', 3), ('topics', 2), ('description', 1))
+STOP_WORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in',
+    'into', 'is', 'it', 'its', 'of', 'on', 'or', 'the', 'this', 'to',
+    'with'))
+# (suffix, replacement), longest first; the first one that leaves a stem
+# of at least MIN_STEM_LENGTH characters is applied
+SUFFIXES = (('ational', 'ate'), ('ization', 'ize'), ('ations', 'ate'),
+            ('ation', 'ate'), ('ingly', ''), ('ings', ''), ('ing', ''),
+            ('edly', ''), ('ies', 'y'), ('ied', 'y'), ('ed', ''), ('ly', ''),
+            ('es', ''), ('s', ''))
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def stem(word):
+    """Return the stem of the lowercase word. A light suffix stripper:
+    it only has to map the forms of a word to the same term."""
+    for suffix, replacement in SUFFIXES:
+        if word.endswith(suffix) and \
+                len(word) - len(suffix) >= MIN_STEM_LENGTH:
+            # 'class', 'focus', 'analysis' aren't plurals, 'speed' isn't
+            # a past tense
+            if suffix == 's' and word[-2] in 'siu' or \
+                    suffix == 'ed' and word[-3] == 'e':
+                continue
+            word = word[:-len(suffix)] + replacement
+            break
+    # 'conference' and 'conferences' both end up as 'conferenc'
+    if word.endswith('e') and len(word) > MIN_STEM_LENGTH + 1:
+        word = word[:-1]
+    return word
+
+
+def tokenize(text):
+    """Return the terms of text, in order, with repeats."""
+    terms = []
+    for word in _WORD.findall(text.lower()):
+        if len(word) < 2 or word in STOP_WORDS:
+            continue
+        terms.append(stem(word)[:MAX_TERM_LENGTH])
+    return terms
+
+
+def termWeights(conf):
+    """Return the {term: weight} of conf."""
+    weights = collections.defaultdict(int)
+    for field, weight in FIELD_WEIGHTS:
+        value = getattr(conf, field)
+        if not value:
+            continue
+        if isinstance(value, list):
+            value = u' '.join(value)
+        for term in tokenize(value):
+            weights[term] += weight
+    return dict(weights)
+
+
+def termsKey(conf_key):
+    """Return the key of the ConferenceTerms of conf_key."""
+    return ndb.Key(ConferenceTerms, TERMS_ID, parent=conf_key)
+
+
+def postingKey(term, wsck):
+    """Return the key of the SearchPosting of term in the conference
+    with the websafe key wsck."""
+    return ndb.Key(SearchPosting, u'%s %s' % (term, wsck))
+
+
+def indexConferences(confs):
+    """Bring the postings of confs up to date, writing only the ones
+    that changed. Safe to run again if it fails half way."""
+    old_terms = ndb.get_multi([termsKey(conf.key) for conf in confs])
+    postings = []
+    stale = []
+    terms = []
+    for conf, old in zip(confs, old_terms):
+        wsck = conf.key.urlsafe()
+        weights = termWeights(conf)
+        previous = old.weights if old else {}
+        for term, weight in weights.items():
+            if previous.get(term) != weight:
+                postings.append(SearchPosting(key=postingKey(term, wsck),
+                                              term=term, conference=conf.key,
+                                              weight=weight))
+        stale.extend(postingKey(term, wsck) for term in previous
+                     if term not in weights)
+        if weights != previous:
+            terms.append(ConferenceTerms(key=termsKey(conf.key),
+                                         weights=weights))
+    ndb.put_multi(postings)
+    ndb.delete_multi(stale)
+    # written last, so a retry still sees what the postings were before
+    ndb.put_multi(terms)
+
+
+def unindexConference(conf_key):
+    """Remove the postings of the deleted conference conf_key."""
+    terms = termsKey(conf_key).get()
+    if not terms:
+        return
+    wsck = conf_key.urlsafe()
+    ndb.delete_multi([postingKey(term, wsck) for term in terms.weights])
+    terms.key.delete()
+
+
+def indexConference(conf_key):
+    """Index, or unindex if it no longer exists, the conference conf_key."""
+    conf = conf_key.get()
+    if conf:
+        indexConferences([conf])
+    else:
+        unindexConference(conf_key)
+
+
+def scheduleIndex(conf_key):
+    """Enqueue the indexing of conf_key; within a transaction the task is
+    only added if the transaction commits."""
+    taskqueue.add(url=INDEX_URL,
+                  params={'websafeConferenceKey': conf_key.urlsafe()},
+                  transactional=ndb.in_transaction())
+
+
+def _rank(terms, mode):
+    """Return the keys of the conferences matching terms in SearchMode
+    mode, best first."""
+    futures = [(term, SearchPosting.query(SearchPosting.term == term)
+                                   .order(-SearchPosting.weight)
+                                   .fetch_async(MAX_POSTINGS, projection=[
+                                       SearchPosting.weight,
+                                       SearchPosting.conference]))
+               for term in terms]
+    weights = {}    # term: {conference key: weight}
+    for term, future in futures:
+        weights[term] = dict((p.conference, p.weight)
+                             for p in future.get_result())
+
+    if mode == SearchMode.ALL:
+        # every match is in the shortest posting list (unless all of them
+        # were cut off); a longer list may have been cut off, so look up
+        # the postings it didn't return
+        shortest = min(terms, key=lambda term: len(weights[term]))
+        candidates = weights[shortest].keys()
+        for term in terms:
+            if len(weights[term]) < MAX_POSTINGS:
+                continue
+            missing = [key for key in candidates if key not in weights[term]]
+            found = ndb.get_multi([postingKey(term, key.urlsafe())
+                                   for key in missing])
+            for posting in found:
+                if posting:
+                    weights[term][posting.conference] = posting.weight
+        matches = [key for key in candidates
+                   if all(key in weights[term] for term in terms)]
+    else:
+        matches = set(key for term in terms for key in weights[term])
+
+    # rare terms tell more about a conference than common ones
+    idf = dict((term, math.log(1.0 + float(MAX_POSTINGS) /
+                               max(len(weights[term]), 1)))
+               for term in terms)
+    scores = dict((key, sum(weights[term].get(key, 0) * idf[term]
+                            for term in terms))
+                  for key in matches)
+    return sorted(matches, key=lambda key: (-scores[key], key.urlsafe()))
+
+
+def search(query, mode=SearchMode.ALL):
+    """Return the websafe keys of the conferences matching the free-text
+    query, best first. Terms must all match in ALL mode, any of them in
+    ANY mode. Postings of deleted conferences may still be returned."""
+    terms = sorted(set(tokenize(query)))[:MAX_QUERY_TERMS]
+    if not terms:
+        return []
+    cache_key = MEMCACHE_SEARCH_PREFIX + hashlib.sha1(
+        (u'%s:%s' % (mode, u' '.join(terms))).encode('utf-8')).hexdigest()
+    wscks = memcache.get(cache_key)
+    if wscks is None:
+        wscks = [key.urlsafe() for key in _rank(terms, mode)[:MAX_RESULTS]]
+        memcache.set(cache_key, wscks, time=SEARCH_CACHE_TIME)
+    return wscks
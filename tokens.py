@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+"""tokens.py
+
+Udacity conference server-side Python App Engine OAuth token -> user id
+
+Verified tokens are cached in a bounded LRU per instance and in memcache,
+keyed by a SHA-256 hash of the token (tokens themselves are never stored)
+and kept until the token expires. Google ID tokens are JWTs: their RS256
+signature is checked locally against Google's public keys, which are
+cached as long as Google's Cache-Control allows. Only access tokens and
+tokens that can't be checked locally go to the tokeninfo endpoint.
+"""
+
+import base64
+import collections
+import hashlib
+import json
+import re
+import threading
+import time
+
+import endpoints
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+from google.appengine.api import memcache
+from google.appengine.api import urlfetch
+
+from settings import WEB_CLIENT_ID, ANDROID_CLIENT_ID, IOS_CLIENT_ID
+from settings import ANDROID_AUDIENCE
+
+TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
+CERTS_URL = 'https://www.googleapis.com/oauth2/v3/certs'
+ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+AUDIENCES = frozenset((WEB_CLIENT_ID, ANDROID_CLIENT_ID, IOS_CLIENT_ID,
+                       ANDROID_AUDIENCE, endpoints.API_EXPLORER_CLIENT_ID))
+CLOCK_SKEW = 300                    # seconds
+MEMCACHE_TOKEN_PREFIX = "OAUTH_TOKEN:"
+MEMCACHE_CERTS_KEY = "OAUTH_CERTS"
+MAX_TOKEN_CACHE_TIME = 60 * 60      # seconds
+DEFAULT_CERTS_CACHE_TIME = 60 * 60  # seconds, without Cache-Control
+TOKEN_LOCAL_CACHE_SIZE = 1000       # entries per instance
+
+_lock = threading.Lock()
+_tokens = collections.OrderedDict()     # token hash: (expires, user id)
+_certs = {}                             # 'expires', 'keys': {kid: (n, e)}
+
+
+def _b64decode(segment):
+    """Decode an unpadded base64url JWT segment."""
+    return base64.urlsafe_b64decode(str(segment) + '=' * (-len(segment) % 4))
+
+
+def _getLocal(token_hash):
+    with _lock:
+        entry = _tokens.pop(token_hash, None)
+        if entry is None or entry[0] < time.time():
+            return None
+        # re-insert to mark it as most recently used
+        _tokens[token_hash] = entry
+        return entry[1]
+
+
+def _setLocal(token_hash, expires, user_id):
+    with _lock:
+        _tokens.pop(token_hash, None)
+        _tokens[token_hash] = (expires, user_id)
+        while len(_tokens) > TOKEN_LOCAL_CACHE_SIZE:
+            _tokens.popitem(last=False)
+
+
+def _getCerts():
+    """Return Google's current JWT signing keys as {kid: (n, e)}."""
+    if _certs.get('expires', 0) > time.time():
+        return _certs['keys']
+    cached = memcache.get(MEMCACHE_CERTS_KEY)
+    if cached is None:
+        resp = urlfetch.fetch(CERTS_URL)
+        if resp.status_code != 200:
+            raise ValueError('certificate fetch failed: %d' % resp.status_code)
+        keys = {}
+        try:
+            for jwk in json.loads(resp.content)['keys']:
+                keys[jwk['kid']] = (
+                    long(_b64decode(jwk['n']).encode('hex'), 16),
+                    long(_b64decode(jwk['e']).encode('hex'), 16))
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('malformed certificates')
+        max_age = re.search(r'max-age=(\d+)',
+                            resp.headers.get('Cache-Control', ''))
+        ttl = int(max_age.group(1)) if max_age else DEFAULT_CERTS_CACHE_TIME
+        cached = (time.time() + ttl, keys)
+        memcache.set(MEMCACHE_CERTS_KEY, cached, time=ttl)
+    _certs['expires'], _certs['keys'] = cached
+    return _certs['keys']
+
+
+def _verifyIdToken(token):
+    """Check the signature and claims of a Google ID token locally.
+    Returns (user id, expiry time); raises ValueError if it can't be
+    verified."""
+    try:
+        header, payload, signature = token.split('.')
+        header_json = json.loads(_b64decode(header))
+        claims = json.loads(_b64decode(payload))
+        signature = _b64decode(signature)
+    except (TypeError, ValueError):
+        raise ValueError('not a JWT')
+    if not isinstance(header_json, dict) or not isinstance(claims, dict):
+        raise ValueError('not a JWT')
+    if header_json.get('alg') != 'RS256':
+        raise ValueError('unexpected algorithm')
+    kid = header_json.get('kid')
+    key = _getCerts().get(kid) if isinstance(kid, basestring) else None
+    if not key:
+        raise ValueError('unknown signing key')
+
+    verifier = PKCS1_v1_5.new(RSA.construct(key))
+    if not verifier.verify(SHA256.new('%s.%s' % (header, payload)),
+                           signature):
+        raise ValueError('bad signature')
+
+    now = time.time()
+    if claims.get('iss') not in ISSUERS or \
+            claims.get('aud') not in AUDIENCES or \
+            not claims.get('sub') or \
+            claims.get('exp', 0) + CLOCK_SKEW < now or \
+            claims.get('iat', 0) - CLOCK_SKEW > now:
+        raise ValueError('invalid claims')
+    return claims['sub'], claims['exp']
+
+
+def _tokenInfo(token, token_type):
+    """Ask the tokeninfo endpoint about token. Returns (user id, expiry
+    time); the user id is '' if the token is invalid."""
+    url = TOKENINFO_URL % (token_type, token)
+    user = {}
+    wait = 1
+    for i in range(3):
+        resp = urlfetch.fetch(url)
+        if resp.status_code == 200:
+            user = json.loads(resp.content)
+            break
+        elif resp.status_code == 400 and 'invalid_token' in resp.content:
+            url = TOKENINFO_URL % ('access_token', token)
+        else:
+            time.sleep(wait)
+            wait = wait + i
+    return user.get('user_id', ''), time.time() + int(user.get('expires_in', 0))
+
+
+def getUserIdForToken(token, token_type='id_token'):
+    """Return the user id of an OAuth bearer token, '' if it is invalid.
+    token_type says which kind of token the tokeninfo endpoint is asked
+    about first when the token can't be verified locally."""
+    token_hash = hashlib.sha256(token).hexdigest()
+    user_id = _getLocal(token_hash)
+    if user_id is not None:
+        return user_id
+    cached = memcache.get(MEMCACHE_TOKEN_PREFIX + token_hash)
+    if cached is not None:
+        expires, user_id = cached
+        _setLocal(token_hash, expires, user_id)
+        return user_id
+
+    try:
+        user_id, expires = _verifyIdToken(token)
+    except (ValueError, urlfetch.Error):
+        user_id, expires = _tokenInfo(token, token_type)
+    expires = min(expires, time.time() + MAX_TOKEN_CACHE_TIME)
+    if user_id and expires > time.time():
+        memcache.set(MEMCACHE_TOKEN_PREFIX + token_hash, (expires, user_id),
+                     time=int(expires - time.time()) + 1)
+        _setLocal(token_hash, expires, user_id)
+    return user_id
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+"""tokens_test.py
+
+Tests of the OAuth token -> user id lookup (tokens.py) against a local
+stand-in for Google's certificate and tokeninfo endpoints: ID tokens are
+signed with a key generated here, and every urlfetch is answered by
+FakeGoogle instead of going out. Run with the App Engine SDK and pycrypto
+on the Python path:
+
+    python tokens_test.py
+"""
+
+import base64
+import json
+import time
+import unittest
+
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+from google.appengine.ext import testbed
+
+from settings import WEB_CLIENT_ID
+import tokens
+
+KID = 'test-key'
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+def _intToB64(value):
+    digits = '%x' % value
+    return _b64encode(('0' * (len(digits) % 2) + digits).decode('hex'))
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, content, headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+
+class FakeGoogle(object):
+    """Stand-in for urlfetch.fetch: serves the public key of key from
+    CERTS_URL, or certs if it is set, and answers tokeninfo from users,
+    a {(token type, token): user id} dict."""
+
+    def __init__(self, key):
+        self.key = key
+        self.certs = None
+        self.users = {}
+        self.fetched = []
+
+    def __call__(self, url):
+        self.fetched.append(url)
+        if url == tokens.CERTS_URL and self.certs is not None:
+            return FakeResponse(200, self.certs)
+        if url == tokens.CERTS_URL:
+            jwk = {'kid': KID, 'kty': 'RSA', 'alg': 'RS256',
+                   'n': _intToB64(self.key.n), 'e': _intToB64(self.key.e)}
+            return FakeResponse(200, json.dumps({'keys': [jwk]}),
+                                {'Cache-Control': 'public, max-age=600'})
+        for (token_type, token), user_id in self.users.items():
+            if url == tokens.TOKENINFO_URL % (token_type, token):
+                return FakeResponse(200, json.dumps(
+                    {'user_id': user_id, 'expires_in': 3600}))
+        return FakeResponse(400, '{"error": "invalid_token"}')
+
+    def tokenInfoCalls(self):
+        return [url for url in self.fetched if url != tokens.CERTS_URL]
+
+
+class TokensTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.key = RSA.generate(1024)
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        tokens._tokens.clear()
+        tokens._certs.clear()
+        self.google = FakeGoogle(self.key)
+        self.fetch = tokens.urlfetch.fetch
+        tokens.urlfetch.fetch = self.google
+
+    def tearDown(self):
+        tokens.urlfetch.fetch = self.fetch
+        self.testbed.deactivate()
+
+    def _idToken(self, sub='1234', **claims):
+        now = int(time.time())
+        payload = {'iss': 'accounts.google.com', 'aud': WEB_CLIENT_ID,
+                   'sub': sub, 'iat': now, 'exp': now + 3600}
+        payload.update(claims)
+        signing_input = '%s.%s' % (
+            _b64encode(json.dumps({'alg': 'RS256', 'kid': KID})),
+            _b64encode(json.dumps(payload)))
+        signature = PKCS1_v1_5.new(self.key).sign(SHA256.new(signing_input))
+        return '%s.%s' % (signing_input, _b64encode(signature))
+
+    def testIdTokenVerifiedLocally(self):
+        self.assertEqual(tokens.getUserIdForToken(self._idToken()), '1234')
+        self.assertEqual(self.google.fetched, [tokens.CERTS_URL])
+
+    def testVerifiedTokenIsCached(self):
+        token = self._idToken()
+        tokens.getUserIdForToken(token)
+        self.assertEqual(tokens.getUserIdForToken(token), '1234')
+        # another instance finds it in memcache
+        tokens._tokens.clear()
+        tokens._certs.clear()
+        self.assertEqual(tokens.getUserIdForToken(token), '1234')
+        self.assertEqual(self.google.fetched, [tokens.CERTS_URL])
+
+    def testMalformedSignatureFallsBackToTokenInfo(self):
+        header, payload, signature = self._idToken().split('.')
+        token = '%s.%s.%s' % (header, payload, 'a')
+        self.google.users[('id_token', token)] = '1234'
+        self.assertEqual(tokens.getUserIdForToken(token), '1234')
+        self.assertEqual(len(self.google.tokenInfoCalls()), 1)
+
+    def testTamperedTokenIsRejected(self):
+        header, payload, signature = self._idToken().split('.')
+        other = self._idToken(sub='5678').split('.')[1]
+        token = '%s.%s.%s' % (header, other, signature)
+        self.assertEqual(tokens.getUserIdForToken(token), '')
+        self.assertTrue(self.google.tokenInfoCalls())
+
+    def testNonObjectHeaderOrClaimsAreNotAJWT(self):
+        header, payload, signature = self._idToken().split('.')
+        for token in ('%s.%s.%s' % (_b64encode('[]'), payload, signature),
+                      '%s.%s.%s' % (_b64encode('"x"'), payload, signature),
+                      '%s.%s.%s' % (header, _b64encode('[]'), signature)):
+            self.assertRaises(ValueError, tokens._verifyIdToken, token)
+            self.google.users[('id_token', token)] = '1234'
+            self.assertEqual(tokens.getUserIdForToken(token), '1234')
+
+    def testMalformedCertsFallBackToTokenInfo(self):
+        token = self._idToken()
+        self.google.users[('id_token', token)] = '1234'
+        for certs in ('[]', '"x"', '{}', '{"keys": [{"kid": "k"}]}',
+                      '{"keys": ["x"]}'):
+            tokens._certs.clear()
+            self.google.certs = certs
+            self.assertRaises(ValueError, tokens._verifyIdToken, token)
+        self.assertEqual(tokens.getUserIdForToken(token), '1234')
+
+    def testWrongAudienceFallsBackToTokenInfo(self):
+        token = self._idToken(aud='someone-else')
+        self.assertEqual(tokens.getUserIdForToken(token), '')
+        self.assertTrue(self.google.tokenInfoCalls())
+
+    def testExpiredTokenFallsBackToTokenInfo(self):
+        now = int(time.time())
+        token = self._idToken(iat=now - 7200, exp=now - 3600)
+        self.assertEqual(tokens.getUserIdForToken(token), '')
+        self.assertTrue(self.google.tokenInfoCalls())
+
+    def testAccessTokenRetriedAsAccessToken(self):
+        self.google.users[('access_token', 'ya29.access')] = '1234'
+        self.assertEqual(tokens.getUserIdForToken('ya29.access'), '1234')
+        self.assertEqual(self.google.tokenInfoCalls(), [
+            tokens.TOKENINFO_URL % ('id_token', 'ya29.access'),
+            tokens.TOKENINFO_URL % ('access_token', 'ya29.access')])
+
+    def testInvalidTokenIsNotCached(self):
+        self.assertEqual(tokens.getUserIdForToken('ya29.bogus'), '')
+        calls = len(self.google.tokenInfoCalls())
+        self.assertEqual(tokens.getUserIdForToken('ya29.bogus'), '')
+        self.assertEqual(len(self.google.tokenInfoCalls()), calls * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
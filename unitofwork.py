@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+"""unitofwork.py
+
+Udacity conference server-side Python App Engine unit of work
+
+A UnitOfWork collects the entities a request loads, creates or deletes and
+writes them back with a single put_multi (and delete_multi) in flush().
+Loaded entities are tracked with a snapshot of their serialized form, so
+flush() skips the ones that weren't changed; setting a property twice, or
+to the value it already had, costs no extra write.
+"""
+
+import collections
+
+from google.appengine.ext import ndb
+
+
+def _snapshot(entity):
+    """Return the serialized form of entity, to compare it later."""
+    return ndb.model_to_protobuf(entity).SerializeToString()
+
+
+class UnitOfWork(object):
+    """Entities to write back at the end of a unit of work.
+
+    track() entities right after loading them, before changing them; add()
+    new entities and delete() keys. on_write callbacks run after the entity
+    has been written, e.g. to invalidate a cache; inside a transaction,
+    flush() before it commits and let the callbacks use call_on_commit.
+    A transactional function is retried from scratch, so each attempt
+    must use a UnitOfWork of its own.
+    """
+
+    def __init__(self):
+        # id(entity): [entity, snapshot or None if new, [on_write, ...]]
+        self._entities = collections.OrderedDict()
+        self._deletes = []
+
+    def track(self, entity, on_write=None):
+        """Watch a loaded entity for changes. Returns entity; None is
+        passed through, so the result of a get() can be tracked as is."""
+        if entity is None:
+            return None
+        if id(entity) not in self._entities:
+            self._entities[id(entity)] = [entity, _snapshot(entity), []]
+        if on_write:
+            self._entities[id(entity)][2].append(on_write)
+        return entity
+
+    def add(self, entity, on_write=None):
+        """Write entity on the next flush, changed or not. Returns entity."""
+        if id(entity) not in self._entities:
+            self._entities[id(entity)] = [entity, None, []]
+        entry = self._entities[id(entity)]
+        entry[1] = None
+        if on_write:
+            entry[2].append(on_write)
+        return entity
+
+    def delete(self, key):
+        """Delete key on the next flush."""
+        self._deletes.append(key)
+
+    def flush(self):
+        """Write the new and changed entities with one put_multi and delete
+        the deleted keys. Returns the list of entities written; they stay
+        tracked, so a later flush only writes what changed since."""
+        dirty = [entry for entry in self._entities.values()
+                 if entry[1] is None or entry[1] != _snapshot(entry[0])]
+        deletes, self._deletes = self._deletes, []
+        if dirty:
+            ndb.put_multi([entry[0] for entry in dirty])
+        if deletes:
+            ndb.delete_multi(deletes)
+        for entry in dirty:
+            entry[1] = _snapshot(entry[0])
+            for on_write in entry[2]:
+                on_write()
+        return [entry[0] for entry in dirty]
@@ -1,10 +1,8 @@
-import json
 import os
-import time
 import uuid
 
-from google.appengine.api import urlfetch
 from models import Profile
+import tokens
 
 def getUserId(user, id_type="email"):
     if id_type == "email":
@@ -17,22 +15,8 @@ def getUserId(user, id_type="email"):
         token_type = 'id_token'
         if 'OAUTH_USER_ID' in os.environ:
             token_type = 'access_token'
-        url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-               % (token_type, token))
-        user = {}
-        wait = 1
-        for i in range(3):
-            resp = urlfetch.fetch(url)
-            if resp.status_code == 200:
-                user = json.loads(resp.content)
-                break
-            elif resp.status_code == 400 and 'invalid_token' in resp.content:
-                url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-                       % ('access_token', token))
-            else:
-                time.sleep(wait)
-                wait = wait + i
-        return user.get('user_id', '')
+        # verified locally or cached for the lifetime of the token, see tokens.py
+        return tokens.getUserIdForToken(token, token_type)
 
     if id_type == "custom":
         # implement your own user_id creation and getting algorythm